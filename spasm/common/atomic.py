@@ -1,13 +1,12 @@
 from typing import Any, TypeVar, Optional, Callable, Generic
 
-import traceback
 import time
 
-from threading import Lock, Event
-from queue import Queue
+from threading import Lock, Event, Condition
 
 from spasm.common.error import UnresolvedPromise
-from spasm.common.defaults import REFRESH_DELAY
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+from spasm.common.log import Logger
 
 _KT = TypeVar('_KT')
 _VT = TypeVar('_VT')
@@ -55,6 +54,7 @@ class AtomicCounter:
     def __init__(self):
         self._val = 0
         self._lock = Lock()
+        self._zero = Condition(self._lock)
 
     def get(self):
         with self._lock:
@@ -68,16 +68,21 @@ class AtomicCounter:
     def dec(self):
         with self._lock:
             self._val -= 1
+            if not self._val:
+                self._zero.notify_all()
             return self._val
 
     def set(self, val: int):
         with self._lock:
             self._val = val
+            if not self._val:
+                self._zero.notify_all()
 
     def block(self, stop_event: Optional[Event] = None):
         '''blocks until counter reaches zero (unreliable)'''
-        while (stop_event is None or not stop_event.is_set()) and self.get():
-            time.sleep(REFRESH_DELAY)
+        with self._zero:
+            while (stop_event is None or not stop_event.is_set()) and self._val:
+                self._zero.wait(STOP_CHECK_INTERVAL)
 
 
 class Promise:
@@ -87,20 +92,20 @@ class Promise:
 
     def __init__(self):
         self._lock = Lock()
-        self._resolved = False
+        self._resolved = Event()
 
     def resolve(self, value):
         '''
         Only the creator of this instance should call this method. once.
         '''
-        self._resolved = True
         self._value = value
+        self._resolved.set()
 
     def resolved(self):
         '''
         Returns whether the promise is resolved.
         '''
-        return self._resolved
+        return self._resolved.is_set()
 
     def get(self, blocking=False, timeout: float | None = None):
         '''
@@ -108,21 +113,17 @@ class Promise:
         If unresolved, depending on the blocking parameter, either raises an `UnresolvedPromise` exception (blocking=`False`), or waits until resolved (blocking=`True`).
         '''
         if blocking:
-            start_time = time.time()
-            while not self._resolved and timeout is None or time.time()-start_time < timeout:
-                time.sleep(REFRESH_DELAY)
-                pass
-        if not self._resolved:
+            self._resolved.wait(timeout)
+        if not self._resolved.is_set():
             raise UnresolvedPromise
         return self._value
 
 
-def safe_thread_target(logger: Queue, stop_event: Event, func: Callable):
+def safe_thread_target(logger: Logger, stop_event: Event, func: Callable):
     def new_func(*args, **kwargs):
         try:
             func(*args, **kwargs)
         except Exception as e:
-            logger.put(traceback.format_exc())
-            logger.put(f'[ERROR] {e}')
+            logger.exception('[ERROR] %s', e)
             stop_event.set()
     return new_func
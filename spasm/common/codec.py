@@ -0,0 +1,181 @@
+from typing import Any
+
+from enum import Enum
+import json
+import struct
+
+from spasm.common.error import ProtocolViolation
+
+
+class PayloadCodec(Enum):
+    JSON, \
+        BINARY \
+        = range(2)
+
+
+# Binary payload format: every value starts with a one byte type tag. Sized values (strings, bytes, lists and
+# maps) use the 8-bit size variant of their tag when they fit, and a 32-bit size otherwise.
+_NONE, _FALSE, _TRUE, \
+    _INT8, _INT32, _INT64, _BIG_INT, \
+    _FLOAT, \
+    _STR8, _STR32, \
+    _BYTES8, _BYTES32, \
+    _LIST8, _LIST32, \
+    _MAP8, _MAP32 \
+    = range(16)
+
+_INT32_STRUCT = struct.Struct('<i')
+_INT64_STRUCT = struct.Struct('<q')
+_FLOAT_STRUCT = struct.Struct('<d')
+_SIZE32_STRUCT = struct.Struct('<I')
+
+
+def _encode_size(out: bytearray, small_tag: int, size: int):
+    if size < 256:
+        out.append(small_tag)
+        out.append(size)
+    else:
+        out.append(small_tag + 1)
+        out += _SIZE32_STRUCT.pack(size)
+
+
+def _encode(out: bytearray, value: Any):
+    value_type = type(value)
+    if value_type is str:
+        encoded = value.encode()
+        _encode_size(out, _STR8, len(encoded))
+        out += encoded
+    elif value_type is int:
+        if -128 <= value < 128:
+            out.append(_INT8)
+            out.append(value & 0xFF)
+        elif -(1 << 31) <= value < (1 << 31):
+            out.append(_INT32)
+            out += _INT32_STRUCT.pack(value)
+        elif -(1 << 63) <= value < (1 << 63):
+            out.append(_INT64)
+            out += _INT64_STRUCT.pack(value)
+        else:
+            encoded = value.to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+            out.append(_BIG_INT)
+            out += _SIZE32_STRUCT.pack(len(encoded))
+            out += encoded
+    elif value_type is float:
+        out.append(_FLOAT)
+        out += _FLOAT_STRUCT.pack(value)
+    elif value_type is bool:
+        out.append(_TRUE if value else _FALSE)
+    elif value is None:
+        out.append(_NONE)
+    elif value_type is list or value_type is tuple:
+        _encode_size(out, _LIST8, len(value))
+        for item in value:
+            _encode(out, item)
+    elif value_type is dict:
+        _encode_size(out, _MAP8, len(value))
+        for key, item in value.items():
+            _encode(out, key)
+            _encode(out, item)
+    elif value_type is bytes or value_type is bytearray or value_type is memoryview:
+        _encode_size(out, _BYTES8, len(value))
+        out += value
+    else:
+        raise ProtocolViolation(f'Cannot encode value of type `{value_type.__name__}`.')
+
+
+def _decode(buf: bytes, pos: int) -> tuple[Any, int]:
+    # checks ordered by how often the tags show up in data replies
+    tag = buf[pos]
+    pos += 1
+    if tag == _STR8:
+        end = pos + 1 + buf[pos]
+        return buf[pos+1:end].decode(), end
+    if tag == _INT8:
+        value = buf[pos]
+        return value - 256 if value >= 128 else value, pos + 1
+    if tag == _INT32:
+        return _INT32_STRUCT.unpack_from(buf, pos)[0], pos + 4
+    if tag == _FLOAT:
+        return _FLOAT_STRUCT.unpack_from(buf, pos)[0], pos + 8
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _MAP8 or tag == _MAP32:
+        if tag == _MAP8:
+            size = buf[pos]
+            pos += 1
+        else:
+            size, = _SIZE32_STRUCT.unpack_from(buf, pos)
+            pos += 4
+        mapping = {}
+        for _ in range(size):
+            key, pos = _decode(buf, pos)
+            mapping[key], pos = _decode(buf, pos)
+        return mapping, pos
+    if tag == _LIST8 or tag == _LIST32:
+        if tag == _LIST8:
+            size = buf[pos]
+            pos += 1
+        else:
+            size, = _SIZE32_STRUCT.unpack_from(buf, pos)
+            pos += 4
+        items = []
+        for _ in range(size):
+            item, pos = _decode(buf, pos)
+            items.append(item)
+        return items, pos
+    if tag == _BYTES8:
+        end = pos + 1 + buf[pos]
+        return buf[pos+1:end], end
+    if tag == _NONE:
+        return None, pos
+    if tag == _STR32 or tag == _BYTES32:
+        size, = _SIZE32_STRUCT.unpack_from(buf, pos)
+        pos += 4
+        end = pos + size
+        return (buf[pos:end].decode() if tag == _STR32 else buf[pos:end]), end
+    if tag == _INT64:
+        return _INT64_STRUCT.unpack_from(buf, pos)[0], pos + 8
+    if tag == _BIG_INT:
+        size, = _SIZE32_STRUCT.unpack_from(buf, pos)
+        pos += 4
+        return int.from_bytes(buf[pos:pos+size], 'little', signed=True), pos + size
+    raise ProtocolViolation(f'Invalid binary payload tag - {tag}.')
+
+
+def encode_binary(value: Any) -> bytes:
+    '''Encodes `None`, bools, ints, floats, strings, bytes, lists, tuples and dicts of those. Tuples decode as lists.'''
+    out = bytearray()
+    _encode(out, value)
+    return out
+
+
+def decode_binary(payload: bytes | memoryview) -> Any:
+    payload = bytes(payload)
+    try:
+        value, end = _decode(payload, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, RecursionError) as e:
+        raise ProtocolViolation(f'Malformed binary payload: {e}.')
+    if end != len(payload):
+        raise ProtocolViolation('Trailing bytes after binary payload.')
+    return value
+
+
+def encode_payload(value: Any, codec: PayloadCodec) -> bytes:
+    if value is None:
+        return b''
+    if codec is PayloadCodec.BINARY:
+        return encode_binary(value)
+    return json.dumps(value).encode()
+
+
+def decode_payload(payload: bytes | memoryview, codec: PayloadCodec) -> Any:
+    if not len(payload):
+        return None
+    if codec is PayloadCodec.BINARY:
+        return decode_binary(payload)
+    try:
+        return json.loads(str(payload, 'utf-8'))
+    except ValueError as e:
+        raise ProtocolViolation(f'Malformed JSON payload: {e}.')
@@ -0,0 +1,109 @@
+from typing import Any
+
+from concurrent.futures import ProcessPoolExecutor, CancelledError, BrokenExecutor
+import multiprocessing
+
+from spasm.common.diffie_hellman import Group, ModPGroup, EllipticCurveGroup, KeyExchangeError
+
+# groups a worker built from the parameters sent with its tasks, by those parameters
+_worker_groups: dict[tuple, Group] = {}
+
+
+def _group_parameters(group: Group) -> tuple:
+    '''What a worker needs to rebuild `group`. Workers are spawned, so they don't see groups loaded at runtime.'''
+    if isinstance(group, ModPGroup):
+        return ('modp', group.name, group.modulus, group.generator(), group.exponent_bits)
+    if isinstance(group, EllipticCurveGroup):
+        return ('ec', group.name, group.curve, group.order)
+    raise KeyExchangeError(f'Group {group.name} can\'t be offloaded.')
+
+
+def _worker_group(parameters: tuple) -> Group:
+    if (group := _worker_groups.get(parameters)) is None:
+        kind, *arguments = parameters
+        group = _worker_groups[parameters] = (ModPGroup if kind == 'modp' else EllipticCurveGroup)(*arguments)
+    return group
+
+
+def _power(parameters: tuple, element: Any, exponent: int) -> Any:
+    group = _worker_group(parameters)
+    return group.to_payload(group.power(group.from_payload(element, allow_identity=True), exponent))
+
+
+def _power_generator(parameters: tuple, exponent: int) -> Any:
+    group = _worker_group(parameters)
+    return group.to_payload(group.power_generator(exponent))
+
+
+class CryptoExecutor:
+    '''
+    Runs group exponentiations in worker processes, so they don't hold the GIL of the server process. \n
+    MODP and elliptic curve groups can be offloaded. Each task carries the group parameters, and elements are passed
+    as payload values.
+    '''
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # spawned rather than forked, the server has threads and sockets open by now
+        self._executor = ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'))
+
+    def wrap(self, group: Group) -> 'OffloadedGroup':
+        return OffloadedGroup(group, self)
+
+    def _run(self, func, *args) -> Any:
+        try:
+            return self._executor.submit(func, *args).result()
+        except (CancelledError, BrokenExecutor, RuntimeError) as e:
+            # RuntimeError: submitted after shutdown
+            raise KeyExchangeError(f'Crypto executor unavailable: {e!r}')
+        except KeyExchangeError:
+            raise
+        except Exception as e:
+            # raised in the worker, like an invalid element
+            raise KeyExchangeError(f'Crypto worker failed: {e!r}')
+
+    def power(self, group: Group, element: Any, exponent: int) -> Any:
+        '''Blocks the calling thread only.'''
+        return group.from_payload(self._run(_power, _group_parameters(group), group.to_payload(element), exponent), allow_identity=True)
+
+    def power_generator(self, group: Group, exponent: int) -> Any:
+        return group.from_payload(self._run(_power_generator, _group_parameters(group), exponent))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class OffloadedGroup(Group):
+    '''`group` with its exponentiations running on a `CryptoExecutor`.'''
+
+    def __init__(self, group: Group, executor: CryptoExecutor):
+        self.group = group
+        self.name = group.name
+        self.executor = executor
+
+    def generator(self) -> Any:
+        return self.group.generator()
+
+    def random_exponent(self) -> int:
+        return self.group.random_exponent()
+
+    def power(self, element: Any, exponent: int) -> Any:
+        return self.executor.power(self.group, element, exponent)
+
+    def power_generator(self, exponent: int) -> Any:
+        return self.executor.power_generator(self.group, exponent)
+
+    def multiply(self, first: Any, second: Any) -> Any:
+        return self.group.multiply(first, second)
+
+    def inverse(self, element: Any) -> Any:
+        return self.group.inverse(element)
+
+    def to_bytes(self, element: Any) -> bytes:
+        return self.group.to_bytes(element)
+
+    def to_payload(self, element: Any) -> Any:
+        return self.group.to_payload(element)
+
+    def from_payload(self, value: Any, allow_identity: bool = False) -> Any:
+        return self.group.from_payload(value, allow_identity)
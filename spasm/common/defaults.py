@@ -1,3 +1,9 @@
 TIMEOUT = 4
 
-REFRESH_DELAY = 0.1
\ No newline at end of file
+REFRESH_DELAY = 0.1
+
+# seconds a key exchange is used for before a new one, see `MainServer.acquire_epoch`
+EPOCH_DURATION = 60
+
+# upper bound on how long an idle thread takes to notice a stop event
+STOP_CHECK_INTERVAL = 0.5
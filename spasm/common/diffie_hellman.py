@@ -1,6 +1,19 @@
-from typing import Callable
-from Crypto.Random.random import getrandbits
+from typing import Callable, Optional, Any
+from enum import Enum
+from collections import deque
+from threading import Lock, Condition, Event
+import time
+import os
+import json
+from Crypto.Random.random import getrandbits, randrange
 from Crypto.Hash import SHA384
+from Crypto.PublicKey import ECC
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Util.number import isPrime
+
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+from spasm.common.codec import encode_binary, decode_binary
+from spasm.common.error import ProtocolViolation
 
 
 class KeyExchangeError(Exception):
@@ -18,41 +31,506 @@ MOD_BYTE_LENGTH = (MOD_BIT_LENGTH + 7) // 8
 
 GENERATOR = 4
 
-assert pow(GENERATOR, MODULUS//2, MODULUS) == 1
+
+# exponents of the short exponent profile. the modulus is a safe prime, so the subgroup of quadratic residues
+# has prime order and short exponents only give up the discrete log search space, not a subgroup leak
+SHORT_EXPONENT_BITS = 384
+
+# rows of the fixed-base comb, the table holds 2^COMB_ROWS elements
+COMB_ROWS = 10
+
+
+class FixedBaseTable:
+    '''
+    Lim-Lee comb for powers of a fixed base. \n
+    An exponent of up to `exponent_bits` bits is split into `rows` rows of `span` bits each, and every
+    combination of one bit per row has its product precomputed. A power then costs `span` squarings and
+    at most `span` multiplications, against `exponent_bits` squarings for `pow`.
+    '''
+
+    def __init__(self, base: int, modulus: int, exponent_bits: int, rows: int = COMB_ROWS, table: Optional[list[int]] = None):
+        self.base = base
+        self.modulus = modulus
+        self.exponent_bits = exponent_bits
+        self.rows = rows
+        self.span = -(-exponent_bits // rows)
+        self.table = self._build() if table is None else table
+
+    def _build(self) -> list[int]:
+        row_bases = [self.base]
+        for _ in range(self.rows - 1):
+            row_bases.append(pow(row_bases[-1], 1 << self.span, self.modulus))
+        table = [1] * (1 << self.rows)
+        for combination in range(1, 1 << self.rows):
+            lowest = combination & -combination
+            table[combination] = table[combination ^ lowest] * row_bases[lowest.bit_length() - 1] % self.modulus
+        return table
+
+    def power(self, exponent: int) -> int:
+        if exponent.bit_length() > self.span * self.rows:
+            return pow(self.base, exponent, self.modulus)
+        mask = (1 << self.span) - 1
+        rows = [(exponent >> (row * self.span)) & mask for row in range(self.rows)]
+        modulus = self.modulus
+        table = self.table
+        result = 1
+        for bit in range(self.span - 1, -1, -1):
+            combination = 0
+            for row in range(self.rows):
+                combination |= ((rows[row] >> bit) & 1) << row
+            result = result * result % modulus
+            if combination:
+                result = result * table[combination] % modulus
+        return result
+
+    def save(self, path: str):
+        with open(path, 'wb') as file:
+            file.write(encode_binary({'base': self.base, 'modulus': self.modulus, 'exponent_bits': self.exponent_bits,
+                                      'rows': self.rows, 'table': self.table}))
+
+    def load(path: str, base: int, modulus: int, exponent_bits: int, rows: int = COMB_ROWS) -> Optional['FixedBaseTable']:
+        '''
+        [Static Method]
+        Reads a table written by `save`. Returns `None` if the file is missing, unreadable or for other parameters.
+        '''
+        try:
+            with open(path, 'rb') as file:
+                stored = decode_binary(file.read())
+        except (OSError, ProtocolViolation):
+            return None
+        if not isinstance(stored, dict) or \
+                [stored.get('base'), stored.get('modulus'), stored.get('exponent_bits'), stored.get('rows')] != [base, modulus, exponent_bits, rows] or \
+                not isinstance(stored.get('table'), list) or len(stored['table']) != 1 << rows:
+            return None
+        return FixedBaseTable(base, modulus, exponent_bits, rows, stored['table'])
+
+
+class Group:
+    '''
+    A group the ring key exchange runs in. Parties only need exponentiation to commute. \n
+    Elements cross the wire as payload values, see `to_payload` and `from_payload`.
+    '''
+    name: str
+
+    def generator(self) -> Any:
+        raise NotImplementedError
+
+    def random_exponent(self) -> int:
+        raise NotImplementedError
+
+    def power(self, element: Any, exponent: int) -> Any:
+        raise NotImplementedError
+
+    def power_generator(self, exponent: int) -> Any:
+        return self.power(self.generator(), exponent)
+
+    def multiply(self, first: Any, second: Any) -> Any:
+        raise NotImplementedError
+
+    def inverse(self, element: Any) -> Any:
+        raise NotImplementedError
+
+    def to_bytes(self, element: Any) -> bytes:
+        '''Fixed size encoding the shared secret is derived from.'''
+        raise NotImplementedError
+
+    def to_payload(self, element: Any) -> Any:
+        return element
+
+    def from_payload(self, value: Any, allow_identity: bool = False) -> Any:
+        '''Raises `KeyExchangeError` if `value` isn't a valid element.'''
+        raise NotImplementedError
+
+
+class ModPGroup(Group):
+    '''The multiplicative group modulo a safe prime. Exponents of `exponent_bits` bits, as long as the modulus by default.'''
+
+    def __init__(self, name: str, modulus: int, generator: int, exponent_bits: int | None = None):
+        self.name = name
+        self.modulus = modulus
+        self._generator = generator
+        self.byte_length = (modulus.bit_length() + 7) // 8
+        self.exponent_bits = modulus.bit_length() if exponent_bits is None else exponent_bits
+        self._table: Optional[FixedBaseTable] = None
+        self._table_lock = Lock()
+
+    def generator(self) -> int:
+        return self._generator
+
+    def fixed_base_table(self) -> FixedBaseTable:
+        '''The comb table of the generator, built on first use.'''
+        with self._table_lock:
+            if self._table is None:
+                self._table = FixedBaseTable(self._generator, self.modulus, self.exponent_bits)
+            return self._table
+
+    def load_fixed_base_table(self, path: str):
+        '''Uses the table cached at `path`, building and writing it there if it isn't usable.'''
+        with self._table_lock:
+            table = FixedBaseTable.load(path, self._generator, self.modulus, self.exponent_bits)
+            if table is None:
+                table = FixedBaseTable(self._generator, self.modulus, self.exponent_bits)
+                table.save(path)
+            self._table = table
+
+    def power_generator(self, exponent: int) -> int:
+        return self.fixed_base_table().power(exponent)
+
+    def random_exponent(self) -> int:
+        return getrandbits(self.exponent_bits)
+
+    def power(self, element: int, exponent: int) -> int:
+        return pow(element, exponent, self.modulus)
+
+    def multiply(self, first: int, second: int) -> int:
+        return first * second % self.modulus
+
+    def inverse(self, element: int) -> int:
+        return pow(element, -1, self.modulus)
+
+    def to_bytes(self, element: int) -> bytes:
+        return element.to_bytes(self.byte_length, 'little')
+
+    def from_payload(self, value: Any, allow_identity: bool = False) -> int:
+        if type(value) is not int or not (1 < value < self.modulus - 1 or allow_identity and value == 1):
+            raise KeyExchangeError(f'Invalid {self.name} element.')
+        return value
+
+
+class EllipticCurveGroup(Group):
+    '''Points of a pycryptodome curve. Points go over the wire as `[x, y]`.'''
+
+    def __init__(self, name: str, curve: str, order: int):
+        self.name = name
+        self.curve = curve
+        self.order = order
+        self._generator = ECC.construct(curve=curve, d=1).pointQ
+        self.byte_length = self._generator.size_in_bytes()
+
+    def generator(self) -> ECC.EccPoint:
+        return self._generator
+
+    def random_exponent(self) -> int:
+        return randrange(1, self.order)
+
+    def power(self, element: ECC.EccPoint, exponent: int) -> ECC.EccPoint:
+        return element * exponent
+
+    def multiply(self, first: ECC.EccPoint, second: ECC.EccPoint) -> ECC.EccPoint:
+        return first + second
+
+    def inverse(self, element: ECC.EccPoint) -> ECC.EccPoint:
+        return -element
+
+    def to_bytes(self, element: ECC.EccPoint) -> bytes:
+        return int(element.x).to_bytes(self.byte_length, 'big')
+
+    def to_payload(self, element: ECC.EccPoint) -> Optional[list[int]]:
+        '''The point at infinity is `None`.'''
+        if element.is_point_at_infinity():
+            return None
+        return [int(element.x), int(element.y)]
+
+    def from_payload(self, value: Any, allow_identity: bool = False) -> ECC.EccPoint:
+        if value is None and allow_identity:
+            return self._generator.point_at_infinity()
+        try:
+            x, y = value
+            point = ECC.EccPoint(x, y, self.curve)
+        except (TypeError, ValueError):
+            raise KeyExchangeError(f'Invalid {self.name} element.')
+        if point.is_point_at_infinity():
+            raise KeyExchangeError(f'Invalid {self.name} element.')
+        return point
+
+
+MODP_4096 = ModPGroup('modp4096', MODULUS, GENERATOR)
+MODP_4096_SHORT = ModPGroup('modp4096-short', MODULUS, GENERATOR, SHORT_EXPONENT_BITS)
+P256 = EllipticCurveGroup('p256', 'p256',
+    115792089210356248762697446949407573529996955224135760342422259061068512044369)
+
+GROUPS: dict[str, Group] = {group.name: group for group in [MODP_4096, MODP_4096_SHORT, P256]}
+DEFAULT_GROUP = MODP_4096
+
+
+def load_fixed_base_tables(directory: str):
+    '''Loads the comb tables of every MODP group from `directory`, writing the missing ones.'''
+    for group in GROUPS.values():
+        if isinstance(group, ModPGroup):
+            group.load_fixed_base_table(os.path.join(directory, f'{group.name}.table'))
+
+
+_validated_parameters: set[str] = set()
+_validated_parameters_lock = Lock()
+# validations of the groups `get_group` hands out, shared by the servers of this user
+VALIDATION_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'spasm', 'validated-groups')
+
+
+def parameter_hash(modulus: int, generator: int) -> str:
+    '''Hash of the modulus, the generator and the order of the subgroup it generates.'''
+    return SHA384.new(f'{modulus}:{generator}:{(modulus - 1) // 2}'.encode()).hexdigest()
+
+
+def validate_modp_parameters(modulus: int, generator: int, cache_path: Optional[str] = None) -> bool:
+    '''
+    Checks that `modulus` is a safe prime and `generator` a quadratic residue other than 1 modulo it. \n
+    A success is remembered by parameter hash for the rest of the process, and in `cache_path` if given,
+    so the primality tests run once per set of parameters rather than on every start.
+    '''
+    digest = parameter_hash(modulus, generator)
+    with _validated_parameters_lock:
+        if digest in _validated_parameters:
+            return True
+    if cache_path is not None:
+        try:
+            with open(cache_path) as file:
+                if digest in file.read().split():
+                    with _validated_parameters_lock:
+                        _validated_parameters.add(digest)
+                    return True
+        except OSError:
+            pass
+    if not isPrime(modulus) or not isPrime((modulus - 1) // 2) or not 1 < generator < modulus - 1 or \
+            pow(generator, (modulus - 1) // 2, modulus) != 1:
+        return False
+    with _validated_parameters_lock:
+        _validated_parameters.add(digest)
+    if cache_path is not None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            with open(cache_path, 'a') as file:
+                file.write(digest + '\n')
+        except OSError:
+            pass
+    return True
+
+
+def load_modp_group(path: str, name: Optional[str] = None, exponent_bits: Optional[int] = None) -> ModPGroup:
+    '''
+    Reads a parameter file written by `primes.write_parameters` and registers the group in `GROUPS`,
+    as `modp<bits>` unless `name` is given. \n
+    Raises `KeyExchangeError` if the modulus isn't a safe prime or the generator isn't a quadratic residue.
+    Successful validations are recorded next to the file, in `<path>.validated`.
+    '''
+    try:
+        with open(path) as file:
+            parameters = json.load(file)
+        modulus, generator = int(parameters['modulus']), int(parameters['generator'])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise KeyExchangeError(f'Unreadable group parameters at {path}: {e}')
+    if not validate_modp_parameters(modulus, generator, f'{path}.validated'):
+        raise KeyExchangeError(f'Invalid group parameters at {path}.')
+    group = ModPGroup(f'modp{modulus.bit_length()}' if name is None else name, modulus, generator, exponent_bits)
+    GROUPS[group.name] = group
+    return group
+
+
+def get_group(name: str) -> Group:
+    '''The group registered as `name`. MODP parameters are validated on first use, see `validate_modp_parameters`.'''
+    if name not in GROUPS:
+        raise KeyExchangeError(f'Unknown key exchange group `{name}`.')
+    group = GROUPS[name]
+    if isinstance(group, ModPGroup) and not validate_modp_parameters(group.modulus, group.generator(), VALIDATION_CACHE):
+        raise KeyExchangeError(f'Invalid parameters of key exchange group `{name}`.')
+    return group
+
+
+class EphemeralPool:
+    '''
+    Precomputed `(x, g^x)` pairs per group, refilled in the background by `run`. \n
+    The pairs don't depend on the number of parties. A group is refilled once it's been asked for,
+    `groups` are refilled from the start.
+    '''
+
+    def __init__(self, size: int, groups: Optional[list[Group]] = None):
+        self.size = size
+        groups = [DEFAULT_GROUP] if groups is None else groups
+        self._pairs: dict[str, deque[tuple[int, Any]]] = {group.name: deque() for group in groups}
+        self._groups: dict[str, Group] = {group.name: group for group in groups}
+        self._lock = Lock()
+        self._taken = Condition(self._lock)
+        self._hits = 0
+        self._misses = 0
+        self._refills = 0
+        self._refill_time = 0.
+
+    def take(self, group: Group) -> Optional[tuple[int, Any]]:
+        '''A precomputed pair of `group`, or `None` if there is none left.'''
+        with self._lock:
+            if group.name not in self._groups:
+                self._groups[group.name] = group
+                self._pairs[group.name] = deque()
+            pairs = self._pairs[group.name]
+            if not pairs:
+                self._misses += 1
+                self._taken.notify()
+                return None
+            self._hits += 1
+            self._taken.notify()
+            return pairs.popleft()
+
+    def _next_group(self) -> Optional[Group]:
+        lacking = [group for name, group in self._groups.items() if len(self._pairs[name]) < self.size]
+        return min(lacking, key=lambda group: len(self._pairs[group.name]), default=None)
+
+    def run(self, stop_event: Event):
+        while not stop_event.is_set():
+            with self._lock:
+                if (group := self._next_group()) is None:
+                    self._taken.wait(STOP_CHECK_INTERVAL)
+                    continue
+            start = time.perf_counter()
+            private_key = group.random_exponent()
+            try:
+                pair = (private_key, group.power_generator(private_key))
+            except KeyExchangeError:
+                # an offloaded group whose executor is shutting down
+                stop_event.wait(STOP_CHECK_INTERVAL)
+                continue
+            with self._lock:
+                self._pairs[group.name].append(pair)
+                self._refills += 1
+                self._refill_time += time.perf_counter() - start
+
+    def stats(self) -> dict[str, Any]:
+        '''Hits, misses, pairs computed, their rate (pairs per second of worker time) and the current fill per group.'''
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'refills': self._refills,
+                    'refill_rate': self._refills / self._refill_time if self._refill_time else None,
+                    'available': {name: len(pairs) for name, pairs in self._pairs.items()}}
+
+
+class KeyExchangeProtocol(Enum):
+    '''
+    RING: N - 1 sequential rounds, each party raising its predecessor's intermediate key. \n
+    BURMESTER_DESMEDT: two broadcast rounds, whatever the number of parties.
+    '''
+    RING, \
+        BURMESTER_DESMEDT \
+        = range(2)
 
 
 class DiffieHellmanState:
-    def __init__(self, n: int):
+    '''One party of the N party ring exchange. Intermediate keys come in and go out as payload values.'''
+
+    def __init__(self, n: int, group: Group = DEFAULT_GROUP, pool: Optional[EphemeralPool] = None):
         self._n = n
         self._step = 0
-        self._private_key = getrandbits(MOD_BIT_LENGTH)
-        self.transform_intermediate_key(GENERATOR)
+        self.group = group
+        if pool is not None and (pair := pool.take(group)) is not None:
+            self._private_key, self._latest_key = pair
+            self._step += 1
+        else:
+            self._private_key = group.random_exponent()
+            self._latest_key = group.power_generator(self._private_key)
+            self._step += 1
 
-    def transform_intermediate_key(self, key: int) -> int:
+    def _transform(self, element):
         if self._step >= self._n:
             raise KeyExchangeError(
                 f'Tried performing more than N - 1 ({self._n-1}) steps.')
-        self._latest_key = pow(key, self._private_key, MODULUS)
+        self._latest_key = self.group.power(element, self._private_key)
         self._step += 1
         return self._latest_key
 
+    def transform_intermediate_key(self, key: Any) -> Any:
+        return self.group.to_payload(self._transform(self.group.from_payload(key)))
+
     def public_key(self):
         if self._step >= self._n:
             raise KeyExchangeError(
                 f'Tried accessing final key as public. use result() instead.')
-        return self._latest_key
+        return self.group.to_payload(self._latest_key)
 
     def result(self):
         if self._step != self._n:
             return None
 
-        secret = self._latest_key.to_bytes(MOD_BYTE_LENGTH, 'little')
+        secret = self.group.to_bytes(self._latest_key)
         return SHA384.new(secret).digest()
 
 
+class BurmesterDesmedtState:
+    '''
+    One party of the Burmester-Desmedt group key agreement, `index` in the ring of `n` parties. \n
+    Round one broadcasts `z_i = g^r_i`. Round two broadcasts `X_i = (z_(i+1) / z_(i-1))^r_i`.
+    The key is `g^(r_1 r_2 + r_2 r_3 + ... + r_n r_1)`, three exponentiations per party for any `n`.
+    '''
+
+    def __init__(self, n: int, index: int, group: Group = DEFAULT_GROUP, pool: Optional[EphemeralPool] = None):
+        self._n = n
+        self._index = index
+        self.group = group
+        if pool is not None and (pair := pool.take(group)) is not None:
+            self._private_key, self._public_key = pair
+        else:
+            self._private_key = group.random_exponent()
+            self._public_key = group.power_generator(self._private_key)
+        self._neighbour_key = None
+        self._key = None
+
+    def public_key(self) -> Any:
+        '''`z_i`, broadcast in round one.'''
+        return self.group.to_payload(self._public_key)
+
+    def second_round(self, public_keys: list[Any]) -> Any:
+        '''Takes the `z` of all parties in ring order, returns `X_i` to broadcast in round two.'''
+        if len(public_keys) != self._n:
+            raise KeyExchangeError(f'Expected {self._n} public keys, got {len(public_keys)}.')
+        group = self.group
+        prev_key = group.from_payload(public_keys[(self._index - 1) % self._n])
+        next_key = group.from_payload(public_keys[(self._index + 1) % self._n])
+        # z_(i-1)^r_i, the running product below starts from it
+        self._neighbour_key = group.power(prev_key, self._private_key)
+        return group.to_payload(group.power(group.multiply(next_key, group.inverse(prev_key)), self._private_key))
+
+    def finish(self, broadcasts: list[Any]):
+        '''Takes the `X` of all parties in ring order.'''
+        if self._neighbour_key is None:
+            raise KeyExchangeError('Second round wasn\'t done.')
+        if len(broadcasts) != self._n:
+            raise KeyExchangeError(f'Expected {self._n} second round values, got {len(broadcasts)}.')
+        group = self.group
+        # z_(i-1)^(n r_i) * X_i^(n-1) * X_(i+1)^(n-2) * ... * X_(i+n-2)
+        partial = key = self._neighbour_key
+        for offset in range(self._n - 1):
+            partial = group.multiply(partial, group.from_payload(broadcasts[(self._index + offset) % self._n], allow_identity=True))
+            key = group.multiply(key, partial)
+        self._key = key
+
+    def result(self):
+        if self._key is None:
+            return None
+        return SHA384.new(self.group.to_bytes(self._key)).digest()
+
+
+def derive_query_key(shared_key: bytes, session_id: int) -> bytes:
+    '''A key for a single query session, derived from the shared key of the key epoch it runs in.'''
+    return HKDF(shared_key, SHA384.digest_size, b'spasm-query', SHA384, context=session_id.to_bytes(8, 'little'))
+
+
 if __name__ == '__main__':
     print('asymmetric.py main')
+    assert validate_modp_parameters(MODULUS, GENERATOR)
     # DH example ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    N = 3
+    for group in GROUPS.values():
+        parties = [DiffieHellmanState(N, group) for _ in range(N)]
+        for it in range(N-1):
+            keys = [party.public_key() for party in parties]
+            for i, party in enumerate(parties):
+                party.transform_intermediate_key(keys[i-1])
+        assert len({party.result() for party in parties}) == 1
+
+    for group in GROUPS.values():
+        for N in [2, 3, 5]:
+            parties = [BurmesterDesmedtState(N, i, group) for i in range(N)]
+            public_keys = [party.public_key() for party in parties]
+            broadcasts = [party.second_round(public_keys) for party in parties]
+            for party in parties:
+                party.finish(broadcasts)
+            assert len({party.result() for party in parties}) == 1
+
     N = 2
     parties = [DiffieHellmanState(N) for _ in range(N)]
 
@@ -1,6 +1,10 @@
 class ProtocolViolation(Exception):
     pass
 
+class UnknownEpochError(ProtocolViolation):
+    '''The key epoch of a request is unknown to the data server, or has no key. A new key exchange fixes it.'''
+    pass
+
 class UnresolvedPromise(Exception):
     pass
 
@@ -1,47 +1,101 @@
 import tkinter as tk
 from tkinter import ttk
-from threading import Lock, Event
-import datetime
-from queue import Queue, Empty
+from typing import Callable, Optional
+
+from threading import Event
+import time
+
+from spasm.common.log import Logger, LogLevel, LogRecord, BufferSink, time_now
+
+# lines kept by the admin console
+CONSOLE_LINES = 2000
+# milliseconds between console refreshes; everything logged in between is inserted at once
+FRAME_INTERVAL = 100
+# component of lines that don't start with a `[TAG]`
+OTHER_COMPONENT = 'OTHER'
+
+
+def component_of(text : str) -> str:
+    '''`NETWORK` for `[NETWORK] ...` and `[ERROR-NETWORK] ...`.'''
+    if not text.startswith('[') or (end := text.find(']')) < 0:
+        return OTHER_COMPONENT
+    tag = text[1:end]
+    return tag.removeprefix('ERROR-') or OTHER_COMPONENT
 
-def time_now():
-    return str(datetime.datetime.now())[:-7]
 
 class ConsoleOutputWidget(tk.Text):
-    def __init__(self, *args, **kwargs):
+    '''
+    Read-only log view holding at most `max_lines` lines; the oldest are deleted as new ones come in. \n
+    Every line is tagged with its component (`NETWORK` for `[NETWORK] ...` and `[ERROR-NETWORK] ...`), and hiding
+    a component elides its tag, so history isn't re-rendered. `on_new_component` is called the first time one shows up.
+    '''
+
+    def __init__(self, *args, max_lines : int = CONSOLE_LINES, on_new_component : Optional[Callable[[str], None]] = None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.configure(font='TkFixedFont',takefocus=0)
-        self.yview(tk.END)
-        self.lock = Lock()
-        self.lines = []
+        self.configure(font='TkFixedFont',takefocus=0,state='disabled')
+        self.max_lines = max_lines
+        self.on_new_component = on_new_component
+        self.components : set[str] = set()
+        self.tag_configure(f'level:{LogLevel.WARNING.name}', foreground='#A60')
+        self.tag_configure(f'level:{LogLevel.ERROR.name}', foreground='#C00')
     
     def add_line(self, line):
-        self.lines.append(line)
-        self.configure(state='normal')
-        self.insert(tk.END, f'{time_now()} > {line}\n')
-        self.configure(state='disabled')
-        self.yview(tk.END)
+        self.add_lines([(line, time_now(), LogLevel.INFO)])
         
     def add_text(self, text : str):
         self.add_line(text)
 
+    def add_records(self, records : list[LogRecord]):
+        self.add_lines([(record.text(), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.time)), record.level) for record in records])
+
+    def add_lines(self, lines : list[tuple[str, str, LogLevel]]):
+        '''Inserts `(text, timestamp, level)` lines with a single insert, trim and scroll.'''
+        follow = self.yview()[1] >= 1.0
+        chunks = []
+        for text, timestamp, level in lines:
+            chunks += [f'{timestamp} > {text}\n', (self._component_tag(component_of(text)), f'level:{level.name}')]
+        self.configure(state='normal')
+        self.insert(tk.END, *chunks)
+        excess = int(self.index('end-1c').split('.')[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.delete('1.0', f'{excess + 1}.0')
+        self.configure(state='disabled')
+        if follow:
+            self.yview(tk.END)
+
+    def set_visible(self, component : str, visible : bool):
+        self.tag_configure(self._component_tag(component), elide=not visible)
+
+    def _component_tag(self, component : str):
+        if component not in self.components:
+            self.components.add(component)
+            if self.on_new_component is not None:
+                self.on_new_component(component)
+        return 'component:' + component.replace(' ', '_')
+
+
 class LoggerGraphicInterface:
     def handle_updates(self):
         if self.stop_event.is_set():
             self.window.destroy()
             return
-        try:
-            message = self.logger.get_nowait()
-            self.console_output.add_text(message)
-            print(message)
-        except Empty:
-            pass
-        self.window.after(100, self.handle_updates)
+        if records := self.log_buffer.take():
+            self.console_output.add_records(records)
+        self.window.after(FRAME_INTERVAL, self.handle_updates)
+
+    def add_filter(self, component : str):
+        visible = tk.BooleanVar(self.window, True)
+        self.filter_variables[component] = visible
+        ttk.Checkbutton(self.filters, text=component, variable=visible,
+                        command=lambda: self.console_output.set_visible(component, visible.get())).pack(side='left')
     
-    def __init__(self, logger : Queue, title, subtitle, public_key):
+    def __init__(self, logger : Logger, title, subtitle, public_key):
         self.logger = logger
+        # filled by the logger thread, emptied here on the tkinter thread
+        self.log_buffer = BufferSink(CONSOLE_LINES)
+        self.logger.add_sink(self.log_buffer)
         
-        self.logger.put('[INTERFACE] Started graphics interface.')
+        self.logger.info('[INTERFACE] Started graphics interface.')
         self.window = tk.Tk()
         style = ttk.Style()
         style.theme_use('classic')
@@ -49,9 +103,12 @@ class LoggerGraphicInterface:
         self.window.title(f'{title} - Admin')
         self.name = ttk.Label(text=subtitle,font=('TkDefaultFont',20), background='#EEE')
         self.public_key = ttk.Label(text=f'Public Key: "{public_key}"',font=('Verdana'), background='#EEE')
-        self.console_output = ConsoleOutputWidget()
+        self.filters = ttk.Frame()
+        self.filter_variables : dict[str, tk.BooleanVar] = {}
+        self.console_output = ConsoleOutputWidget(on_new_component=self.add_filter)
         self.name.pack()
         self.public_key.pack()
+        self.filters.pack(padx=5, fill='x')
         self.console_output.pack(padx=5,pady=5,expand=True, fill='both')
         
         self.window.bind('<Button-1>',lambda event: event.widget == self.window and self.window.focus())
@@ -59,7 +116,7 @@ class LoggerGraphicInterface:
     def run(self, stop_event : Event):
         try:
             self.stop_event = stop_event
-            self.window.after(100, self.handle_updates)
+            self.window.after(FRAME_INTERVAL, self.handle_updates)
             self.window.mainloop()
             print('Window Closed.')
             self.stop_event.set()
@@ -0,0 +1,75 @@
+from typing import Any, Optional
+
+from threading import Event
+import signal
+import json
+import os
+
+from spasm.common.network_components import DataServer
+from spasm.common.security import AsymmetricKey
+from spasm.common.log import Logger, LogLevel, ConsoleSink, RotatingFileSink
+from spasm.common.diffie_hellman import load_modp_group, load_fixed_base_tables
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+
+# seconds a SIGTERM waits for running work before stopping anyway
+DRAIN_TIMEOUT = 30
+
+
+def load_config(path: str) -> dict[str, Any]:
+    '''
+    Reads a JSON cluster config. Relative paths in it are taken relative to the config file. \n
+    `data_servers` lists `{id, address, public_key, information, database?, key?, crypto_workers?, metrics_address?, trace_file?, profile_dir?}`,
+    `main_server` holds the main server options, `parameters` lists group parameter files to load,
+    `fixed_base_cache` a directory for fixed-base tables, and `log_level`/`log_file` set up logging.
+    '''
+    with open(path) as file:
+        config = json.load(file)
+    config['_directory'] = os.path.dirname(os.path.abspath(path))
+    return config
+
+
+def config_path(config: dict[str, Any], path: Optional[str]) -> Optional[str]:
+    return None if path is None else os.path.join(config['_directory'], path)
+
+
+def data_servers_from_config(config: dict[str, Any]) -> list[DataServer]:
+    return [DataServer(entry['id'], tuple(entry['address']), entry.get('public_key'), entry.get('information', {}))
+            for entry in config['data_servers']]
+
+
+def load_key(config: dict[str, Any], path: Optional[str]) -> AsymmetricKey:
+    '''The key saved at `path`, generated there on first start. A throwaway key if no path is configured.'''
+    return AsymmetricKey() if path is None else AsymmetricKey.load_or_generate(config_path(config, path))
+
+
+def load_crypto_config(config: dict[str, Any]):
+    for path in config.get('parameters', []):
+        load_modp_group(config_path(config, path))
+    if (directory := config_path(config, config.get('fixed_base_cache'))) is not None:
+        os.makedirs(directory, exist_ok=True)
+        load_fixed_base_tables(directory)
+
+
+def make_logger(config: dict[str, Any], level: Optional[str], log_file: Optional[str]) -> Logger:
+    '''A logger printing to stdout and, if configured, to a rotating file. Arguments override `log_level`/`log_file` of the config.'''
+    logger = Logger(LogLevel[(level or config.get('log_level', LogLevel.INFO.name)).upper()])
+    logger.add_sink(ConsoleSink())
+    if (path := log_file or config_path(config, config.get('log_file'))) is not None:
+        logger.add_sink(RotatingFileSink(path))
+    return logger
+
+
+def drain_on_signals() -> Event:
+    '''Returns an event set by SIGTERM or SIGINT. Must be called from the main thread.'''
+    drain_requested = Event()
+    def request_drain(signum, frame):
+        drain_requested.set()
+    signal.signal(signal.SIGTERM, request_drain)
+    signal.signal(signal.SIGINT, request_drain)
+    return drain_requested
+
+
+def wait_for_drain_request(drain_requested: Event, stop_event: Event):
+    '''Blocks until a drain is requested or the servers stop by themselves.'''
+    while not drain_requested.wait(STOP_CHECK_INTERVAL) and not stop_event.is_set():
+        pass
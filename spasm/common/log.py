@@ -0,0 +1,224 @@
+from typing import Any, Optional, TextIO
+
+from dataclasses import dataclass, field
+from collections import deque
+from enum import IntEnum
+from threading import Lock, Event
+from queue import Queue, Empty, Full
+import traceback
+import datetime
+import time
+import sys
+import os
+
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+
+# records waiting for the sinks. Beyond this, new records are dropped and counted
+LOG_QUEUE_SIZE = 1 << 12
+# records handed to the sinks at once
+LOG_BATCH_SIZE = 256
+LOG_FILE_SIZE = 1 << 22
+LOG_FILE_BACKUPS = 3
+# lines kept for a sink that is polled, like the GUI
+BUFFER_SINK_SIZE = 1 << 11
+
+
+def time_now():
+    return str(datetime.datetime.now())[:-7]
+
+
+class LogLevel(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
+@dataclass(slots=True)
+class LogRecord:
+    time: float
+    level: LogLevel
+    message: str
+    args: tuple
+    _line: Optional[str] = field(default=None, repr=False)
+
+    def text(self) -> str:
+        '''The message with its arguments substituted, `%`-style.'''
+        if not self.args:
+            return self.message
+        try:
+            return self.message % self.args
+        except (TypeError, ValueError):
+            return f'{self.message} {self.args}'
+
+    def line(self) -> str:
+        '''Formatted once, on first use, so every sink shares the work.'''
+        if self._line is None:
+            self._line = f'[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time))}] {self.text()}'
+        return self._line
+
+
+class LogSink:
+    def write(self, records: list[LogRecord]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ConsoleSink(LogSink):
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream
+
+    def write(self, records: list[LogRecord]):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(record.line() + '\n' for record in records))
+        stream.flush()
+
+
+class RotatingFileSink(LogSink):
+    '''Appends to `path`, moving it to `path.1` (and older files up to `path.{backups}`) once it reaches `max_bytes`.'''
+
+    def __init__(self, path: str, max_bytes: int = LOG_FILE_SIZE, backups: int = LOG_FILE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
+
+    def write(self, records: list[LogRecord]):
+        text = ''.join(record.line() + '\n' for record in records)
+        if self._size and self._size + len(text) > self.max_bytes:
+            self._rotate()
+        self._file.write(text)
+        self._file.flush()
+        self._size += len(text)
+
+    def close(self):
+        self._file.close()
+
+
+class BufferSink(LogSink):
+    '''Keeps the latest `size` records for a consumer that polls with `take`. Older records are dropped and counted.'''
+
+    def __init__(self, size: int = BUFFER_SINK_SIZE):
+        self._records: deque[LogRecord] = deque(maxlen=size)
+        self._lock = Lock()
+        self.dropped = 0
+
+    def write(self, records: list[LogRecord]):
+        with self._lock:
+            self.dropped += max(len(self._records) + len(records) - self._records.maxlen, 0)
+            self._records.extend(records)
+
+    def take(self) -> list[LogRecord]:
+        with self._lock:
+            records = list(self._records)
+            self._records.clear()
+        return records
+
+
+class Logger:
+    '''
+    Leveled logger with a bounded queue. \n
+    Messages are `%`-style templates, formatted by `run` on its own thread, and not at all below `level`:
+    `logger.debug('Received %s', data)` costs a comparison when debug logging is off.
+    When the queue is full, new records are dropped and counted instead of blocking the caller.
+    '''
+
+    def __init__(self, level: LogLevel = LogLevel.INFO, size: int = LOG_QUEUE_SIZE):
+        self.level = level
+        self._queue: Queue[LogRecord] = Queue(size)
+        self._sinks: list[LogSink] = []
+        self._dropped = {level: 0 for level in LogLevel}
+        self._dropped_lock = Lock()
+
+    def add_sink(self, sink: LogSink):
+        '''Call before `run`.'''
+        self._sinks.append(sink)
+
+    def enabled(self, level: LogLevel) -> bool:
+        return level >= self.level
+
+    def log(self, level: LogLevel, message: str, *args: Any):
+        if level < self.level:
+            return
+        try:
+            self._queue.put_nowait(LogRecord(time.time(), level, message, args))
+        except Full:
+            with self._dropped_lock:
+                self._dropped[level] += 1
+
+    def debug(self, message: str, *args: Any):
+        self.log(LogLevel.DEBUG, message, *args)
+
+    def info(self, message: str, *args: Any):
+        self.log(LogLevel.INFO, message, *args)
+
+    def warning(self, message: str, *args: Any):
+        self.log(LogLevel.WARNING, message, *args)
+
+    def error(self, message: str, *args: Any):
+        self.log(LogLevel.ERROR, message, *args)
+
+    def exception(self, message: str, *args: Any):
+        '''Logs an error with the traceback of the exception being handled.'''
+        if self.enabled(LogLevel.ERROR):
+            self.log(LogLevel.ERROR, message + '\n%s', *args, traceback.format_exc().rstrip())
+
+    def put(self, message: str):
+        '''Same as `info`, for code written against a plain queue of lines.'''
+        self.log(LogLevel.INFO, message)
+
+    def dropped(self) -> dict[str, int]:
+        with self._dropped_lock:
+            return {level.name: count for level, count in self._dropped.items()}
+
+    def _take_batch(self, timeout: float) -> list[LogRecord]:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        try:
+            while len(batch) < LOG_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def _write(self, records: list[LogRecord]):
+        for sink in self._sinks:
+            try:
+                sink.write(records)
+            except Exception:
+                traceback.print_exc()
+
+    def run(self, stop_event: Event):
+        '''Hands records to the sinks in batches until `stop_event` is set, then flushes the rest and closes them.'''
+        reported = 0
+        try:
+            while True:
+                stopping = stop_event.is_set()
+                batch = self._take_batch(0 if stopping else STOP_CHECK_INTERVAL)
+                with self._dropped_lock:
+                    dropped = sum(self._dropped.values())
+                if dropped > reported:
+                    batch.append(LogRecord(time.time(), LogLevel.WARNING, '[LOG] Queue full, dropped %d records.', (dropped - reported,)))
+                    reported = dropped
+                if batch:
+                    self._write(batch)
+                elif stopping:
+                    break
+        finally:
+            for sink in self._sinks:
+                sink.close()
@@ -0,0 +1,257 @@
+from typing import Callable, Optional, Iterator
+
+from contextlib import contextmanager
+from bisect import bisect_left
+from threading import Lock, Event
+import time
+
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+from spasm.common.log import Logger
+
+# upper bounds, in seconds, of the default histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    A metric family. Without `label_names` it is its own only child, otherwise `labels(...)` returns
+    (and remembers) the child for those label values.
+    '''
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._children: dict[tuple[str, ...], Metric] = {}
+        self._children_lock = Lock()
+        self._lock = Lock()
+
+    def _new_child(self) -> 'Metric':
+        return type(self)(self.name, self.help)
+
+    def labels(self, *values: str) -> 'Metric':
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.label_names):
+            raise ValueError(f'{self.name} takes labels {self.label_names}, got {values}.')
+        if (child := self._children.get(values)) is None:
+            with self._children_lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        '''`(suffix, labels, value)` of this child, without the family's labels.'''
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        children = list(self._children.items()) if self.label_names else [((), self)]
+        for values, child in children:
+            for suffix, extra, value in child.samples():
+                lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, values, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    '''By convention, counter names end with `_total`.'''
+    TYPE = 'counter'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self._value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def get(self) -> float:
+        return self._value
+
+    def samples(self):
+        yield '', '', self._value
+
+
+class Gauge(Metric):
+    '''Either set explicitly, or read from `function` on every scrape.'''
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self._value = 0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def get(self) -> float:
+        return self._value if self._function is None else self._function()
+
+    def samples(self):
+        yield '', '', self.get()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # per bucket, not cumulative; the last one is +Inf
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def _new_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        '''Observes the seconds spent in the `with` block, even if it raises.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float:
+        '''Estimate, by linear interpolation inside the bucket the quantile falls in.'''
+        with self._lock:
+            counts = list(self._counts)
+        total = sum(counts)
+        if not total:
+            return float('nan')
+        rank, seen = q * total, 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        with self._lock:
+            counts, total_sum = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '_bucket', f'le="{_format_value(bound)}"', cumulative
+        yield '_sum', '', total_sum
+        yield '_count', '', cumulative
+
+
+class MetricsRegistry:
+    '''Named metrics of a process. Asking for an existing name returns the existing metric.'''
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = Lock()
+
+    def _get(self, kind: type, name: str, help: str, label_names: tuple[str, ...], **kwargs) -> Metric:
+        with self._lock:
+            if (metric := self._metrics.get(name)) is None:
+                metric = self._metrics[name] = kind(name, help, label_names, **kwargs)
+            elif not isinstance(metric, kind):
+                raise ValueError(f'Metric {name} is already registered as a {metric.TYPE}.')
+            return metric
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._get(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self._get(Gauge, name, help, label_names)
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, label_names, buckets=buckets)
+
+    def render(self) -> str:
+        '''All metrics in the Prometheus text exposition format.'''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = MetricsRegistry()
+
+QUEUE_DEPTH = REGISTRY.gauge('spasm_queue_depth', 'Items waiting in an internal queue.', ('queue',))
+
+
+def export_queue_depths(depths: dict[str, Callable[[], float]]):
+    '''
+    Reads the size of each queue from its function on every scrape. \n
+    There is one callback per queue name in the process, so only the app or entry point that owns a server calls
+    this, for its own server. Components only report their queues, e.g. `ServerComponent.queue_depths`.
+    '''
+    for queue, size in depths.items():
+        QUEUE_DEPTH.labels(queue).set_function(size)
+
+
+class MetricsServer:
+    '''Serves `registry.render()` over HTTP at `/metrics`, for a Prometheus scraper on the same host.'''
+
+    def __init__(self, address: tuple[str, int], logger: Logger, registry: MetricsRegistry = REGISTRY):
+        self.address = address
+        self.logger = logger
+        self.registry = registry
+
+    def run(self, stop_event: Event):
+        # not needed unless metrics are actually served
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        with HTTPServer(self.address, Handler) as server:
+            server.timeout = STOP_CHECK_INTERVAL
+            self.logger.info('[METRICS] Serving metrics on http://%s:%d/metrics.', *self.address)
+            while not stop_event.is_set():
+                server.handle_request()
+        self.logger.info('[METRICS] Closed metrics server.')
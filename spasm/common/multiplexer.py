@@ -0,0 +1,123 @@
+from typing import Callable, Optional
+
+from queue import Queue, Empty
+from threading import Lock
+import socket
+import time
+
+from spasm.common.atomic import AtomicDict
+from spasm.common.error import DataUnavailableError
+from spasm.common.protocol import Message, MessageType
+from spasm.common.reactor import Reactor, Channel
+from spasm.common.log import Logger
+
+# replies a request may hold before its connection stops reading, until it's down to half of them
+MAX_BUFFERED_REPLIES = 8
+
+
+class PendingRequest:
+    '''
+    The replies to one request sent through a `Multiplexer`. \n
+    A streamed reply puts each `RESPONSE_PART` here before the final reply. While more than `MAX_BUFFERED_REPLIES`
+    wait to be read, the connection stops reading, so the sender is held back instead of the replies piling up.
+    Call `close` when abandoning a request before its final reply is read.
+    '''
+
+    def __init__(self, request: Message, deadline: Optional[float], discard: Callable[[], None], channel: Channel):
+        self.request = request
+        self.deadline = deadline
+        self.responses: Queue[Optional[Message]] = Queue()
+        self._discard = discard
+        self._channel = channel
+        self._holding = False
+        self._holding_lock = Lock()
+
+    def deliver(self, response: Optional[Message]):
+        '''Reactor thread only.'''
+        with self._holding_lock:
+            self.responses.put(response)
+            if not self._holding and self.responses.qsize() >= MAX_BUFFERED_REPLIES:
+                self._holding = True
+                self._channel.pause_reading()
+
+    def _release(self, force: bool = False):
+        with self._holding_lock:
+            if self._holding and (force or self.responses.qsize() <= MAX_BUFFERED_REPLIES // 2):
+                self._holding = False
+                self._channel.resume_reading()
+
+    def close(self):
+        '''Drops the request and any replies still to come.'''
+        self._discard()
+        self._release(force=True)
+
+    def get(self) -> Message:
+        '''
+        Blocks until the next reply arrives. \n
+        Raises `DataUnavailableError` if the deadline passes or the connection closes first.
+        '''
+        timeout = None if self.deadline is None else max(self.deadline - time.monotonic(), 0)
+        try:
+            response = self.responses.get(timeout=timeout)
+        except Empty:
+            self.close()
+            raise DataUnavailableError(f'Request `{self.request.id}` timed out.')
+        self._release()
+        if response is None:
+            raise DataUnavailableError(f'Connection closed before request `{self.request.id}` was answered.')
+        return response
+
+
+class Multiplexer:
+    '''
+    Shares one connection between many in-flight requests. \n
+    Replies are matched to their request by `Message.id`, so requests may be answered in any order.
+    '''
+
+    def __init__(self, reactor: Reactor, sock: socket.socket, address: tuple[str, int], logger: Logger):
+        self.address = address
+        self.logger = logger
+        self._pending: AtomicDict[int, PendingRequest] = AtomicDict()
+        self.channel = reactor.add_channel(sock, address, self._receive, self._close)
+
+    def request(self, message: Message, timeout: Optional[float] = None) -> PendingRequest:
+        '''Thread-safe. Sends `message` and returns the handle its replies will arrive on.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = PendingRequest(message, deadline, lambda: self._discard(message.id), self.channel)
+        with self._pending as requests:
+            requests[message.id] = pending
+        try:
+            self.channel.send(message)
+        except DataUnavailableError:
+            self._discard(message.id)
+            raise
+        return pending
+
+    def _discard(self, request_id: int):
+        with self._pending as requests:
+            requests.pop(request_id, None)
+
+    def in_flight(self) -> int:
+        with self._pending as requests:
+            return len(requests)
+
+    def close(self):
+        self.channel.close()
+
+    def _receive(self, channel: Channel, message: Message):
+        with self._pending as requests:
+            if message.type is MessageType.RESPONSE_PART:
+                pending = requests.get(message.id)
+            else:
+                pending = requests.pop(message.id, None)
+        if pending is None:
+            self.logger.warning('[ERROR-NETWORK] Reply from %s to unknown request `%d` (type `%s`).', self.address, message.id, message.type)
+            return
+        pending.deliver(message)
+
+    def _close(self, channel: Channel):
+        with self._pending as requests:
+            pendings = list(requests.values())
+            requests.clear()
+        for pending in pendings:
+            pending.deliver(None)
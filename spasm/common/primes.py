@@ -1,7 +1,18 @@
+from typing import Callable, Optional
 import random
 import time
+import os
+import sys
+import json
+import argparse
+import signal
+import multiprocessing
+from threading import Event
+from queue import Empty
 from Crypto.Util.number import isPrime, getRandomNBitInteger
 
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+
 _SMALL_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151, 157, 163, 167, 173, 179, 181, 191, 193, 197, 199, 211, 223, 227, 229, 233,
                 239, 241, 251, 257, 263, 269, 271, 277, 281, 283, 293, 307, 311, 313, 317, 331, 337, 347, 349, 353, 359, 367, 373, 379, 383, 389, 397, 401, 409, 419, 421, 431, 433, 439, 443, 449, 457, 461, 463, 467, 479, 487, 491, 499, 503, 509, 521, 523, 541]
 
@@ -49,9 +60,147 @@ def gen_sophie_germain_prime(bits):
         if isPrime(p) and isPrime(q):
             return q
 
+# odd primes the sieve strikes out candidates with
+SIEVE_LIMIT = 1 << 16
+# candidates per sieve window, q runs over q0, q0 + 2, ... q0 + 2 * (SIEVE_WINDOW - 1)
+SIEVE_WINDOW = 1 << 16
+PROGRESS_INTERVAL = 1
+PARAMETER_GENERATOR = 4
+
+
+def _odd_primes_below(limit: int) -> list[int]:
+    sieve = bytearray([1]) * limit
+    sieve[:2] = b'\0\0'
+    for n in range(2, int(limit ** .5) + 1):
+        if sieve[n]:
+            sieve[n*n::n] = bytes(len(range(n*n, limit, n)))
+    return [n for n in range(3, limit) if sieve[n]]
+
+
+def _sieve_window(q0: int, sieve_primes: list[int], size: int) -> bytearray:
+    '''
+    Marks the offsets `k` for which neither `q = q0 + 2k` nor `2q + 1` has a factor in `sieve_primes`. \n
+    `q0` must be odd.
+    '''
+    window = bytearray([1]) * size
+    for r in sieve_primes:
+        inverse_of_2 = (r + 1) // 2
+        # q = 0 (mod r), and 2q + 1 = 0 (mod r) i.e. q = (r - 1) / 2 (mod r)
+        for residue in (0, (r - 1) // 2):
+            start = (residue - q0) * inverse_of_2 % r
+            window[start::r] = bytes(len(range(start, size, r)))
+    return window
+
+
+def _is_safe_prime_candidate(q: int) -> bool:
+    '''Fermat tests with base 2, cheap enough to run on every sieve survivor.'''
+    p = 2 * q + 1
+    return pow(2, q - 1, q) == 1 and pow(2, p - 1, p) == 1
+
+
+def _search_safe_primes(bits: int, cancel_event, results):
+    '''Worker process. Puts `('progress', candidates, tested)` and `('found', p)` on `results`.'''
+    # the parent handles ctrl+c and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sieve_primes = [r for r in _odd_primes_below(SIEVE_LIMIT) if r.bit_length() < bits - 1]
+    window_size = min(SIEVE_WINDOW, 1 << max(bits - 5, 0))
+    candidates = tested = 0
+    last_report = time.monotonic()
+    while not cancel_event.is_set():
+        q0 = getRandomNBitInteger(bits - 1) | 1
+        # the window must stay within bits - 1 bits for p = 2q + 1 to have exactly `bits`
+        if (q0 + 2 * window_size).bit_length() != bits - 1:
+            continue
+        window = _sieve_window(q0, sieve_primes, window_size)
+        for offset in range(window_size):
+            if not window[offset]:
+                continue
+            if cancel_event.is_set():
+                return
+            q = q0 + 2 * offset
+            tested += 1
+            if _is_safe_prime_candidate(q) and isPrime(q) and isPrime(2 * q + 1):
+                results.put(('progress', candidates + offset, tested))
+                results.put(('found', 2 * q + 1))
+                return
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                results.put(('progress', candidates + offset, tested))
+                candidates, tested = -offset, 0
+                last_report = time.monotonic()
+        candidates += window_size
+    results.put(('progress', candidates, tested))
+
+
+def generate_safe_prime(bits: int, workers: Optional[int] = None, cancel_event: Optional[Event] = None,
+                        progress: Optional[Callable[[int, int, float], None]] = None) -> Optional[int]:
+    '''
+    Searches for a safe prime `p = 2q + 1` of `bits` bits on `workers` processes, all cores by default. \n
+    Candidates are sieved by the primes below `SIEVE_LIMIT` before any exponentiation.
+    `progress(candidates, tested, seconds)` is called about every `PROGRESS_INTERVAL` seconds with the totals so far.
+    Returns `None` if `cancel_event` is set first.
+    '''
+    context = multiprocessing.get_context('spawn')
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    stop = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=_search_safe_primes, args=(bits, stop, results), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    start = time.monotonic()
+    candidates = tested = 0
+    last_report = start
+    try:
+        while cancel_event is None or not cancel_event.is_set():
+            try:
+                kind, *values = results.get(timeout=STOP_CHECK_INTERVAL)
+            except Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError('All safe prime search workers died.')
+                continue
+            if kind == 'found':
+                return values[0]
+            candidates += values[0]
+            tested += values[1]
+            if progress is not None and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                progress(candidates, tested, last_report - start)
+        return None
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(STOP_CHECK_INTERVAL)
+            if process.is_alive():
+                process.terminate()
+
+
+def write_parameters(path: str, modulus: int, generator: int = PARAMETER_GENERATOR):
+    '''Writes a parameter file `diffie_hellman.load_modp_group` can read.'''
+    with open(path, 'w') as file:
+        json.dump({'bits': modulus.bit_length(), 'modulus': modulus, 'generator': generator}, file)
+
+
+def main(args: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(prog='python -m spasm.common.primes', description='Generates a safe prime Diffie-Hellman group.')
+    parser.add_argument('--bits', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--output', '-o', default=None, help='parameter file to write, the prime is only printed if not given')
+    options = parser.parse_args(args)
+
+    cancel_event = Event()
+    def report(candidates: int, tested: int, seconds: float):
+        print(f'{candidates:,} candidates ({candidates/seconds:,.0f}/s), {tested:,} past the sieve ({tested/seconds:,.1f}/s).', file=sys.stderr)
+    try:
+        prime = generate_safe_prime(options.bits, options.workers, cancel_event, report)
+    except KeyboardInterrupt:
+        cancel_event.set()
+        print('Cancelled.', file=sys.stderr)
+        return 1
+    if options.output is not None:
+        write_parameters(options.output, prime)
+        print(f'Wrote {options.bits} bit parameters to {options.output}.', file=sys.stderr)
+    print(prime)
+    return 0
+
+
 if __name__ == '__main__':
-    assert gen_sophie_germain_prime(5) == 23
-    assert gen_sophie_germain_prime(6) in [47,59]
-    st = time.time()
-    print('Sophie-Germain Prime:', gen_sophie_germain_prime(100))
-    print('Time elapsed:', time.time()-st, 'seconds')
\ No newline at end of file
+    sys.exit(main())
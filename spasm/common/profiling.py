@@ -0,0 +1,216 @@
+'''
+Sampling profiler that can be switched on and off in a running server. \n
+A session either samples every thread until stopped, or is scoped: it waits for `count` runs of a region
+marked with `PROFILER.scope(name)` (like one `KEY_EXCHANGE_START` or one `analysis_query`) and samples only the
+thread running it. Samples are written as collapsed stacks (`frame;frame;frame count` per line), the input of
+flame graph renderers like `flamegraph.pl` or speedscope. \n
+Sessions are controlled with `PROFILE` messages to the main server's loopback port, which forwards them to the
+data servers if asked to (see `python -m spasm.common.profiling --help`). SIGUSR1 toggles profiling of every
+thread in the headless servers.
+'''
+from typing import Any, Optional, Iterator
+
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Thread, Lock, get_ident, enumerate as enumerate_threads
+import argparse
+import socket
+import signal
+import json
+import time
+import sys
+import os
+
+from spasm.common.log import Logger
+
+# seconds between samples
+SAMPLE_INTERVAL = 0.005
+MAX_SCOPED_COUNT = 100
+
+
+class ProfilingError(Exception):
+    pass
+
+
+@dataclass(eq=False)
+class ProfileSession:
+    path: str
+    interval: float
+    # None samples every thread, otherwise only threads inside the scope
+    scope: Optional[str] = None
+    remaining: int = 0
+    threads: set[int] = field(default_factory=set)
+    stacks: Counter = field(default_factory=Counter)
+    samples: int = 0
+    started: float = field(default_factory=time.time)
+    sampler: Optional[Thread] = None
+
+
+def _frame_name(code) -> str:
+    return f'{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_qualname}'
+
+
+class Profiler:
+    def __init__(self):
+        self.directory = '.'
+        self.process = 'spasm'
+        self._session: Optional[ProfileSession] = None
+        self._lock = Lock()
+
+    def configure(self, directory: str, process: str):
+        '''Profiles are written to `directory`, in files named after `process`.'''
+        self.directory = directory
+        self.process = process
+
+    def start(self, scope: Optional[str] = None, count: int = 1, interval: float = SAMPLE_INTERVAL) -> dict[str, Any]:
+        if not 0 < interval <= 1 or (scope is not None and not 0 < count <= MAX_SCOPED_COUNT):
+            raise ProfilingError('Invalid profiling parameters.')
+        with self._lock:
+            if self._session is not None:
+                raise ProfilingError(f'Already profiling, into {self._session.path}.')
+            os.makedirs(self.directory, exist_ok=True)
+            now = time.time()
+            name = f'{self.process}-{scope or 'all'}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}.collapsed'
+            name = name.replace(':', '_').replace(' ', '_')
+            self._session = session = ProfileSession(os.path.abspath(os.path.join(self.directory, name)), interval, scope, count)
+            session.sampler = Thread(target=self._sample, args=(session,), name='profiler', daemon=True)
+            session.sampler.start()
+        return self.status()
+
+    def stop(self) -> dict[str, Any]:
+        '''Ends the session, scoped or not, and writes what was sampled so far.'''
+        with self._lock:
+            session, self._session = self._session, None
+        if session is None:
+            raise ProfilingError('Not profiling.')
+        return self._finish(session)
+
+    def toggle(self) -> dict[str, Any]:
+        '''Starts profiling every thread, or stops the running session.'''
+        try:
+            return self.stop()
+        except ProfilingError:
+            return self.start()
+
+    def status(self) -> dict[str, Any]:
+        with self._lock:
+            session = self._session
+            if session is None:
+                return {'profiling': False}
+            return {'profiling': True, 'path': session.path, 'scope': session.scope, 'remaining': session.remaining,
+                    'samples': session.samples, 'seconds': time.time() - session.started}
+
+    def control(self, request: dict) -> dict[str, Any]:
+        '''Handles the payload of a `PROFILE` message: `{action: start|stop|status, scope?, count?, interval?}`.'''
+        match request.get('action'):
+            case 'start':
+                return self.start(request.get('scope'), int(request.get('count', 1)), float(request.get('interval', SAMPLE_INTERVAL)))
+            case 'stop':
+                return self.stop()
+            case 'status':
+                return self.status()
+            case action:
+                raise ProfilingError(f'Unknown profiling action `{action}`.')
+
+    @contextmanager
+    def scope(self, name: str) -> Iterator[None]:
+        '''Marks a region a scoped session can capture. Costs an attribute check when no session waits for `name`.'''
+        session = self._session
+        if session is None or session.scope != name:
+            yield
+            return
+        thread = get_ident()
+        with self._lock:
+            claimed = session is self._session and session.remaining > 0
+            if claimed:
+                session.remaining -= 1
+                session.threads.add(thread)
+        try:
+            yield
+        finally:
+            if claimed:
+                with self._lock:
+                    session.threads.discard(thread)
+                    done = not session.remaining and not session.threads and session is self._session
+                    if done:
+                        self._session = None
+                if done:
+                    self._finish(session)
+
+    def _sample(self, session: ProfileSession):
+        own = get_ident()
+        while session is self._session:
+            time.sleep(session.interval)
+            if session.scope is None:
+                threads = None
+            else:
+                with self._lock:
+                    threads = set(session.threads)
+                if not threads:
+                    continue
+            names = {thread.ident: thread.name for thread in enumerate_threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (threads is not None and ident not in threads):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', '_'))
+                session.stacks[';'.join(reversed(stack))] += 1
+            session.samples += 1
+
+    def _finish(self, session: ProfileSession) -> dict[str, Any]:
+        # the sampler notices the session ended within one interval
+        session.sampler.join()
+        with open(session.path, 'w', encoding='utf-8') as file:
+            for stack, count in session.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        return {'profiling': False, 'path': session.path, 'scope': session.scope,
+                'samples': session.samples, 'seconds': time.time() - session.started}
+
+
+PROFILER = Profiler()
+
+
+def toggle_on_signal(logger: Logger, signum: int = getattr(signal, 'SIGUSR1', 0)):
+    '''Makes `signum` start or stop profiling every thread. Must be called from the main thread.'''
+    if not signum:
+        return
+
+    def toggle(signum, frame):
+        # the handler runs between bytecodes of the main thread, so file writing is left to a thread
+        Thread(target=lambda: logger.info('[PROFILE] %s', PROFILER.toggle())).start()
+    signal.signal(signum, toggle)
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    from spasm.common.protocol import Message, MessageType
+
+    parser = argparse.ArgumentParser(prog='spasm-profile', description='Starts, stops or checks profiling of a running cluster.')
+    parser.add_argument('action', choices=['start', 'stop', 'status'])
+    parser.add_argument('--address', default='localhost:5550', help='loopback address of the main server')
+    parser.add_argument('--data-server', help='id of a data server to profile instead of the main server, or `all`')
+    parser.add_argument('--scope', help='capture only runs of this region, e.g. KEY_EXCHANGE_START or analysis_query')
+    parser.add_argument('--count', type=int, default=1, help='runs of the scope to capture')
+    parser.add_argument('--interval', type=float, default=SAMPLE_INTERVAL, help='seconds between samples')
+    options = parser.parse_args(args)
+
+    request = {'action': options.action}
+    if options.action == 'start':
+        request |= {'count': options.count, 'interval': options.interval}
+        if options.scope is not None:
+            request['scope'] = options.scope
+    if options.data_server is not None:
+        request['data_server'] = options.data_server
+    host, port = options.address.rsplit(':', 1)
+    with socket.create_connection((host, int(port))) as connection:
+        connection.sendall(Message(MessageType.PROFILE, request).to_bytes())
+        reply = Message.from_bytes(buff=connection)
+    print(json.dumps(reply.data, indent=2))
+    return 0 if reply.type is MessageType.RESPONSE_OK else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,8 @@
 from typing import Optional, Union, Self, Any, overload
 from dataclasses import dataclass
 import socket
+import select
 
-import json
 from enum import Enum
 from threading import Lock, Event
 import time
@@ -11,74 +11,115 @@ from queue import Queue
 
 from spasm.common.atomic import AtomicCounter, Promise
 from spasm.common.error import ProtocolViolation, DataUnavailableError
-from spasm.common.defaults import REFRESH_DELAY
+from spasm.common.codec import PayloadCodec, encode_payload, decode_payload
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+from spasm.common.metrics import REGISTRY
+
+ENCODE_SECONDS = REGISTRY.histogram('spasm_message_encode_seconds', 'Time to encode a message, header included.', ('codec',))
+DECODE_SECONDS = REGISTRY.histogram('spasm_message_decode_seconds', 'Time to decode a message payload.', ('codec',))
+PAYLOAD_BYTES = REGISTRY.counter('spasm_message_payload_bytes_total', 'Payload bytes encoded (out) and decoded (in).', ('direction',))
+# resolved once, the labels are looked up on every message
+_encode_seconds = {codec: ENCODE_SECONDS.labels(codec.name) for codec in PayloadCodec}
+_decode_seconds = {codec: DECODE_SECONDS.labels(codec.name) for codec in PayloadCodec}
+_payload_bytes_out, _payload_bytes_in = PAYLOAD_BYTES.labels('out'), PAYLOAD_BYTES.labels('in')
 
 class ByteBuffer:
-    def __init__(self):
-        self.buf = b''
+    '''
+    Receive buffer backed by a `bytearray`. \n
+    `recv` hands out zero-copy `memoryview`s. Bytes before the `save` point are dropped once they make up
+    most of the buffer, so a long-lived connection keeps only what it hasn't consumed yet.
+    '''
+    COMPACTION_THRESHOLD = 1 << 16
+
+    def __init__(self, data: bytes = b''):
+        self.buf = bytearray(data)
         self.save_idx = 0
         self.idx = 0
         
-    def recv(self, size):
+    def recv(self, size) -> memoryview:
+        '''
+        Returns a view of up to `size` unread bytes. The view stays valid after later appends. \n
+        Release it when done: while a view is alive the array can't be resized, and appends have to copy it.
+        '''
         size = min(size,len(self.buf)-self.idx)
         self.idx += size
-        return self.buf[self.idx-size:self.idx]
+        return memoryview(self.buf)[self.idx-size:self.idx]
         
     def save(self):
         self.save_idx = self.idx
+        if self.save_idx >= ByteBuffer.COMPACTION_THRESHOLD and self.save_idx * 2 >= len(self.buf):
+            self._compact()
     
     def restore(self):
         self.idx = self.save_idx
+
+    def __len__(self):
+        '''Number of bytes not yet received.'''
+        return len(self.buf)-self.idx
+
+    def _compact(self):
+        try:
+            del self.buf[:self.save_idx]
+        except BufferError:
+            # views handed out by `recv` pin the old array, so move to a new one
+            self.buf = self.buf[self.save_idx:]
+        self.idx -= self.save_idx
+        self.save_idx = 0
     
     def append(self, data):
         if not data:
             raise DataUnavailableError
-        self.buf += data
-
-class BytesReader:
-    def __init__(self, buf: bytes) -> None:
-        self.buf = buf
-        self.iter = iter(buf)
-
-    def recv(self, size: int) -> bytes:
         try:
-            return bytes([self.iter.__next__() for _ in range(size)])
-        except StopIteration:
-            raise DataUnavailableError()
+            self.buf += data
+        except BufferError:
+            # a view is still alive. The new array holds only what wasn't consumed, and isn't pinned by anything
+            self.buf = self.buf[self.save_idx:] + data
+            self.idx -= self.save_idx
+            self.save_idx = 0
+
 
 def receive_exact_nonblock(socket: socket.socket, size: int, stop_event: Event) -> bytes:
     old_timeout = socket.gettimeout()
     
     try:
         socket.setblocking(False)
-        res = b''
-        while not stop_event.is_set() and len(res) < size:
+        res = bytearray(size)
+        view = memoryview(res)
+        received = 0
+        while not stop_event.is_set() and received < size:
             try:
-                buf = socket.recv(size-len(res))
-                res += buf
+                if not (count := socket.recv_into(view[received:])):
+                    break
+                received += count
             except BlockingIOError:
-                time.sleep(REFRESH_DELAY)
-                pass
-        if len(res) < size:
+                select.select([socket], [], [], STOP_CHECK_INTERVAL)
+        if received < size:
             raise DataUnavailableError()
         return res
     finally:
         socket.settimeout(old_timeout)
 
 
-def receive_exact(readable: socket.socket | BytesReader | ByteBuffer, size: int, stop_event: Event | None = None) -> bytes:
+def receive_exact(readable: socket.socket | ByteBuffer, size: int, stop_event: Event | None = None) -> bytes | memoryview:
+    if isinstance(readable, ByteBuffer):
+        if len(readable) < size:
+            raise DataUnavailableError()
+        return readable.recv(size)
+
     if stop_event is None:
-        res = b''
-        while len(res) < size and (buf := readable.recv(size-len(res))):
-            res += buf
-        if len(res) < size:
+        res = bytearray(size)
+        view = memoryview(res)
+        received = 0
+        while received < size and (count := readable.recv_into(view[received:])):
+            received += count
+        if received < size:
             raise DataUnavailableError()
         return res
 
     return receive_exact_nonblock(readable, size, stop_event)
 
 
-MESSAGE_TYPE_NUMBER = 12
+MESSAGE_TYPE_NUMBER = 14
 
 
 class MessageType(Enum):
@@ -98,7 +139,11 @@ class MessageType(Enum):
 \
         KEY_EXCHANGE_STEP, \
 \
-        USER_DATA_REQUEST \
+        USER_DATA_REQUEST, \
+\
+        RESPONSE_PART, \
+\
+        PROFILE \
         = range(MESSAGE_TYPE_NUMBER)
 
 
@@ -125,11 +170,16 @@ class Message:
     ID_FIELDSIZE = 8
     SESSION_ID_FIELDSIZE = 8
     DATA_SIZE_FIELDSIZE = 3
+    # low bits of the type field hold the message type, the bits above them the payload codec
+    TYPE_BITS = 5
+    HEADER_SIZE = TYPE_FIELDSIZE + ID_FIELDSIZE + SESSION_ID_FIELDSIZE + DATA_SIZE_FIELDSIZE
+    MAX_DATA_SIZE = (1 << (DATA_SIZE_FIELDSIZE*8)) - 1
 
     type: MessageType
     id: int
     session_id : int
     data: Any
+    codec: PayloadCodec
 
     @overload
     def __init__(self, message: Self) -> None:
@@ -137,25 +187,32 @@ class Message:
         pass
 
     @overload
-    def __init__(self, type: int, data: Any = None, id: int = None, session_id : int = None) -> None:
+    def __init__(self, type: int, data: Any = None, id: int = None, session_id : int = None, codec : PayloadCodec = PayloadCodec.JSON) -> None:
         '''Construct Message instance from its properties.'''
         pass
 
-    def __init__(self, type_or_obj: int | Self, data:int=None, id:int=None, session_id:int=None):
+    def __init__(self, type_or_obj: int | Self, data:int=None, id:int=None, session_id:int=None, codec:PayloadCodec=PayloadCodec.JSON):
         if isinstance(type_or_obj, Message):
             self.type = type_or_obj.type
             self.data = type_or_obj.data
             self.id = type_or_obj.id
-            self.session_id = type_or_obj.id
+            self.session_id = type_or_obj.session_id
+            self.codec = type_or_obj.codec
             return
         self.type = type_or_obj
         self.data = data
         self.id = id_counter.inc() % (1 << (Message.ID_FIELDSIZE*8)) if id is None else id
         self.session_id = 0 if session_id is None else session_id
+        self.codec = codec
 
     def generate_reply(self, success, data : Optional[Any]):
+        '''Replies are encoded with the codec of the request.'''
         response_type = MessageType.RESPONSE_OK if success else MessageType.RESPONSE_FAILED
-        return Message(response_type, data, self.id, self.session_id)
+        return Message(response_type, data, self.id, self.session_id, self.codec)
+
+    def generate_reply_part(self, data : Any):
+        '''A continuation frame of a streamed reply. The stream ends with a regular reply.'''
+        return Message(MessageType.RESPONSE_PART, data, self.id, self.session_id, self.codec)
 
     def from_bytes(bytes: bytes | None = None, buff: socket.socket | ByteBuffer | None = None, stop_event : Event = None) -> Self:
         '''
@@ -164,7 +221,6 @@ class Message:
         A provided socket must be set to blocking. \n
         Raises ProtocolViolation in case data read doesn't match the protocol.
         '''
-        res = Message(0)
         if bytes:
             reader = ByteBuffer(bytes)
         elif buff:
@@ -172,40 +228,67 @@ class Message:
 
         def get_next_bytes(size):
             return receive_exact(reader, size, stop_event)
+        res, data_size = Message.parse_header(get_next_bytes(Message.HEADER_SIZE))
+        res.decode_data(get_next_bytes(data_size))
+
+        return res
+    
+    def parse_header(header: bytes) -> tuple[Self, int]:
+        '''
+        [Static Method]
+        Parses the `HEADER_SIZE` bytes that start a frame. \n
+        Returns a Message with no data and the size of the payload that follows.
+        '''
+        res = Message(0)
+        idx = 0
         def get_next_int(size):
-            return int.from_bytes(get_next_bytes(size),'little')
+            nonlocal idx
+            idx += size
+            return int.from_bytes(header[idx-size:idx], 'little')
 
-        type_num = get_next_int(Message.TYPE_FIELDSIZE)
-        res.type = MessageType(type_num)
+        type_field = get_next_int(Message.TYPE_FIELDSIZE)
+        res.type = MessageType(type_field & ((1 << Message.TYPE_BITS) - 1))
+        try:
+            res.codec = PayloadCodec(type_field >> Message.TYPE_BITS)
+        except ValueError:
+            raise ProtocolViolation(f'Invalid payload codec - {type_field >> Message.TYPE_BITS}.')
         res.id = get_next_int(Message.ID_FIELDSIZE)
         res.session_id = get_next_int(Message.SESSION_ID_FIELDSIZE)
         data_size = get_next_int(Message.DATA_SIZE_FIELDSIZE)
-        res.decode_data(get_next_bytes(data_size))
+        return res, data_size
 
-        return res
-    
     def check_data(self):
         # TODO
         pass
 
-    def decode_data(self, payload):
-        self.data = json.loads(payload) if payload != b'' else None
+    def decode_data(self, payload: bytes | memoryview):
+        start = time.perf_counter()
+        self.data = decode_payload(payload, self.codec)
+        _decode_seconds[self.codec].observe(time.perf_counter() - start)
+        _payload_bytes_in.inc(len(payload))
         self.check_data()
 
-    def encode_data(self) -> bytes:
-        return json.dumps(self.data).encode() if self.data is not None else b''
+    def encode_data(self, codec: PayloadCodec) -> bytes:
+        return encode_payload(self.data, codec)
 
-    def to_bytes(self) -> bytes:
-        payload = self.encode_data()
+    def to_bytes(self, codec: PayloadCodec | None = None) -> bytes:
+        '''Encodes the payload with `codec`, or with the message's own codec if not given.'''
+        start = time.perf_counter()
+        codec = self.codec if codec is None else codec
+        payload = self.encode_data(codec)
         data_size = len(payload)
+        if data_size > Message.MAX_DATA_SIZE:
+            raise ProtocolViolation(f'Payload of {data_size} bytes exceeds the frame limit, stream it instead.')
         try:
-            res = self.type.value.to_bytes(Message.TYPE_FIELDSIZE, 'little') + \
+            res = (self.type.value | codec.value << Message.TYPE_BITS).to_bytes(Message.TYPE_FIELDSIZE, 'little') + \
                 self.id.to_bytes(Message.ID_FIELDSIZE, 'little') + \
                 self.session_id.to_bytes(Message.SESSION_ID_FIELDSIZE, 'little') + \
                 data_size.to_bytes(Message.DATA_SIZE_FIELDSIZE, 'little')
         except OverflowError:
             raise ProtocolViolation('Header values exceeding limits.')
         res += payload
+        _encode_seconds[codec].observe(time.perf_counter() - start)
+        _payload_bytes_out.inc(data_size)
         return res
 
     def read_data(self, key: str | int | float | bool | None, default : Any=NO_DEFAULT):
@@ -216,5 +299,37 @@ class Message:
                 f'Key \'{key}\' not found in data of message of type \'{self.type.name}\'.')
         return self.data[key]
 
+class MessageDecoder:
+    '''
+    Incremental decoder for a stream of frames. \n
+    `feed` it received bytes, then iterate over it to get every message completed so far.
+    A parsed header is kept across reads, so partial payloads aren't re-parsed.
+    '''
+
+    def __init__(self):
+        self._buffer = ByteBuffer()
+        self._pending: Message | None = None
+        self._pending_size = 0
+
+    def feed(self, data: bytes):
+        self._buffer.append(data)
+
+    def __iter__(self):
+        while True:
+            if self._pending is None:
+                if len(self._buffer) < Message.HEADER_SIZE:
+                    return
+                with self._buffer.recv(Message.HEADER_SIZE) as header:
+                    self._pending, self._pending_size = Message.parse_header(header)
+            if len(self._buffer) < self._pending_size:
+                return
+            message, self._pending = self._pending, None
+            # released right away, so appends can grow the buffer in place
+            with self._buffer.recv(self._pending_size) as payload:
+                message.decode_data(payload)
+            self._buffer.save()
+            yield message
+
+
 def reply():
     pass
\ No newline at end of file
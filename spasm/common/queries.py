@@ -4,8 +4,11 @@ import string
 from dataclasses import dataclass
 from enum import Enum
 
-from wtforms import TextAreaField
-from wtforms.validators import ValidationError
+
+def _validation_error(message: str) -> Exception:
+    '''wtforms is only needed by the web server, so it's imported when user text is actually parsed.'''
+    from wtforms.validators import ValidationError
+    return ValidationError(message)
 
 
 class BoundType(Enum):
@@ -95,7 +98,7 @@ def parse_value(text: str):
         try:
             return (float if '.' in text else int)(text)
         except ValueError:
-            raise ValidationError(f'Invalid value {text}. (parsed as number)')
+            raise _validation_error(f'Invalid value {text}. (parsed as number)')
     return text
 
 
@@ -130,11 +133,11 @@ def conditions_from_user_text(text: str):
         if oper_name == '=':
             oper_name = '=='
         if not oper_name:
-            raise ValidationError(f'No bound operator found.')
+            raise _validation_error(f'No bound operator found.')
         if oper_name not in BOUND_OPERATOR_TEXTS:
-            raise ValidationError(f'Invalid bound type `{oper_name}`.')
+            raise _validation_error(f'Invalid bound type `{oper_name}`.')
         if state == 1:
-            raise ValidationError(
+            raise _validation_error(
                 f'Expected value after bound operator `{oper_name}`.')
 
         cond_type = BoundType(BOUND_OPERATOR_TEXTS.index(oper_name))
@@ -0,0 +1,311 @@
+from typing import Callable, Optional
+
+from collections import deque
+from threading import Lock, Event, Condition, get_ident
+import selectors
+import socket
+
+from spasm.common.error import DataUnavailableError, ProtocolViolation
+from spasm.common.protocol import Message, MessageDecoder
+from spasm.common.codec import PayloadCodec
+from spasm.common.atomic import AtomicCounter
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+from spasm.common.log import Logger
+
+HANDSHAKE = b'$'
+
+RECEIVE_CHUNK_SIZE = 2048
+MAX_RECEIVE_CHUNK_SIZE = 1 << 18
+# bytes queued for a slow peer before `Channel.send` waits for them to drain
+MAX_BUFFERED_BYTES = 1 << 20
+
+
+def open_connection(address: tuple[str, int], timeout: float) -> socket.socket:
+    '''
+    Connects to a server at `address` and waits for its handshake byte. \n
+    Raises `DataUnavailableError` if the handshake doesn't arrive within `timeout` seconds.
+    '''
+    sock = socket.create_connection(address, timeout=timeout)
+    try:
+        if sock.recv(len(HANDSHAKE)) != HANDSHAKE:
+            raise DataUnavailableError(f'No handshake from {address}.')
+    except (OSError, DataUnavailableError):
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock
+
+
+class Channel:
+    '''
+    A non-blocking connection owned by a `Reactor`. \n
+    Incoming messages are passed to `on_message(channel, message)` on the reactor thread, so it must not block.
+    `send` is thread-safe, and waits while more than `MAX_BUFFERED_BYTES` are queued for the peer.
+    '''
+
+    def __init__(self, reactor: 'Reactor', sock: socket.socket, address: tuple[str, int], on_message: Callable[['Channel', Message], None], on_close: Optional[Callable[['Channel'], None]] = None):
+        self.reactor = reactor
+        self.address = address
+        self.closed = Event()
+        # overrides the payload codec of every message sent, once negotiated
+        self.codec: Optional[PayloadCodec] = None
+
+        self._sock = sock
+        self._sock.setblocking(False)
+        # every `send` is a whole message, so Nagle would only hold a reply's last part back for the peer's delayed ACK
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._on_message = on_message
+        self._on_close = on_close
+
+        self._decoder = MessageDecoder()
+        self._chunk_size = RECEIVE_CHUNK_SIZE
+        self._out = bytearray()
+        self._out_lock = Lock()
+        self._drained = Condition(self._out_lock)
+        self._writing = False
+        self._read_pauses = AtomicCounter()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def send(self, message: Message | bytes):
+        '''
+        Thread-safe. Queues whatever the socket can't take right away and flushes it on writability. \n
+        Outside the reactor thread, first waits until the queue is below `MAX_BUFFERED_BYTES`, so a slow peer holds the
+        sender back. Raises `DataUnavailableError` if the connection closes, or the reactor stops, while it waits.
+        '''
+        data = message.to_bytes(self.codec) if isinstance(message, Message) else message
+        with self._drained:
+            if not self.reactor.in_reactor_thread():
+                while len(self._out) >= MAX_BUFFERED_BYTES and not self.closed.is_set():
+                    if self.reactor.stopping():
+                        raise DataUnavailableError(f'Connection with {self.address} is closing.')
+                    self._drained.wait(STOP_CHECK_INTERVAL)
+            if self.closed.is_set():
+                raise DataUnavailableError(f'Connection with {self.address} is closed.')
+            if not self._out:
+                try:
+                    data = data[self._sock.send(data):]
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    self.close()
+                    raise DataUnavailableError(f'Connection with {self.address} is closed.')
+            if data:
+                self._out += data
+                if not self._writing:
+                    self._writing = True
+                    self.reactor.call_soon(self._update_events)
+
+    def pause_reading(self):
+        '''Thread-safe. Stops reading until a matching `resume_reading`, so TCP flow control holds the peer back.'''
+        self._read_pauses.inc()
+        self.reactor.call_soon(self._update_events)
+
+    def resume_reading(self):
+        '''Thread-safe.'''
+        self._read_pauses.dec()
+        self.reactor.call_soon(self._update_events)
+
+    def close(self):
+        '''Thread-safe. Closes the connection and calls `on_close` on the reactor thread.'''
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.reactor.call_soon(self._close_now)
+
+    def _close_now(self):
+        if self not in self.reactor._channels:
+            return
+        self.reactor._channels.discard(self)
+        self.reactor.unregister(self._sock)
+        self._sock.close()
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _update_events(self):
+        if not self.closed.is_set():
+            events = (0 if self._read_pauses.get() else selectors.EVENT_READ) | (selectors.EVENT_WRITE if self._writing else 0)
+            self.reactor.watch(self._sock, events, self._handle_events)
+
+    def _flush(self):
+        with self._out_lock:
+            try:
+                sent = self._sock.send(self._out)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._out.clear()
+                self._drained.notify_all()
+                self.close()
+                return
+            del self._out[:sent]
+            if len(self._out) < MAX_BUFFERED_BYTES:
+                self._drained.notify_all()
+            if not self._out:
+                self._writing = False
+                self._update_events()
+
+    def _receive(self):
+        '''Reads until the socket would block or reading is paused, growing the read size while reads come back full.'''
+        while not self._read_pauses.get():
+            try:
+                data = self._sock.recv(self._chunk_size)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b''
+            if not data:
+                self.close()
+                break
+            self._decoder.feed(data)
+            # before reading on, since a message may pause reading
+            for message in self._decoder:
+                self._on_message(self, message)
+            if len(data) < self._chunk_size:
+                break
+            self._chunk_size = min(self._chunk_size * 2, MAX_RECEIVE_CHUNK_SIZE)
+
+    def _handle_events(self, mask: int):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush()
+            if mask & selectors.EVENT_READ:
+                self._receive()
+        except ProtocolViolation as e:
+            self.reactor.logger.warning('[ERROR-NETWORK] %s: %s', self.address, e)
+            self.close()
+
+
+class Reactor:
+    '''
+    Selector-based event loop. \n
+    Sockets are only registered and modified on the reactor thread; other threads hand work over with `call_soon`,
+    which wakes the loop immediately.
+    '''
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+
+        self._selector = selectors.DefaultSelector()
+        self._callbacks: deque[tuple[Callable, tuple]] = deque()
+        self._callbacks_lock = Lock()
+        self._thread_id = None
+        self._stop_event: Optional[Event] = None
+        self._channels: set[Channel] = set()
+
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, self._drain_wakeups)
+
+    def in_reactor_thread(self):
+        return self._thread_id == get_ident()
+
+    def stopping(self) -> bool:
+        return self._stop_event is not None and self._stop_event.is_set()
+
+    def call_soon(self, callback: Callable, *args):
+        '''Thread-safe. Runs `callback(*args)` on the reactor thread.'''
+        with self._callbacks_lock:
+            self._callbacks.append((callback, args))
+        try:
+            self._wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            # a full pipe already guarantees a wakeup
+            pass
+
+    def _drain_wakeups(self, mask: int):
+        try:
+            while self._wakeup_reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run_callbacks(self):
+        with self._callbacks_lock:
+            callbacks = self._callbacks
+            self._callbacks = deque()
+        for callback, args in callbacks:
+            callback(*args)
+
+    def register(self, sock: socket.socket, events: int, handler: Callable[[int], None]):
+        '''Reactor thread only.'''
+        self._selector.register(sock, events, handler)
+
+    def modify(self, sock: socket.socket, events: int, handler: Callable[[int], None]):
+        '''Reactor thread only.'''
+        try:
+            self._selector.modify(sock, events, handler)
+        except (KeyError, ValueError):
+            pass
+
+    def watch(self, sock: socket.socket, events: int, handler: Callable[[int], None]):
+        '''Reactor thread only. Like `modify`, but registers `sock` again if needed, and unregisters it for no `events`.'''
+        if not events:
+            self.unregister(sock)
+            return
+        try:
+            self._selector.modify(sock, events, handler)
+        except KeyError:
+            try:
+                self._selector.register(sock, events, handler)
+            except ValueError:
+                pass
+        except ValueError:
+            pass
+
+    def unregister(self, sock: socket.socket):
+        '''Reactor thread only.'''
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def listen(self, address: tuple[str, int], on_accept: Callable[[socket.socket, tuple[str, int]], None], backlog: int = socket.SOMAXCONN) -> socket.socket:
+        '''Binds a listening socket and calls `on_accept(sock, addr)` on the reactor thread for every new connection.'''
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.bind(address)
+            server.listen(backlog)
+            server.setblocking(False)
+        except OSError:
+            server.close()
+            raise
+
+        def accept_all(mask: int):
+            while True:
+                try:
+                    sock, addr = server.accept()
+                except BlockingIOError:
+                    return
+                on_accept(sock, addr)
+
+        self.call_soon(self.register, server, selectors.EVENT_READ, accept_all)
+        return server
+
+    def add_channel(self, sock: socket.socket, address: tuple[str, int], on_message: Callable[[Channel, Message], None], on_close: Optional[Callable[[Channel], None]] = None) -> Channel:
+        '''Thread-safe. Wraps a connected socket in a `Channel` served by this reactor.'''
+        channel = Channel(self, sock, address, on_message, on_close)
+        self._channels.add(channel)
+        self.call_soon(self.register, sock, selectors.EVENT_READ, channel._handle_events)
+        return channel
+
+    def run(self, stop_event: Event):
+        '''Serves registered sockets until `stop_event` is set, then closes all of them.'''
+        self._thread_id = get_ident()
+        self._stop_event = stop_event
+        try:
+            while not stop_event.is_set():
+                self._run_callbacks()
+                for key, mask in self._selector.select(STOP_CHECK_INTERVAL):
+                    key.data(mask)
+            self._run_callbacks()
+        finally:
+            for channel in list(self._channels):
+                channel.closed.set()
+                channel._close_now()
+            for key in list(self._selector.get_map().values()):
+                key.fileobj.close()
+            self._selector.close()
+            self._wakeup_writer.close()
@@ -1,6 +1,7 @@
 from typing import Optional
 
 from dataclasses import dataclass
+import os
 
 from Crypto.PublicKey import ECC
 
@@ -12,6 +13,16 @@ class PrivateKey:
     def public_key(self):
         return self._key.public_key()
 
+    def save(self, path : str):
+        '''Writes the key as PEM, readable by the owner only.'''
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wt') as file:
+            file.write(self._key.export_key(format='PEM'))
+
+    def load(path : str) -> 'PrivateKey':
+        '''[Static Method]'''
+        with open(path, 'rt') as file:
+            return PrivateKey(ECC.import_key(file.read()))
+
 class PublicKey:
     _key : ECC.EccKey
     def __init__(self, private_key : ECC.EccKey):
@@ -24,4 +35,19 @@ class AsymmetricKey:
     
     def public_key(self):
         return self._public_key
+
+    def save(self, path : str):
+        self._private_key.save(path)
+
+    def load(path : str) -> 'AsymmetricKey':
+        '''[Static Method] Loads a key written by `save`.'''
+        return AsymmetricKey(PrivateKey.load(path))
+
+    def load_or_generate(path : str) -> 'AsymmetricKey':
+        '''[Static Method] Loads the key at `path`, generating and saving one there if there is none yet.'''
+        if os.path.exists(path):
+            return AsymmetricKey.load(path)
+        key = AsymmetricKey()
+        key.save(path)
+        return key
     
\ No newline at end of file
@@ -5,9 +5,12 @@ from enum import Enum
 from threading import Thread, Event, Lock
 
 from queue import Queue
+import time
 
+from spasm.common.atomic import AtomicDict
 from spasm.common.protocol import Message
 from spasm.common.network_components import NetworkComponent
+from spasm.common.log import Logger
 
 
 class SessionState(Enum):
@@ -16,10 +19,10 @@ class SessionState(Enum):
 class SessionContext[SessionStateType : SessionState]:
     id: int
     kill_event: Event
-    logger: Queue
+    logger: Logger
     state: SessionStateType
 
-    def __init__(self, id : int, kill_event : Event, logger : Queue, state : SessionStateType):
+    def __init__(self, id : int, kill_event : Event, logger: Logger, state : SessionStateType):
         self.id = id
         self.kill_event = kill_event
         self.logger = logger
@@ -35,9 +38,13 @@ class SessionWrapper[SessionContextType : SessionContext]:
         self._lock.acquire()
         return self._session
 
-    def __exit__(self):
+    def __exit__(self, *args):
         self._lock.release()
 
+    def unlocked(self) -> SessionContextType:
+        '''Access without the lock. Only for members that are thread-safe on their own, like queues.'''
+        return self._session
+
 
 class CommunicationSession[SessionWrapperType : SessionWrapper]:
     session_id: int
@@ -48,15 +55,120 @@ class CommunicationSession[SessionWrapperType : SessionWrapper]:
 
     incoming_requests: Queue[tuple[NetworkComponent, Message]]
 
-    def __init__(self, session_id: int, handler: Callable, session_wrapper : SessionWrapperType):
+    def __init__(self, session_id: int, handler: Callable, session_wrapper : SessionWrapperType, kill_event : Event | None = None):
         self.session_id = session_id
         self.session_wrapper = session_wrapper
-        self.kill_event = Event()
+        self.kill_event = Event() if kill_event is None else kill_event
         self.incoming_requests = Queue()
+        self.last_active = time.monotonic()
+        self.busy = 0
+        # overrides the ttl of the table, see `SessionTable.set_ttl`
+        self.ttl: float | None = None
 
         self.thread = Thread(target=handler, args=(
             self, self.kill_event))
         self.thread.start()
 
     def kill(self):
-        self.kill_event.set()
\ No newline at end of file
+        self.kill_event.set()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_time(self) -> float:
+        '''Seconds since the session last did anything, zero while it handles a request.'''
+        if self.busy or not self.incoming_requests.empty():
+            return 0
+        return time.monotonic() - self.last_active
+
+    def activity(self):
+        '''Context manager marking the session busy while it handles a request.'''
+        return _SessionActivity(self)
+
+
+class _SessionActivity:
+    def __init__(self, session: CommunicationSession):
+        self._session = session
+
+    def __enter__(self):
+        self._session.busy += 1
+
+    def __exit__(self, *args):
+        self._session.busy -= 1
+        self._session.touch()
+
+
+class SessionTable:
+    '''
+    Thread-safe map of session ids to `CommunicationSession`s, created on first use. \n
+    Sessions idle for longer than `ttl` seconds are killed by `evict_idle`.
+    '''
+
+    def __init__(self, ttl: float, handler: Callable[[CommunicationSession, Event], None], make_wrapper: Callable[[int, Event], SessionWrapper]):
+        self.ttl = ttl
+        self._handler = handler
+        self._make_wrapper = make_wrapper
+        self._sessions: AtomicDict[int, CommunicationSession] = AtomicDict()
+
+    def get(self, session_id: int) -> CommunicationSession:
+        with self._sessions as sessions:
+            if (session := sessions.get(session_id)) is None:
+                kill_event = Event()
+                session = CommunicationSession(session_id, self._handler, self._make_wrapper(session_id, kill_event), kill_event)
+                sessions[session_id] = session
+            session.touch()
+            return session
+
+    def find(self, session_id: int) -> CommunicationSession | None:
+        '''Like `get`, without creating the session if it doesn't exist.'''
+        with self._sessions as sessions:
+            if (session := sessions.get(session_id)) is not None:
+                session.touch()
+            return session
+
+    def kill(self, session_id: int) -> bool:
+        with self._sessions as sessions:
+            session = sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.kill()
+        return True
+
+    def evict_idle(self) -> list[int]:
+        '''Kills every session idle for longer than `ttl`. Returns their ids.'''
+        with self._sessions as sessions:
+            evicted = [session for session in sessions.values()
+                       if session.idle_time() > (self.ttl if session.ttl is None else session.ttl)]
+            for session in evicted:
+                del sessions[session.session_id]
+        for session in evicted:
+            session.kill()
+        return [session.session_id for session in evicted]
+
+    def set_ttl(self, session_id: int, ttl: float):
+        '''Lets one session stay idle for `ttl` seconds instead of the table's ttl.'''
+        with self._sessions as sessions:
+            if (session := sessions.get(session_id)) is not None:
+                session.ttl = ttl
+
+    def kill_all(self):
+        with self._sessions as sessions:
+            killed = list(sessions.values())
+            sessions.clear()
+        for session in killed:
+            session.kill()
+
+    def values(self) -> list[CommunicationSession]:
+        '''A snapshot of the live sessions.'''
+        with self._sessions as sessions:
+            return list(sessions.values())
+
+    def busy(self, unfinished: Callable[[CommunicationSession], bool] | None = None) -> int:
+        '''Number of sessions handling or holding requests, or idle but `unfinished` by the caller's measure.'''
+        with self._sessions as sessions:
+            return sum(1 for session in sessions.values()
+                       if not session.idle_time() or unfinished is not None and unfinished(session))
+
+    def __len__(self):
+        with self._sessions as sessions:
+            return len(sessions)
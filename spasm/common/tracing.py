@@ -0,0 +1,148 @@
+'''
+Span tracing across the servers of a cluster. \n
+A trace id is made by the loopback server for every user query and travels with it: through the query queue
+to the main server, and as the `trace` entry of `KEY_EXCHANGE_INIT` and `DATA_REQUEST` payloads to the data servers,
+which keep it in the session so ring peer steps are traced too. Each process appends its spans as JSON lines to its
+own file; `python -m spasm.common.tracing FILES...` merges the files into a waterfall per query.
+'''
+from typing import Any, Optional, Iterator
+
+from contextlib import contextmanager
+from threading import Lock, local
+import argparse
+import secrets
+import json
+import time
+import sys
+
+# seconds between flushes of the span file
+FLUSH_INTERVAL = 1
+WATERFALL_WIDTH = 60
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(8)
+
+
+class Tracer:
+    '''
+    Records spans to a file once `enable`d, otherwise does nothing. \n
+    A span without an explicit trace id belongs to the innermost span open on the same thread.
+    '''
+
+    def __init__(self):
+        self.process: Optional[str] = None
+        self._file = None
+        self._lock = Lock()
+        self._last_flush = 0.0
+        self._current = local()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def enable(self, path: str, process: str):
+        '''Appends the spans of this process, named `process` in the waterfall, to `path`.'''
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(path, 'a', encoding='utf-8')
+            self.process = process
+
+    def disable(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+
+    def current(self) -> Optional[str]:
+        return getattr(self._current, 'trace_id', None)
+
+    def record(self, trace_id: Optional[str], name: str, start: float, end: float, **attributes: Any):
+        '''Records a span that already ended. Times are `time.time()` values, comparable across processes.'''
+        if self._file is None or (trace_id := trace_id or self.current()) is None:
+            return
+        line = json.dumps({'trace': trace_id, 'process': self.process, 'name': name, 'start': start, 'end': end,
+                           'attributes': attributes}, default=str)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            if end - self._last_flush >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = end
+
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str] = None, **attributes: Any) -> Iterator[None]:
+        if self._file is None:
+            yield
+            return
+        previous = self.current()
+        trace_id = trace_id or previous
+        self._current.trace_id = trace_id
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._current.trace_id = previous
+            self.record(trace_id, name, start, time.time(), **attributes)
+
+
+TRACER = Tracer()
+
+
+def read_spans(paths: list[str]) -> dict[str, list[dict]]:
+    '''Spans of all files, by trace id, in start order.'''
+    traces: dict[str, list[dict]] = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    span = json.loads(line)
+                    traces.setdefault(span['trace'], []).append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda span: (span['start'], -span['end']))
+    return traces
+
+
+def waterfall(trace_id: str, spans: list[dict], width: int = WATERFALL_WIDTH) -> str:
+    start = min(span['start'] for span in spans)
+    duration = max(span['end'] for span in spans) - start
+    scale = width / duration if duration else 0
+    process_width = max(len(span['process'] or '') for span in spans)
+    name_width = max(len(span['name']) for span in spans)
+    lines = [f'trace {trace_id}: {duration * 1000:.1f} ms, {len(spans)} spans']
+    for span in spans:
+        offset = int((span['start'] - start) * scale)
+        length = max(int((span['end'] - start) * scale) - offset, 1)
+        attributes = ' '.join(f'{key}={value}' for key, value in span['attributes'].items())
+        lines.append(f'  {(span['process'] or ''):<{process_width}}  {span['name']:<{name_width}}  '
+                     f'|{' ' * offset}{'=' * length}{' ' * (width - offset - length)}|'
+                     f' {(span['end'] - span['start']) * 1000:8.1f} ms  {attributes}')
+    return '\n'.join(lines)
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='spasm-trace', description='Prints per-query waterfalls from span files.')
+    parser.add_argument('files', nargs='+', help='span files of the main server and the data servers')
+    parser.add_argument('--trace', help='only this trace id')
+    parser.add_argument('--slowest', type=int, help='only the N slowest traces')
+    parser.add_argument('--width', type=int, default=WATERFALL_WIDTH)
+    options = parser.parse_args(args)
+
+    traces = read_spans(options.files)
+    if options.trace is not None:
+        if options.trace not in traces:
+            print(f'No spans for trace {options.trace}.', file=sys.stderr)
+            return 1
+        traces = {options.trace: traces[options.trace]}
+    order = sorted(traces, key=lambda trace_id: min(span['start'] for span in traces[trace_id]))
+    if options.slowest is not None:
+        order = sorted(order, key=lambda trace_id: max(span['end'] for span in traces[trace_id]) -
+                       min(span['start'] for span in traces[trace_id]), reverse=True)[:options.slowest]
+    print('\n\n'.join(waterfall(trace_id, traces[trace_id], options.width) for trace_id in order))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,23 @@
 from __future__ import annotations
 
-from queue import Queue, Empty
 from threading import Thread, Event
 
 from spasm.common.network_components import DataServer
 from spasm.common.security import AsymmetricKey
 from spasm.common.atomic import safe_thread_target, ImpliedEvent
-from spasm.common.graphics import LoggerGraphicInterface, time_now
+from spasm.common.log import Logger, ConsoleSink
+from spasm.common.metrics import MetricsServer, export_queue_depths
 
 class App:
-    def __init__(self, address: tuple[str, int], database: Database, key : AsymmetricKey, data_servers : list[DataServer], this_data_server : DataServer):
+    def __init__(self, address: tuple[str, int], database: Database, key : AsymmetricKey, data_servers : list[DataServer], this_data_server : DataServer, crypto_workers : int = 0, metrics_address : tuple[str, int] | None = None):
+        # tkinter is only loaded by apps that actually open a window
+        from spasm.common.graphics import LoggerGraphicInterface
+
         self.address = address
 
-        self.logger = Queue()
+        self.logger = Logger()
+        self.logger.add_sink(ConsoleSink())
+        self.log_stop_event = Event()
         
         self.outside_representation = this_data_server
 
@@ -20,8 +25,12 @@ class App:
         self.sub_stop_event = ImpliedEvent(self.stop_event)
 
         self.database = DataComponent(database, self.logger)
-        self.server = ServerComponent(address, self.logger, self.database, key, data_servers, this_data_server)
+        self.server = ServerComponent(address, self.logger, self.database, key, data_servers, this_data_server, crypto_workers)
+        export_queue_depths(self.database.queue_depths() | self.server.queue_depths())
         self.gui = LoggerGraphicInterface(self.logger, 'Data Server', f'Data Server of "{this_data_server.information["name"]}"', this_data_server.public_key)
+        # started once the GUI has added its sink
+        self.log_thread = Thread(target=self.logger.run, args=(self.log_stop_event,))
+        self.log_thread.start()
 
         self.database_thread = Thread(
             target=safe_thread_target(self.logger,self.sub_stop_event,self.database.run), args=(self.sub_stop_event,))
@@ -30,6 +39,12 @@ class App:
         self.server_thread = Thread(
             target=safe_thread_target(self.logger,self.sub_stop_event,self.server.run), args=(self.sub_stop_event,))
         self.server_thread.start()
+
+        self.metrics_thread = None
+        if metrics_address is not None:
+            self.metrics_thread = Thread(
+                target=safe_thread_target(self.logger,self.sub_stop_event,MetricsServer(metrics_address, self.logger).run), args=(self.sub_stop_event,))
+            self.metrics_thread.start()
         
         try:
             self.gui.run(self.stop_event)
@@ -39,12 +54,11 @@ class App:
             self.stop_event.set()
         self.database_thread.join()
         self.server_thread.join()
+        if self.metrics_thread is not None:
+            self.metrics_thread.join()
         print('Terminating...')
-        try:
-            while msg := self.logger.get_nowait():
-                print(f'[{time_now()}]',msg)
-        except Empty:
-            pass
+        self.log_stop_event.set()
+        self.log_thread.join()
         print('Done.')
 
     def __repr__(self) -> str:
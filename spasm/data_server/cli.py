@@ -0,0 +1,73 @@
+'''Headless data server: `spasm-data-server CONFIG --index N`.'''
+from typing import Optional
+
+from threading import Thread, Event
+import argparse
+import sys
+
+from spasm.common.atomic import safe_thread_target
+from spasm.common.log import LogLevel
+from spasm.common.metrics import MetricsServer, export_queue_depths
+from spasm.common.tracing import TRACER
+from spasm.common.profiling import PROFILER, toggle_on_signal
+from spasm.common.headless import DRAIN_TIMEOUT, load_config, config_path, data_servers_from_config, load_key, \
+    load_crypto_config, make_logger, drain_on_signals, wait_for_drain_request
+
+from spasm.data_server.data import DataComponent, JsonFileDatabase
+from spasm.data_server.network import ServerComponent, CRYPTO_WORKERS
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='spasm-data-server', description='Runs a data server without a GUI.')
+    parser.add_argument('config', help='cluster config file')
+    parser.add_argument('--index', type=int, required=True, help='index of this server in the `data_servers` of the config')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT)
+    parser.add_argument('--log-level', choices=[level.name for level in LogLevel], type=str.upper)
+    parser.add_argument('--log-file', help='rotating log file, in addition to stdout')
+    options = parser.parse_args(args)
+
+    config = load_config(options.config)
+    load_crypto_config(config)
+    data_servers = data_servers_from_config(config)
+    this_data_server = data_servers[options.index]
+    entry = config['data_servers'][options.index]
+
+    logger = make_logger(config, options.log_level, options.log_file)
+    if 'trace_file' in entry:
+        TRACER.enable(config_path(config, entry['trace_file']), f'data:{this_data_server.id}')
+    PROFILER.configure(config_path(config, entry.get('profile_dir', '.')), f'data-{this_data_server.id}')
+    toggle_on_signal(logger)
+    stop_event = Event()
+    log_stop_event = Event()
+    drain_requested = drain_on_signals()
+
+    database = DataComponent(JsonFileDatabase(config_path(config, entry['database'])), logger)
+    server = ServerComponent(this_data_server.address, logger, database, load_key(config, entry.get('key')),
+                             data_servers, this_data_server, entry.get('crypto_workers', CRYPTO_WORKERS))
+    export_queue_depths(database.queue_depths() | server.queue_depths())
+
+    log_thread = Thread(target=logger.run, args=(log_stop_event,))
+    threads = [Thread(target=safe_thread_target(logger, stop_event, database.run), args=(stop_event,)),
+               Thread(target=safe_thread_target(logger, stop_event, server.run), args=(stop_event,))]
+    if 'metrics_address' in entry:
+        metrics_server = MetricsServer(tuple(entry['metrics_address']), logger)
+        threads.append(Thread(target=safe_thread_target(logger, stop_event, metrics_server.run), args=(stop_event,)))
+    log_thread.start()
+    for thread in threads:
+        thread.start()
+
+    wait_for_drain_request(drain_requested, stop_event)
+    if not stop_event.is_set():
+        logger.info('[SERVER] Draining...')
+        server.drain(options.drain_timeout)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    TRACER.disable()
+    log_stop_event.set()
+    log_thread.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,20 @@
-from typing import Callable, Iterable, Any
+from typing import Callable, Iterable, Iterator, Any
 from threading import Event, Lock
 import time
+import copy
+import json
 
 from queue import Queue, Empty
 
 from Crypto.Hash import SHA384
 
-from spasm.common.defaults import REFRESH_DELAY
+from spasm.common.defaults import STOP_CHECK_INTERVAL
+from spasm.common.log import Logger
+from spasm.common.metrics import REGISTRY
+from spasm.common.tracing import TRACER
+
+READ_SECONDS = REGISTRY.histogram('spasm_database_read_seconds', 'Time spent hashing ids and fetching records for one read, not counting the consumer.')
+RECORDS_READ = REGISTRY.counter('spasm_database_records_total', 'Records fetched from the database.')
 
 class Database:
     def __init__(self, data: dict):
@@ -17,44 +25,79 @@ class Database:
         pass
 
 
+class JsonFileDatabase(Database):
+    '''Read-only database loaded from a JSON object of id -> record.'''
+
+    def __init__(self, location: str):
+        self.file_location = location
+        with open(location, 'r') as f:
+            self._data: dict = json.load(f)
+
+    def get(self, id):
+        return copy.deepcopy(self._data.get(id))
+
+
 class DataComponent:
-    def __init__(self, database: Database, logger : Queue):
+    def __init__(self, database: Database, logger : Logger):
         self.logger = logger
         self._reader_lock = Lock()
         self._database = database
         self._request_queue: Queue[tuple[Queue,
                                          Iterable[str], bytes]] = Queue()
 
+    def queue_depths(self) -> dict[str, Callable[[], int]]:
+        '''Sizes of the internal queues, for `export_queue_depths`.'''
+        return {'database_requests': self._request_queue.qsize}
+
     def write(self, callback: Callable[[Database], None]):
         with self._reader_lock:
-            self.logger.put('[DATA] Writing...')
+            self.logger.info('[DATA] Writing...')
             callback(self._database)
-            self.logger.put('[DATA] Done writing.')
+            self.logger.info('[DATA] Done writing.')
+
+    def _read(self, id_subset: Iterable[str], salt: bytes, raw_digests: bool = False) -> list[tuple[str | bytes,Any]]:
+        '''Returns the records of `id_subset` keyed by their salted hash, as raw bytes if `raw_digests`, otherwise as hex.'''
+        return list(self.read_stream(id_subset, salt, raw_digests))
 
-    def _read(self, id_subset: Iterable[str], salt: bytes) -> list[tuple[str,Any]]:
+    def read_stream(self, id_subset: Iterable[str], salt: bytes, raw_digests: bool = False) -> Iterator[tuple[str | bytes,Any]]:
+        '''
+        Same as `_read`, but yields the records one by one in hash order. \n
+        Only the hashes are held up front, each record is fetched when it's reached.
+        '''
+        self.logger.debug('[DATA] Fetching... (secret salt: `%s`).', salt)
+        wall_start, start = time.time(), time.perf_counter()
         with self._reader_lock:
-            self.logger.put(f'[DATA] Fetching... (secret salt: `{salt}`).')
-            result = []
             base_hasher = SHA384.new(salt)
+            hashed_ids = []
             for id in id_subset:
                 hasher = base_hasher.copy()
-                if data := self._database.get(id):
-                    hasher.update(id.encode())
-                    result.append((hasher.hexdigest(), data))
-            result.sort()
-            self.logger.put(f'[DATA] Done fetching.')
-            return result
+                hasher.update(id.encode())
+                hashed_ids.append((hasher.digest(), id))
+        hashed_ids.sort()
+        busy = time.perf_counter() - start
+        records = 0
+        for digest, id in hashed_ids:
+            start = time.perf_counter()
+            with self._reader_lock:
+                data = self._database.get(id)
+            busy += time.perf_counter() - start
+            if data:
+                records += 1
+                RECORDS_READ.inc()
+                yield (digest if raw_digests else digest.hex(), data)
+        READ_SECONDS.observe(busy)
+        TRACER.record(None, 'database_read', wall_start, time.time(), records=records, busy=round(busy, 6))
+        self.logger.debug('[DATA] Done fetching.')
 
     def request(self, output_queue: Queue, request_id, id_subset: Iterable[str], salt: bytes):
         self._request_queue.put((output_queue, request_id, id_subset, salt))
 
     def run(self, stop_event: Event):
-        self.logger.put('[DATA] Started database, waiting for requests.')
+        self.logger.info('[DATA] Started database, waiting for requests.')
         while not stop_event.is_set():
             try:
-                output_queue, request_id, id_subset, salt = self._request_queue.get_nowait()
-                output_queue.put((request_id, self._read(id_subset, salt)))
+                output_queue, request_id, id_subset, salt = self._request_queue.get(timeout=STOP_CHECK_INTERVAL)
             except Empty:
-                time.sleep(REFRESH_DELAY)
-                pass
-        self.logger.put(f'[DATA] Closed database. approximately {self._request_queue.qsize()} requests lost.')
+                continue
+            output_queue.put((request_id, self._read(id_subset, salt)))
+        self.logger.info('[DATA] Closed database. approximately %d requests lost.', self._request_queue.qsize())
@@ -1,11 +1,9 @@
 from __future__ import annotations
 
-from typing import Optional, Union, Callable, Any, overload
+from typing import Optional, Union, Callable, Iterable, Any, overload
 from dataclasses import dataclass
 from enum import Enum
 
-import traceback
-import errno
 import socket
 from threading import Thread, Lock, Event
 from queue import Queue, Empty
@@ -13,20 +11,48 @@ import time
 
 from Crypto.Hash import SHA384
 
-from spasm.common.error import DataUnavailableError, ProtocolViolation
-from spasm.common.protocol import ByteBuffer, Message, MessageType
-from spasm.common.atomic import safe_thread_target, ImpliedEvent
-from spasm.common.diffie_hellman import DiffieHellmanState
+from spasm.common.error import DataUnavailableError, ProtocolViolation, UnknownEpochError
+from spasm.common.protocol import Message, MessageType
+from spasm.common.codec import PayloadCodec
+from spasm.common.reactor import Reactor, Channel, HANDSHAKE
+from spasm.common.atomic import safe_thread_target
+from spasm.common.sessions import CommunicationSession, SessionWrapper, SessionTable
+from spasm.common.diffie_hellman import DiffieHellmanState, KeyExchangeError, BurmesterDesmedtState, KeyExchangeProtocol, Group, DEFAULT_GROUP, EphemeralPool, get_group, derive_query_key
+from spasm.common.crypto_pool import CryptoExecutor
 from spasm.common.network_components import DataServer
 from spasm.common.security import AsymmetricKey
-from spasm.common.defaults import REFRESH_DELAY
+from spasm.common.defaults import STOP_CHECK_INTERVAL, REFRESH_DELAY, EPOCH_DURATION
+from spasm.common.log import Logger
+from spasm.common.metrics import REGISTRY
+from spasm.common.tracing import TRACER
+from spasm.common.profiling import PROFILER, ProfilingError
 
 from spasm.data_server.data import DataComponent
+from spasm.data_server.sessions import DataSession, KeyExchangeState
+from spasm.data_server.peers import PeerLinks
 
 TIMEOUT = 4
 
+# the only requests that start a session, any other request must belong to a live one
+SESSION_OPENING_REQUESTS = (MessageType.KEY_EXCHANGE_INIT, MessageType.DATA_REQUEST)
+
+STREAM_CHUNK_SIZE = 1024
+
+SESSION_TTL = 30
+# a key epoch session is kept this long past the epoch duration the main server announced, even if idle
+EPOCH_TTL_MARGIN = SESSION_TTL
+SESSION_SWEEP_INTERVAL = 1
+
+EPHEMERAL_POOL_SIZE = 8
+
+# worker processes for key exchange exponentiations, 0 runs them in the session threads
+CRYPTO_WORKERS = 0
+
+SESSION_REQUEST_SECONDS = REGISTRY.histogram('spasm_session_request_seconds', 'Time to handle a session request, by message type.', ('type',))
+SESSION_REQUEST_FAILURES = REGISTRY.counter('spasm_session_request_failures_total', 'Session requests answered with a failure, by message type.', ('type',))
+
 class ServerComponent:
-    def __init__(self, address : tuple[str,int], logger : Queue, database : DataComponent, security_key : AsymmetricKey, data_servers : list[DataServer], this_data_server : DataServer):
+    def __init__(self, address : tuple[str,int], logger : Logger, database : DataComponent, security_key : AsymmetricKey, data_servers : list[DataServer], this_data_server : DataServer, crypto_workers : int = CRYPTO_WORKERS):
         self.address = address
         self.logger = logger
         self.database = database
@@ -34,155 +60,331 @@ class ServerComponent:
         self.known_data_servers = data_servers
         self.this_data_server = this_data_server
         
-        self.key_exchange_component : DiffieHellmanState = None
-        
-        self.key_queue = Queue()
+        self.sessions = SessionTable(SESSION_TTL, self.handle_session,
+            lambda session_id, kill_event: SessionWrapper(DataSession(session_id, kill_event, logger)))
+
+        self.crypto = CryptoExecutor(crypto_workers) if crypto_workers else None
+        self.ephemerals = EphemeralPool(EPHEMERAL_POOL_SIZE, [self.key_exchange_group(DEFAULT_GROUP.name)])
+
+        self.main_connection : Channel = None
+        self.main_requests : Queue[Message] = Queue()
         self.database_output = Queue()
+        # set by `drain`, refuses new sessions
+        self.draining = Event()
+
+    def queue_depths(self) -> dict[str, Callable[[], int]]:
+        '''Sizes of the internal queues, for `export_queue_depths`.'''
+        return {'key_exchange': lambda: sum(session.session_wrapper.unlocked().key_queue.qsize() for session in self.sessions.values())}
+
+    def send_reply(self, reply : Message):
+        '''Every reply to the main server goes out here, encoded with the codec of its request.'''
+        self.main_connection.send(reply.to_bytes())
 
     def reply_ok(self, request : Message, data = None):
-        self.main_connection.send(request.generate_reply(True,data).to_bytes())
+        self.send_reply(request.generate_reply(True,data))
+
+    def reply_stream(self, request : Message, items : Iterable):
+        '''
+        Streams `items` as `RESPONSE_PART` frames of up to `STREAM_CHUNK_SIZE` items each, then replies with the item count. \n
+        A chunk that doesn't fit in one frame is split in halves. Sending waits while the main server is behind, see
+        `Channel.send`, so records are only read as fast as it takes them.
+        '''
+        count = 0
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                self.send_reply_part(request, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            self.send_reply_part(request, chunk)
+            count += len(chunk)
+        self.reply_ok(request, count)
+
+    def send_reply_part(self, request : Message, chunk : list):
+        try:
+            # raises before sending anything if the chunk doesn't fit in a frame
+            self.send_reply(request.generate_reply_part(chunk))
+        except ProtocolViolation:
+            if len(chunk) == 1:
+                raise
+            self.send_reply_part(request, chunk[:len(chunk)//2])
+            self.send_reply_part(request, chunk[len(chunk)//2:])
+
+    def reply_failed(self, request : Message, data = None):
+        self.send_reply(request.generate_reply(False,data))
 
     def handle_request(self, request : Message):
-        self.logger.put(f'[NETWORK] received message from main: type `{\
-            request.type}`, id `{request.id}`, sid `{request.session_id}`.')
+        '''Handles session-less requests and session control, on the main connection thread.'''
+        self.logger.debug('[NETWORK] received message from main: type `%s`, id `%d`, sid `%d`.',
+            request.type, request.id, request.session_id)
+        match request.type:
+            case MessageType.INFO:
+                offered = request.read_data('codecs', [])
+                codec = next((name for name in offered if name in PayloadCodec.__members__), PayloadCodec.JSON.name)
+                self.reply_ok(request, {'codec': codec, 'ephemerals': self.ephemerals.stats()})
+            case MessageType.END_SESSION:
+                self.reply_ok(request, self.sessions.kill(request.session_id))
+            case MessageType.PROFILE:
+                try:
+                    self.reply_ok(request, PROFILER.control(request.data or {}))
+                except (ProfilingError, TypeError, ValueError) as e:
+                    self.reply_failed(request, str(e))
+            case _:
+                raise NotImplementedError
+
+    def handle_session_request(self, session : DataSession, request : Message):
+        self.logger.debug('[NETWORK] received message from main: type `%s`, id `%d`, sid `%d`.',
+            request.type, request.id, request.session_id)
         match request.type:
             case MessageType.KEY_EXCHANGE_INIT:
-                data_server_ids : list[str] = request.data
+                # older main servers send just the list of data server ids
+                if isinstance(request.data, list):
+                    data_server_ids, group, protocol = request.data, self.key_exchange_group(DEFAULT_GROUP.name), KeyExchangeProtocol.RING
+                else:
+                    data_server_ids : list[str] = request.read_data('data_servers')
+                    group = self.key_exchange_group(request.read_data('group', DEFAULT_GROUP.name))
+                    protocol_name = request.read_data('protocol', KeyExchangeProtocol.RING.name)
+                    if protocol_name not in KeyExchangeProtocol.__members__:
+                        raise KeyExchangeError(f'Unknown key exchange protocol `{protocol_name}`.')
+                    protocol = KeyExchangeProtocol[protocol_name]
+                    session.epoch_duration = float(request.read_data('epoch_duration', EPOCH_DURATION))
                 data_servers : list[DataServer] = []
                 for data_server in self.known_data_servers:
                     if data_server.id in data_server_ids:
                         data_servers.append(data_server)
-                self.active_data_servers = data_servers
                 N = len(data_servers)
                 this_index = data_servers.index(self.this_data_server)
-                self.prev_data_server = data_servers[(this_index + N - 1) % N]
-                self.next_data_server = data_servers[(this_index + 1) % N]
-                self.key_exchange_N = N
-                self.key_exchange_component = DiffieHellmanState(N)
-                self.logger.put('[KEY EXCHANGE] Initialized key exchange component.')
+                session.prev_data_server = data_servers[(this_index + N - 1) % N]
+                session.next_data_server = data_servers[(this_index + 1) % N]
+                session.key_exchange_N = N
+                session.key_exchange_servers = data_servers
+                session.key_exchange_index = this_index
+                session.key_exchange_protocol = protocol
+                if protocol is KeyExchangeProtocol.BURMESTER_DESMEDT:
+                    session.key_exchange_component = BurmesterDesmedtState(N, this_index, group, self.ephemerals)
+                else:
+                    session.key_exchange_component = DiffieHellmanState(N, group, self.ephemerals)
+                session.state = KeyExchangeState.INITIALIZED
+                self.logger.debug('[KEY EXCHANGE] Initialized %s key exchange component over %s.', protocol.name, group.name)
                 self.reply_ok(request)
             case MessageType.KEY_EXCHANGE_START:
-                with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as sock:
-                    sock.setblocking(False)
-
-                    try:
-                        sock.connect(self.next_data_server.address)
-                    except OSError as e:
-                        if e.errno != errno.EINPROGRESS:
-                            raise
-                    
-                    timed_stop = ImpliedEvent(self.stop_event,TIMEOUT)
-                    while not timed_stop.is_set():
-                        try:
-                            sock.recv(1)
-                            break
-                        except BlockingIOError as e:
-                            time.sleep(REFRESH_DELAY)
-                            pass
-                    if timed_stop.is_set():
-                        raise Exception(f'Could not connect to data server at {self.next_data_server.address}.')
-                    
-                    self.logger.put(f'[NETWORK] Connected to data server at {self.next_data_server.address}.')
-                    for step in range(self.key_exchange_N-1):
-                        sock.send(Message(MessageType.KEY_EXCHANGE_STEP,data=self.key_exchange_component.public_key(),session_id=request.session_id).to_bytes())
-                        while not self.stop_event.is_set():
-                            try:
-                                self.key_exchange_component.transform_intermediate_key(self.key_queue.get())
-                                break
-                            except Empty:
-                                time.sleep(REFRESH_DELAY)
-                                pass
-                self.shared_key = self.key_exchange_component.result()
-                self.shared_key_proof = SHA384.new(self.shared_key).hexdigest()
-                self.reply_ok(request, self.shared_key_proof)
-                self.logger.put('[KEY EXCHANGE] Key exchange done. closing connections.')
+                if session.state is not KeyExchangeState.INITIALIZED:
+                    raise ProtocolViolation(f'Key exchange of session {session.id} was not initialized.')
+                if session.key_exchange_protocol is KeyExchangeProtocol.BURMESTER_DESMEDT:
+                    self.run_burmester_desmedt(session)
+                else:
+                    self.run_ring(session)
+                session.shared_key = session.key_exchange_component.result()
+                session.shared_key_proof = SHA384.new(session.shared_key).hexdigest()
+                session.state = KeyExchangeState.DONE
+                # queries use the key until the main server's epoch ends, however long they leave it idle
+                self.sessions.set_ttl(session.id, session.epoch_duration + EPOCH_TTL_MARGIN)
+                self.reply_ok(request, session.shared_key_proof)
+                self.logger.debug('[KEY EXCHANGE] Key exchange done.')
             case MessageType.DATA_REQUEST:
-                ids = request.data
-                result = self.database._read(ids, self.shared_key)
-                self.reply_ok(request, result)
+                if isinstance(request.data, list):
+                    if session.state is not KeyExchangeState.DONE:
+                        raise ProtocolViolation(f'No shared key in session {session.id}.')
+                    ids, salt = request.data, session.shared_key
+                else:
+                    ids = request.read_data('ids')
+                    salt = derive_query_key(self.epoch_key(request.read_data('epoch'), session.id), session.id)
+                self.reply_stream(request, self.database.read_stream(ids, salt, raw_digests=request.codec is PayloadCodec.BINARY))
             case _:
                 raise NotImplementedError
 
+    def key_exchange_group(self, name : str) -> Group:
+        group = get_group(name)
+        return group if self.crypto is None else self.crypto.wrap(group)
+
+    def send_key_exchange_step(self, session : DataSession, data_server : DataServer, data):
+        try:
+            self.peers.send(data_server.address, Message(MessageType.KEY_EXCHANGE_STEP, data=data, session_id=session.id))
+        except (OSError, DataUnavailableError):
+            raise KeyExchangeError(f'Could not reach data server at {data_server.address}.')
+
+    def run_ring(self, session : DataSession):
+        for step in range(session.key_exchange_N-1):
+            self.send_key_exchange_step(session, session.next_data_server, session.key_exchange_component.public_key())
+            session.key_exchange_component.transform_intermediate_key(self.receive_key(session))
+
+    def run_burmester_desmedt(self, session : DataSession):
+        component : BurmesterDesmedtState = session.key_exchange_component
+        self.broadcast(session, 1, component.public_key())
+        self.broadcast(session, 2, component.second_round(self.receive_broadcasts(session, 1)))
+        component.finish(self.receive_broadcasts(session, 2))
+
+    def broadcast(self, session : DataSession, round : int, value):
+        session.broadcasts[round][session.key_exchange_index] = value
+        for data_server in session.key_exchange_servers:
+            if data_server != self.this_data_server:
+                self.send_key_exchange_step(session, data_server, {'round': round, 'from': session.key_exchange_index, 'value': value})
+
+    def receive_broadcasts(self, session : DataSession, round : int) -> list:
+        '''Waits for the values of all parties in broadcast `round`. Values of the next round may arrive first.'''
+        while len(session.broadcasts[round]) < session.key_exchange_N:
+            step = self.receive_key(session)
+            if not isinstance(step, dict) or step.get('round') not in session.broadcasts or \
+                    type(sender := step.get('from')) is not int or not 0 <= sender < session.key_exchange_N:
+                raise KeyExchangeError(f'Malformed broadcast in session {session.id}.')
+            if sender in session.broadcasts[step['round']]:
+                raise KeyExchangeError(f'Repeated broadcast from party {sender} in session {session.id}.')
+            session.broadcasts[step['round']][sender] = step.get('value')
+        return [session.broadcasts[round][index] for index in range(session.key_exchange_N)]
+
+    def epoch_key(self, epoch_id : int, session_id : int) -> bytes:
+        '''
+        The shared key of the key epoch session `epoch_id`, for deriving the key of query session `session_id`. \n
+        Each session id gets a key once per epoch: a reused id would get the same derived key, so it is rejected.
+        '''
+        epoch = self.sessions.find(epoch_id)
+        if epoch is None:
+            raise UnknownEpochError(f'Unknown key epoch {epoch_id}.')
+        with epoch.session_wrapper as context:
+            if context.state is not KeyExchangeState.DONE:
+                raise UnknownEpochError(f'No shared key in key epoch {epoch_id}.')
+            if session_id in context.query_sessions or session_id == epoch_id:
+                raise ProtocolViolation(f'Session {session_id} already used key epoch {epoch_id}.')
+            context.query_sessions.add(session_id)
+            return context.shared_key
+
+    def handle_session(self, session : CommunicationSession[SessionWrapper[DataSession]], kill_event : Event):
+        while not kill_event.is_set() and not self.stop_event.is_set():
+            try:
+                _, request = session.incoming_requests.get(timeout=STOP_CHECK_INTERVAL)
+            except Empty:
+                continue
+            with session.activity(), session.session_wrapper as context, SESSION_REQUEST_SECONDS.labels(request.type.name).time(), \
+                    TRACER.span(request.type.name, self.session_trace(context, request), session=session.session_id), \
+                    PROFILER.scope(request.type.name):
+                try:
+                    self.handle_session_request(context, request)
+                except UnknownEpochError as e:
+                    # lets the main server tell a stale epoch, which a new key exchange fixes, from other failures
+                    self.logger.warning('[ERROR] Session %d: %s', session.session_id, e)
+                    SESSION_REQUEST_FAILURES.labels(request.type.name).inc()
+                    self.reply_failed(request, {'unknown_epoch': request.read_data('epoch', None), 'error': str(e)})
+                except (ProtocolViolation, KeyExchangeError, DataUnavailableError) as e:
+                    self.logger.warning('[ERROR] Session %d: %s', session.session_id, e)
+                    SESSION_REQUEST_FAILURES.labels(request.type.name).inc()
+                    self.reply_failed(request, str(e))
+                except Exception as e:
+                    # a broken session must not take the other sessions down with it
+                    self.logger.exception('[ERROR] Session %d: %s', session.session_id, e)
+                    SESSION_REQUEST_FAILURES.labels(request.type.name).inc()
+                    self.reply_failed(request, str(e))
+
+    def session_trace(self, session : DataSession, request : Message) -> Optional[str]:
+        '''Keeps the trace id sent with `KEY_EXCHANGE_INIT` and `DATA_REQUEST`, so later requests of the session and ring steps are traced too.'''
+        if isinstance(request.data, dict) and (trace_id := request.data.get('trace')) is not None:
+            session.trace_id = trace_id
+        return session.trace_id
+
+    def receive_key(self, session : DataSession):
+        deadline = time.monotonic() + TIMEOUT
+        with TRACER.span('receive_key', session=session.id):
+            while not session.kill_event.is_set() and not self.stop_event.is_set() and (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    return session.key_queue.get(timeout=min(remaining, STOP_CHECK_INTERVAL))
+                except Empty:
+                    pass
+        raise KeyExchangeError(f'Key exchange of session {session.id} timed out.')
+
+    def receive_unexpected_message(self, connection : Channel, message : Message):
+        self.logger.warning('[ERROR-NETWORK] Unexpected message from %s: type `%s`, id `%d`.', connection.address, message.type, message.id)
+
     def handle_main_connection(self):
-        self.logger.put(f'[SERVER] Start of connection with main server at {self.main_address}.')
-        reader = ByteBuffer()
-        self.main_connection.setblocking(False)
-        self.main_connection.send(b'$')
+        self.logger.info('[SERVER] Start of connection with main server at %s.', self.main_address)
+        last_sweep = time.monotonic()
         while not self.stop_event.is_set():
-            time.sleep(REFRESH_DELAY)
             try:
-                reader.append(self.main_connection.recv(2048))
-            except BlockingIOError:
+                message = self.main_requests.get(timeout=STOP_CHECK_INTERVAL)
+                self.handle_request(message)
+            except Empty:
                 pass
-            except DataUnavailableError:
-                break
-            else:
-                reader.save()
-                try:
-                    message = Message.from_bytes(buff=reader)
-                    self.handle_request(message)
-                except DataUnavailableError:
-                    reader.restore()
-            
-        self.logger.put(f'[SERVER] End of connection with main at {self.main_address}.')
+            except DataUnavailableError as e:
+                # the main server left before the reply, `close_main_connection` stops the server
+                self.logger.info('[SERVER] %s', e)
+            if time.monotonic() - last_sweep > SESSION_SWEEP_INTERVAL:
+                last_sweep = time.monotonic()
+                if evicted := self.sessions.evict_idle():
+                    self.logger.info('[SERVER] Evicted idle sessions %s.', evicted)
+        self.sessions.kill_all()
+        self.peers.close_all()
+        self.logger.info('[SERVER] End of connection with main at %s.', self.main_address)
         self.stop_event.set()
-    
-    def handle_backward_connection(self, conn : socket.socket, addr):
-        self.logger.put(f'[SERVER] Start of connection with data server at {addr}.')
-        reader = ByteBuffer()
-        conn.setblocking(False)
-        conn.send(b'$')
-        while not self.stop_event.is_set():
+
+    def receive_main_message(self, connection : Channel, message : Message):
+        if message.session_id == 0 or message.type is MessageType.END_SESSION:
+            self.main_requests.put(message)
+            return
+        if message.type in SESSION_OPENING_REQUESTS:
+            if self.draining.is_set() and self.sessions.find(message.session_id) is None:
+                self.logger.info('[SERVER] Draining, refused `%s` for new session %d.', message.type, message.session_id)
+                self.reply_failed(message, 'Data server is draining.')
+                return
+            session = self.sessions.get(message.session_id)
+        elif (session := self.sessions.find(message.session_id)) is None:
+            self.logger.warning('[ERROR-NETWORK] `%s` for unknown session %d.', message.type, message.session_id)
+            self.reply_failed(message, f'Unknown session {message.session_id}.')
+            return
+        session.incoming_requests.put((self.main_address, message))
+
+    def receive_backward_message(self, connection : Channel, message : Message):
+        self.logger.debug('[NETWORK] received message from data server: type `%s`, id `%d`, sid `%d`.',
+            message.type, message.id, message.session_id)
+        # a late step of a session that already ended must not start it again
+        if (session := self.sessions.find(message.session_id)) is None:
+            self.logger.warning('[ERROR-NETWORK] Key exchange step from %s for unknown session %d, dropped.', connection.address, message.session_id)
+            return
+        session.session_wrapper.unlocked().key_queue.put(message.data)
+
+    def accept_connection(self, conn : socket.socket, addr):
+        conn.send(HANDSHAKE)
+        if self.main_connection is None:
+            self.main_address = addr
+            self.main_connection = self.reactor.add_channel(conn, addr, self.receive_main_message, self.close_main_connection)
+            Thread(target=safe_thread_target(self.logger,self.stop_event,self.handle_main_connection)).start()
+            return
+        self.logger.info('[SERVER] Start of connection with data server at %s.', addr)
+        self.reactor.add_channel(conn, addr, self.receive_backward_message, self.close_backward_connection)
+
+    def close_main_connection(self, connection : Channel):
+        self.stop_event.set()
+
+    def close_backward_connection(self, connection : Channel):
+        self.logger.info('[SERVER] End of connection with %s.', connection.address)
+
+    def drain(self, timeout : float) -> bool:
+        '''
+        Refuses new sessions, then waits up to `timeout` seconds for every session to finish its requests and any key
+        exchange it started. Returns whether they did.
+        '''
+        self.draining.set()
+        # between KEY_EXCHANGE_INIT and the end of KEY_EXCHANGE_START the ring peers still count on this server
+        key_exchange_running = lambda session: session.session_wrapper.unlocked().state is KeyExchangeState.INITIALIZED
+        deadline = time.monotonic() + timeout
+        while (busy := self.sessions.busy(key_exchange_running)) and time.monotonic() < deadline:
             time.sleep(REFRESH_DELAY)
-            try:
-                reader.append(conn.recv(2048))
-            except BlockingIOError:
-                pass
-            except DataUnavailableError:
-                break
-            else:
-                reader.save()
-                try:
-                    message : Message = Message.from_bytes(buff=reader)
-                    self.logger.put(f'[NETWORK] received message from main: type `{\
-                        message.type}`, id `{message.id}`, sid `{message.session_id}`.')
-                    self.key_queue.put(message.data)
-                except DataUnavailableError:
-                    reader.restore()
-        self.logger.put(f'[SERVER] End of connection with {addr}.')
+        if busy:
+            self.logger.warning('[SERVER] %d sessions still busy after draining for %ss.', busy, timeout)
+        return not busy
 
     def run(self, stop_event: Event):
         self.stop_event = stop_event
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-                server.bind(self.address)
-                server.listen(1)
-                server.setblocking(False)
-
-                self.logger.put(f'[SERVER] Started Server. Listening on {\
-                    self.address}.')
-
-                while not stop_event.is_set():
-                    try:
-                        self.main_connection, self.main_address = server.accept()
-                        break
-                    except BlockingIOError:
-                        time.sleep(REFRESH_DELAY)
-                        pass
-                
-                if stop_event.is_set():
-                    return
-                
-                Thread(target=safe_thread_target(self.logger,self.stop_event,self.handle_main_connection)).start()
-                
-                while not stop_event.is_set():
-                    try:
-                        conn, addr = server.accept()
-                        self.handle_backward_connection(conn, addr)
-                    except IOError as e:
-                        time.sleep(REFRESH_DELAY)
+            self.reactor = Reactor(self.logger)
+            Thread(target=safe_thread_target(self.logger,self.stop_event,self.ephemerals.run),args=(stop_event,)).start()
+            self.peers = PeerLinks(self.reactor, self.logger, TIMEOUT, self.receive_unexpected_message)
+            self.reactor.listen(self.address, self.accept_connection)
+            self.logger.info('[SERVER] Started Server. Listening on %s.', self.address)
+            self.reactor.run(stop_event)
         except Exception as e:
-            self.logger.put(f'[ERROR-NETWORK] {e}')
+            self.logger.error('[ERROR-NETWORK] %s', e)
             self.stop_event.set()
         finally:
-            self.logger.put(f'[SERVER] Closed Server.')
+            if self.crypto is not None:
+                self.crypto.shutdown()
+            self.logger.info('[SERVER] Closed Server.')
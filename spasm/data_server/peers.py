@@ -0,0 +1,54 @@
+from typing import Callable
+
+from threading import Lock
+
+from spasm.common.error import DataUnavailableError
+from spasm.common.protocol import Message
+from spasm.common.reactor import Reactor, Channel, open_connection
+from spasm.common.log import Logger
+
+
+class PeerLinks:
+    '''
+    Long-lived connections to other data servers, opened on first use and shared by all sessions. \n
+    A link that drops is reopened by the next `send` to that server. Messages of different sessions
+    are told apart by their session id.
+    '''
+
+    def __init__(self, reactor: Reactor, logger: Logger, timeout: float, on_message: Callable[[Channel, Message], None]):
+        self.reactor = reactor
+        self.logger = logger
+        self.timeout = timeout
+        self._on_message = on_message
+        self._links: dict[tuple[str, int], Channel] = {}
+        self._lock = Lock()
+
+    def link(self, address: tuple[str, int]) -> Channel:
+        '''Returns the open link to `address`, connecting if there is none. Raises `OSError` if it can't connect.'''
+        with self._lock:
+            channel = self._links.get(address)
+            if channel is None or channel.closed.is_set():
+                channel = self.reactor.add_channel(open_connection(address, self.timeout), address, self._on_message, self._drop)
+                self._links[address] = channel
+                self.logger.info('[NETWORK] Opened link to data server at %s.', address)
+            return channel
+
+    def send(self, address: tuple[str, int], message: Message):
+        '''Sends over the link to `address`, reconnecting once if the link turns out to be down.'''
+        try:
+            self.link(address).send(message)
+        except DataUnavailableError:
+            self.link(address).send(message)
+
+    def _drop(self, channel: Channel):
+        with self._lock:
+            if self._links.get(channel.address) is channel:
+                del self._links[channel.address]
+        self.logger.info('[NETWORK] Link to data server at %s closed.', channel.address)
+
+    def close_all(self):
+        with self._lock:
+            links = list(self._links.values())
+            self._links.clear()
+        for channel in links:
+            channel.close()
@@ -0,0 +1,56 @@
+from typing import Optional, Any
+
+from threading import Event
+from queue import Queue
+
+from spasm.common.sessions import SessionState, SessionContext
+from spasm.common.diffie_hellman import DiffieHellmanState, BurmesterDesmedtState, KeyExchangeProtocol
+from spasm.common.network_components import DataServer
+from spasm.common.log import Logger
+from spasm.common.defaults import EPOCH_DURATION
+
+
+class KeyExchangeState(SessionState):
+    NEW, \
+        INITIALIZED, \
+        DONE \
+        = range(3)
+
+
+class DataSession(SessionContext[KeyExchangeState]):
+    '''State of one query session on a data server.'''
+    key_queue: Queue[Any]
+    key_exchange_protocol: KeyExchangeProtocol
+    key_exchange_component: Optional[DiffieHellmanState | BurmesterDesmedtState]
+    key_exchange_N: int
+    key_exchange_servers: list[DataServer]
+    key_exchange_index: int
+    # broadcast round -> index of the sender -> value, for Burmester-Desmedt
+    broadcasts: dict[int, dict[int, Any]]
+    prev_data_server: Optional[DataServer]
+    next_data_server: Optional[DataServer]
+    shared_key: Optional[bytes]
+    shared_key_proof: Optional[str]
+    # seconds the main server uses the key for, if this session is a key epoch
+    epoch_duration: float
+    # query sessions that derived a key from this one, if it is a key epoch
+    query_sessions: set[int]
+    # set by the main server's requests, see `spasm.common.tracing`
+    trace_id: Optional[str]
+
+    def __init__(self, id: int, kill_event: Event, logger: Logger):
+        super().__init__(id, kill_event, logger, KeyExchangeState.NEW)
+        self.key_queue = Queue()
+        self.key_exchange_protocol = KeyExchangeProtocol.RING
+        self.key_exchange_component = None
+        self.key_exchange_N = 0
+        self.key_exchange_servers = []
+        self.key_exchange_index = 0
+        self.broadcasts = {1: {}, 2: {}}
+        self.prev_data_server = None
+        self.next_data_server = None
+        self.shared_key = None
+        self.shared_key_proof = None
+        self.epoch_duration = EPOCH_DURATION
+        self.query_sessions = set()
+        self.trace_id = None
@@ -1,41 +1,58 @@
 from typing import Any
 
 from threading import Thread, Event
-from queue import Queue, Empty
+from queue import Queue
 
 from Crypto.Random.random import sample
 
 from spasm.common.protocol import Message
+from spasm.common.codec import PayloadCodec
+from spasm.common.diffie_hellman import DEFAULT_GROUP, KeyExchangeProtocol
 from spasm.common.security import AsymmetricKey
 from spasm.common.network_components import DataServer
 from spasm.common.atomic import safe_thread_target, ImpliedEvent
-from spasm.common.graphics import LoggerGraphicInterface, time_now
+from spasm.common.log import Logger, ConsoleSink
+from spasm.common.metrics import MetricsServer, export_queue_depths
 
-from spasm.main_server.backend import MainServer
+from spasm.main_server.backend import MainServer, MAX_CONCURRENT_QUERIES, EPOCH_DURATION, EPOCH_MAX_QUERIES
 from spasm.main_server.loopback import LoopbackServer
 
 class App:
-    def __init__(self, main_address : tuple[str,int], loopback_address : tuple[str, int], data_servers : list[DataServer], base_data, key : AsymmetricKey):
-        self.logger : Queue[str] = Queue()
+    def __init__(self, main_address : tuple[str,int], loopback_address : tuple[str, int], data_servers : list[DataServer], base_data, key : AsymmetricKey, payload_codec : PayloadCodec = PayloadCodec.BINARY, max_concurrent_queries : int = MAX_CONCURRENT_QUERIES, key_exchange_group : str = DEFAULT_GROUP.name, key_exchange_protocol : KeyExchangeProtocol = KeyExchangeProtocol.RING, epoch_duration : float = EPOCH_DURATION, epoch_max_queries : int = EPOCH_MAX_QUERIES, metrics_address : tuple[str, int] | None = None):
+        # tkinter is only loaded by apps that actually open a window
+        from spasm.common.graphics import LoggerGraphicInterface
+
+        self.logger = Logger()
+        self.logger.add_sink(ConsoleSink())
+        self.log_stop_event = Event()
         self.stop_event = Event()
         self.sub_stop_event = ImpliedEvent(self.stop_event)
         
-        self.user_query_queue : Queue[tuple[Message,Any]] = Queue()
-        self.query_result_queue : Queue[tuple[Message,Any]] = Queue()
+        self.user_query_queue : Queue[tuple[Message,Any,str]] = Queue()
+        self.query_result_queue : Queue[tuple[Message,bool,Any]] = Queue()
         
-        self.main_server = MainServer(self.logger, main_address, data_servers, base_data, self.user_query_queue, self.query_result_queue)
-        self.loopback_server = LoopbackServer(self.logger, loopback_address, data_servers, self.user_query_queue, self.query_result_queue)
+        self.main_server = MainServer(self.logger, main_address, data_servers, base_data, self.user_query_queue, self.query_result_queue, payload_codec, max_concurrent_queries, key_exchange_group, key_exchange_protocol, epoch_duration, epoch_max_queries)
+        export_queue_depths(self.main_server.queue_depths())
+        self.loopback_server = LoopbackServer(self.logger, loopback_address, data_servers, self.user_query_queue, self.query_result_queue, self.main_server.query_stats.snapshot, self.main_server.profile)
         
         self.main_server_thread = Thread(target=safe_thread_target(self.logger,self.sub_stop_event,self.main_server.run),args=(self.sub_stop_event,))
         self.loopback_server_thread = Thread(target=safe_thread_target(self.logger,self.sub_stop_event,self.loopback_server.run),args=(self.sub_stop_event,))
         
         self.main_server_thread.start()
         self.loopback_server_thread.start()
+
+        self.metrics_thread = None
+        if metrics_address is not None:
+            self.metrics_thread = Thread(target=safe_thread_target(self.logger,self.sub_stop_event,MetricsServer(metrics_address, self.logger).run),args=(self.sub_stop_event,))
+            self.metrics_thread.start()
         
         self.gui = LoggerGraphicInterface(self.logger, 'Main Server', 'Main Server', key)
         self.gui.window.configure(bg='#333')
         self.gui.name.configure(background='#333',foreground='white')
         self.gui.public_key.configure(background='#333',foreground='white')
+        # started once the GUI has added its sink
+        self.log_thread = Thread(target=self.logger.run, args=(self.log_stop_event,))
+        self.log_thread.start()
         
         try:
             self.gui.run(self.stop_event)
@@ -45,11 +62,10 @@ class App:
             self.stop_event.set()
         self.main_server_thread.join()
         self.loopback_server_thread.join()
+        if self.metrics_thread is not None:
+            self.metrics_thread.join()
         print('Terminating...')
-        try:
-            while msg := self.logger.get_nowait():
-                print(f'[{time_now()}]',msg)
-        except Empty:
-            pass
+        self.log_stop_event.set()
+        self.log_thread.join()
         print('Done.')
         
\ No newline at end of file
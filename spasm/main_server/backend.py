@@ -1,42 +1,113 @@
-from typing import Optional, Any
-
-import errno
+from typing import Optional, Callable, Iterator, Any
 
 from enum import Enum
 from dataclasses import dataclass
+from collections import deque
 
 from queue import Queue, Empty
 from threading import Thread, Event, Lock
 import time
-import socket
 
 from Crypto.Random.random import sample
 
 
 from spasm.common.network_components import DataServer
-from spasm.common.atomic import AtomicCounter, AtomicDict, ImpliedEvent, safe_thread_target
-from spasm.common.protocol import Message, MessageType, ByteBuffer, DataUnavailableError
+from spasm.common.atomic import AtomicCounter, AtomicDict, safe_thread_target
+from spasm.common.protocol import Message, MessageType, DataUnavailableError
+from spasm.common.error import ProtocolViolation, UnknownEpochError
+from spasm.common.codec import PayloadCodec
+from spasm.common.reactor import Reactor, open_connection
+from spasm.common.multiplexer import Multiplexer, PendingRequest
 from spasm.common.queries import Condition, ConditionsType, BoundType, filter_ids, conditional_from_struct
-from spasm.common.diffie_hellman import KeyExchangeError
-from spasm.common.defaults import REFRESH_DELAY
+from spasm.common.diffie_hellman import KeyExchangeError, KeyExchangeProtocol, DEFAULT_GROUP, get_group
+from spasm.common.defaults import STOP_CHECK_INTERVAL, EPOCH_DURATION
+from spasm.common.log import Logger
+from spasm.common.metrics import REGISTRY
+from spasm.common.tracing import TRACER
+from spasm.common.profiling import PROFILER, ProfilingError
 
 class BadDataServerError(Exception):
     pass
 
 
 TIMEOUT = 4
+REQUEST_TIMEOUT = 60
 
 ID_SAMPLE_SIZE = 3
 STUDY_GROUP_MINIMAL_SIZE = 4
 
+MAX_CONCURRENT_QUERIES = 4
+
+# a key exchange runs once per epoch (at most `EPOCH_DURATION` seconds), queries in it use keys derived from the epoch key
+EPOCH_MAX_QUERIES = 256
+LATENCY_WINDOW = 1024
+
+REQUEST_SECONDS = REGISTRY.histogram('spasm_request_seconds', 'Round trip of a request to the data servers, by message type.', ('type',))
+KEY_EXCHANGE_SECONDS = REGISTRY.histogram('spasm_key_exchange_seconds', 'Time for all data servers to agree on a key.')
+QUERY_IDS_SECONDS = REGISTRY.histogram('spasm_query_ids_seconds', 'Time to fetch and merge the records of a query from all data servers.')
+
+class QueryStats:
+    '''Thread-safe counters of the query executors, for sizing `max_concurrent_queries`.'''
+
+    def __init__(self, query_queue: Queue):
+        self._lock = Lock()
+        self._query_queue = query_queue
+        self._in_flight = 0
+        self._completed = 0
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self) -> float:
+        with self._lock:
+            self._in_flight += 1
+        return time.monotonic()
+
+    def finish(self, start_time: float) -> float:
+        latency = time.monotonic() - start_time
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._latencies.append(latency)
+        return latency
+
+    def snapshot(self) -> dict[str, int | float | None]:
+        '''Queue depth, in-flight and completed counts, and latency percentiles (seconds) over the last `LATENCY_WINDOW` queries.'''
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {'queue_depth': self._query_queue.qsize(), 'in_flight': self._in_flight, 'completed': self._completed}
+        for name, fraction in [('p50', .5), ('p90', .9), ('p99', .99)]:
+            result[f'latency_{name}'] = latencies[min(int(fraction*len(latencies)), len(latencies)-1)] if latencies else None
+        result['latency_max'] = latencies[-1] if latencies else None
+        return result
+
+
+@dataclass
+class KeyEpoch:
+    session_id: int
+    started: float
+    queries: int = 0
+    users: int = 0
+    retired: bool = False
+
+    def expired(self, duration: float, max_queries: int) -> bool:
+        return self.queries >= max_queries or time.monotonic() - self.started >= duration
+
+
 class MainServer:
-    def __init__(self, logger: Queue, address: tuple[str, int], data_servers: list[DataServer], base_data: dict, user_query_queue: Queue, query_result_queue: Queue):
+    def __init__(self, logger: Logger, address: tuple[str, int], data_servers: list[DataServer], base_data: dict, user_query_queue: Queue, query_result_queue: Queue, payload_codec: PayloadCodec = PayloadCodec.BINARY, max_concurrent_queries: int = MAX_CONCURRENT_QUERIES, key_exchange_group: str = DEFAULT_GROUP.name, key_exchange_protocol: KeyExchangeProtocol = KeyExchangeProtocol.RING, epoch_duration: float = EPOCH_DURATION, epoch_max_queries: int = EPOCH_MAX_QUERIES):
         self.logger = logger
+        self.payload_codec = payload_codec
+        self.max_concurrent_queries = max_concurrent_queries
+        self.key_exchange_group = get_group(key_exchange_group)
+        self.key_exchange_protocol = key_exchange_protocol
+        self.epoch_duration = epoch_duration
+        self.epoch_max_queries = epoch_max_queries
+        self.epoch : Optional[KeyEpoch] = None
+        self.epoch_lock = Lock()
         self.address = address
         self.data_servers = data_servers
         self.data_server_ids = [data_server.id for data_server in data_servers]
 
-        self.connections: dict[DataServer, socket.socket] = {}
+        self.connections: dict[DataServer, Multiplexer] = {}
         # self.requests : AtomicDict[DataServer,Queue[Message,Queue]] = AtomicDict([(data_server,Queue()) for data_server in data_servers])
         # self.responses : AtomicDict[DataServer,Queue[Message]] = AtomicDict([(data_server,Queue()) for data_server in data_servers])
 
@@ -45,75 +116,88 @@ class MainServer:
         self.query_result_queue = query_result_queue
 
         self.session_counter = AtomicCounter()
+        self.query_stats = QueryStats(user_query_queue)
+        self.draining = Event()
+
+    def queue_depths(self) -> dict[str, Callable[[], int]]:
+        '''Sizes of the queues it serves, for `export_queue_depths`.'''
+        return {'user_queries': self.user_query_queue.qsize, 'query_results': self.query_result_queue.qsize}
 
     def connect_all(self):
         for data_server in self.data_servers:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.connections[data_server] = sock
-            sock.setblocking(False)
-            
             try:
-                sock.connect(data_server.address)
-            except OSError as e:
-                if e.errno != errno.EINPROGRESS:
-                    raise
-            
-            timed_stop = ImpliedEvent(self.stop_event,TIMEOUT)
-            while not timed_stop.is_set():
-                try:
-                    sock.recv(1)
-                    break
-                except BlockingIOError as e:
-                    time.sleep(REFRESH_DELAY)
-                    pass
-            if timed_stop.is_set():
-                self.logger.put(f'[ERROR] Could not connect to data server at {data_server.address}.')
+                sock = open_connection(data_server.address, TIMEOUT)
+            except OSError:
+                self.logger.error('[ERROR] Could not connect to data server at %s.', data_server.address)
                 raise Exception(f'Could not connect to data server at {data_server.address}.')
-            
-            self.logger.put(f'[NETWORK] Connected to data server at {data_server.address}.')
+            self.connections[data_server] = Multiplexer(self.reactor, sock, data_server.address, self.logger)
+            self.logger.info('[NETWORK] Connected to data server at %s.', data_server.address)
+            self.negotiate_codec(data_server)
+
+    def negotiate_codec(self, data_server : DataServer):
+        '''Asks `data_server` for the preferred payload codec, falling back to JSON.'''
+        offered = [self.payload_codec.name, PayloadCodec.JSON.name]
+        response = self.make_request(data_server, Message(MessageType.INFO, {'codecs': offered}))
+        codec = PayloadCodec[response.read_data('codec')]
+        self.connections[data_server].channel.codec = codec
+        self.logger.info('[NETWORK] Using %s payloads with data server at %s.', codec.name, data_server.address)
 
     def disconnect_all(self):
         for data_server in self.data_servers:
             conn = self.connections.get(data_server)
             if conn is not None:
-                try:
-                    conn.__exit__()
-                    self.logger.put(f'[NETWORK] Disconnected from data server at {data_server.address}.')
-                except Exception:
-                    pass
-
-    def make_request(self, recipient : DataServer, message : Message, responses : Optional[Queue] = None):
-        self.logger.put(f'[NETWORK] Sending request to {recipient.address}: type `{message.type}`, id `{message.id}`, sid `{message.session_id}`.')
-        conn = self.connections[recipient]
-        conn.send(message.to_bytes())
-        response = Message.from_bytes(buff=conn, stop_event=self.stop_event)
-        self.logger.put(f'[NETWORK] Received response from {recipient.address}: type `{response.type}`, id `{response.id}`, sid `{response.session_id}`, data `{response.data}`.')
-        
-        if responses is None:
-            return response
-        responses.put((recipient,response))
-        
+                conn.close()
+                self.logger.info('[NETWORK] Disconnected from data server at %s.', data_server.address)
+
+    def send_request(self, recipient : DataServer, message : Message) -> PendingRequest:
+        '''Thread-safe. Any number of requests may be in flight on the same connection.'''
+        self.logger.debug('[NETWORK] Sending request to %s: type `%s`, id `%d`, sid `%d`.', recipient.address, message.type, message.id, message.session_id)
+        return self.connections[recipient].request(message, REQUEST_TIMEOUT)
+
+    def receive_response(self, recipient : DataServer, pending : PendingRequest) -> Message:
+        response = pending.get()
+        self.logger.debug('[NETWORK] Received response from %s: type `%s`, id `%d`, sid `%d`, data `%s`.', recipient.address, response.type, response.id, response.session_id, response.data)
+        return response
+
+    def receive_stream(self, recipient : DataServer, pending : PendingRequest) -> Iterator[Any]:
+        '''Yields the data of each `RESPONSE_PART` of a streamed reply from `recipient` as it arrives.'''
+        while True:
+            response = self.receive_response(recipient, pending)
+            match response.type:
+                case MessageType.RESPONSE_PART:
+                    yield response.data
+                case MessageType.RESPONSE_OK:
+                    return
+                case MessageType.RESPONSE_FAILED if isinstance(response.data, dict) and 'unknown_epoch' in response.data:
+                    raise UnknownEpochError(f'Data server at {recipient.address} lost key epoch {response.data['unknown_epoch']}.')
+                case _:
+                    raise BadDataServerError(f'Data server at {recipient.address} failed request `{response.id}`: {response.data}')
+
+    def make_request(self, recipient : DataServer, message : Message) -> Message:
+        with REQUEST_SECONDS.labels(message.type.name).time():
+            return self.receive_response(recipient, self.send_request(recipient, message))
 
     def request_all_data_servers(self, message: Message) -> list[tuple[DataServer, Message]]:
-        responses = Queue()
-        for data_server in self.data_servers:
-            Thread(target=safe_thread_target(self.logger,self.stop_event,self.make_request),args=(data_server, message, responses)).start()
-        
-        result = []
-        while not self.stop_event.is_set() and len(result) < len(self.data_servers):
-            try:
-                result.append(responses.get_nowait())
-            except Empty:
-                time.sleep(REFRESH_DELAY)
-                pass
-        if len(result) < len(self.data_servers):
-            return None
-        return result
+        start = time.perf_counter()
+        pendings = [(data_server, self.send_request(data_server, message)) for data_server in self.data_servers]
+        try:
+            responses = [(data_server, self.receive_response(data_server, pending)) for data_server, pending in pendings]
+            REQUEST_SECONDS.labels(message.type.name).observe(time.perf_counter() - start)
+            return responses
+        except DataUnavailableError:
+            if self.stop_event.is_set():
+                return None
+            raise
 
     def run_key_exchange(self, session_id: int):
-        self.logger.put(f'[KEY EXCHANGE] Key exchange started.')
+        with KEY_EXCHANGE_SECONDS.time(), TRACER.span('key_exchange', session=session_id), PROFILER.scope('key_exchange'):
+            self._run_key_exchange(session_id)
+
+    def _run_key_exchange(self, session_id: int):
+        self.logger.debug('[KEY EXCHANGE] Key exchange started.')
         self.request_all_data_servers(Message(
-            MessageType.KEY_EXCHANGE_INIT, data=self.data_server_ids, session_id=session_id))
+            MessageType.KEY_EXCHANGE_INIT, data=self.traced({'data_servers': self.data_server_ids, 'group': self.key_exchange_group.name, 'protocol': self.key_exchange_protocol.name,
+                          'epoch_duration': self.epoch_duration}), session_id=session_id))
         responses = self.request_all_data_servers(
             Message(MessageType.KEY_EXCHANGE_START, session_id=session_id))
 
@@ -121,26 +205,101 @@ class MainServer:
         for _, response in responses:
             response: Message
             if hashed_key is not None and hashed_key != response.data:
-                self.logger.put(f'[ERROR] Key exchanged failed: different secret proofs "{hashed_key}" and "{response.data}".')
+                self.logger.error('[ERROR] Key exchanged failed: different secret proofs "%s" and "%s".', hashed_key, response.data)
                 self.stop_event.set()
                 raise KeyExchangeError('Inconsistent proofs.')
             hashed_key = response.data
-        self.logger.put(f'[KEY EXCHANGE] Key exchange done. proof: "{hashed_key}".')
+        self.logger.debug('[KEY EXCHANGE] Key exchange done. proof: "%s".', hashed_key)
+
+    def end_session(self, session_id: int):
+        '''Lets the data servers drop the session state now instead of waiting for it to expire. Doesn't wait for replies.'''
+        for data_server in self.data_servers:
+            self.send_request(data_server, Message(MessageType.END_SESSION, session_id=session_id))
+
+    def acquire_epoch(self) -> KeyEpoch:
+        '''The current key epoch, after starting a new one with a key exchange if it expired.'''
+        with self.epoch_lock:
+            if self.epoch is None or self.epoch.expired(self.epoch_duration, self.epoch_max_queries):
+                session_id = self.session_counter.inc()
+                self.run_key_exchange(session_id)
+                if self.epoch is not None:
+                    self.retire_epoch(self.epoch)
+                self.epoch = KeyEpoch(session_id, time.monotonic())
+                self.logger.info('[KEY EXCHANGE] Started key epoch %d.', session_id)
+            self.epoch.queries += 1
+            self.epoch.users += 1
+            return self.epoch
+
+    def release_epoch(self, epoch: KeyEpoch):
+        with self.epoch_lock:
+            epoch.users -= 1
+            if epoch.retired and not epoch.users:
+                self.end_session(epoch.session_id)
+
+    def retire_epoch(self, epoch: KeyEpoch):
+        '''Ends `epoch` once the queries still running in it are done. Call with `epoch_lock` held.'''
+        if epoch.retired:
+            return
+        epoch.retired = True
+        if not epoch.users:
+            self.end_session(epoch.session_id)
+
+    def invalidate_epoch(self, epoch: KeyEpoch):
+        '''Makes the next query start a new epoch, since a data server no longer has the key of `epoch`.'''
+        with self.epoch_lock:
+            if self.epoch is epoch:
+                self.epoch = None
+            self.retire_epoch(epoch)
+
+    def traced(self, data: dict) -> dict:
+        '''Adds the trace id of the query being handled on this thread to a request payload.'''
+        if (trace_id := TRACER.current()) is not None:
+            data['trace'] = trace_id
+        return data
 
     def query_ids(self, ids):
+        with QUERY_IDS_SECONDS.time(), TRACER.span('query_ids', records=len(ids)):
+            return self._query_ids(ids)
+
+    def _query_ids(self, ids):
+        try:
+            return self.fetch_records(ids)
+        except UnknownEpochError as e:
+            self.logger.warning('[KEY EXCHANGE] %s Retrying in a new epoch.', e)
+            return self.fetch_records(ids)
+
+    def fetch_records(self, ids):
+        '''Fetches and merges the records of `ids` from all data servers, with keys of the current epoch.'''
+        with TRACER.span('acquire_epoch'):
+            epoch = self.acquire_epoch()
         session_id = self.session_counter.inc()
-        self.run_key_exchange(session_id)
-        merged_data = {}
-        data_responses = self.request_all_data_servers(
-            Message(MessageType.DATA_REQUEST, data=ids, session_id=session_id))
-        for data_server, response in data_responses:
-            data: list[tuple[str, Any]] = response.data
-            self.logger.put(f'Data from {data_server.address}: {data}')
-            for hashed_id, information in data:
-                if hashed_id not in merged_data:
-                    merged_data[hashed_id] = {}
-                merged_data[hashed_id][data_server.id] = information
-        return list(merged_data.values())
+        pendings: list[tuple[DataServer, PendingRequest]] = []
+        try:
+            merged_data = {}
+            request = Message(MessageType.DATA_REQUEST, data=self.traced({'ids': ids, 'epoch': epoch.session_id}), session_id=session_id)
+            start = time.time()
+            pendings += [(data_server, self.send_request(data_server, request)) for data_server in self.data_servers]
+            for data_server, pending in pendings:
+                for data in self.receive_stream(data_server, pending):
+                    data: list[tuple[str | bytes, Any]]
+                    self.logger.debug('Data from %s: %s', data_server.address, data)
+                    for hashed_id, information in data:
+                        if hashed_id not in merged_data:
+                            merged_data[hashed_id] = {}
+                        merged_data[hashed_id][data_server.id] = information
+                # from sending the request until this server's stream is merged
+                TRACER.record(None, 'fetch', start, time.time(), data_server=data_server.id, session=session_id)
+            return list(merged_data.values())
+        except UnknownEpochError:
+            self.invalidate_epoch(epoch)
+            raise
+        finally:
+            # streams left unread after a failure would keep their connections from reading
+            for _, pending in pendings:
+                pending.close()
+            if not self.stop_event.is_set():
+                self.end_session(session_id)
+            self.release_epoch(epoch)
 
     def analysis_query(self, sample_conditions: Optional[ConditionsType] = None):
         study_group = filter_ids(self.base_data, sample_conditions)
@@ -150,25 +309,70 @@ class MainServer:
         res = self.query_ids(sample_ids)
         return res
 
+    def handle_queries(self):
+        '''Query executor. `run` starts `max_concurrent_queries` of these, each query gets its own session.'''
+        while not self.stop_event.is_set() and not self.draining.is_set():
+            try:
+                message, conditional, trace_id = self.user_query_queue.get(timeout=STOP_CHECK_INTERVAL)
+            except Empty:
+                continue
+            start_time = self.query_stats.start()
+            success = False
+            try:
+                with TRACER.span('query', trace_id, message=message.id), PROFILER.scope('analysis_query'):
+                    result = self.analysis_query(conditional_from_struct(conditional))
+                success = True
+            except (BadDataServerError, KeyExchangeError, ProtocolViolation, DataUnavailableError) as e:
+                self.logger.warning('[ERROR-QUERY] Query `%d` failed: %s', message.id, e)
+                result = str(e)
+            except Exception as e:
+                # one failed query must not stop the executor, or the queries behind it would never be answered
+                self.logger.exception('[ERROR-QUERY] Query `%d` failed: %s', message.id, e)
+                result = str(e)
+            finally:
+                latency = self.query_stats.finish(start_time)
+            if success:
+                self.logger.info('[QUERY] Query `%d` done in %.3fs.', message.id, latency)
+                self.logger.debug('results: %s', result)
+            self.query_result_queue.put((message, success, result))
+
+    def profile(self, request: dict) -> Any:
+        '''Runs a `PROFILE` request here, or on the data servers named by its `data_server` entry: an id, or `all`.'''
+        target = request.pop('data_server', None)
+        if target is None:
+            return PROFILER.control(request)
+        data_servers = self.data_servers if target == 'all' else [data_server for data_server in self.data_servers if data_server.id == target]
+        if not data_servers:
+            raise ProfilingError(f'Unknown data server `{target}`.')
+        replies = {}
+        for data_server in data_servers:
+            response = self.make_request(data_server, Message(MessageType.PROFILE, request))
+            replies[data_server.id] = response.data if response.type is MessageType.RESPONSE_OK else {'error': response.data}
+        return replies
+
+    def drain(self):
+        '''Stops taking queries. `run` returns once the running ones are done.'''
+        self.draining.set()
+
     def run(self, stop_event: Event):
         try:
             self.stop_event = stop_event
+            self.reactor = Reactor(self.logger)
+            Thread(target=safe_thread_target(self.logger,self.stop_event,self.reactor.run),args=(stop_event,)).start()
             self.connect_all()
-            self.logger.put('[NETWORK] Connected to all data_servers.')
+            self.logger.info('[NETWORK] Connected to all data_servers.')
             # result = self.analysis_query({'SysBP':Condition(BoundType.AT_LEAST,116)})
             # print('result:',result)
-            while not stop_event.is_set():
-                try:
-                    message, conditional = self.user_query_queue.get_nowait()
-                    conditional = conditional_from_struct(conditional)
-                    result = self.analysis_query(conditional)
-                    self.logger.put('results: ' + str(result))
-                    self.query_result_queue.put((message, result))
-                except Empty:
-                    time.sleep(REFRESH_DELAY)
-                    pass
+            executors = [Thread(target=safe_thread_target(self.logger,self.stop_event,self.handle_queries)) for _ in range(self.max_concurrent_queries)]
+            for executor in executors:
+                executor.start()
+            self.logger.info('[QUERY] Running up to %d queries at a time.', self.max_concurrent_queries)
+            for executor in executors:
+                executor.join()
+            if self.draining.is_set():
+                self.logger.info('[QUERY] Drained. approximately %d queued queries lost.', self.user_query_queue.qsize())
         except Exception as e:
-            self.logger.put(f'[ERROR-BACKEND] {e}')
+            self.logger.error('[ERROR-BACKEND] %s', e)
             self.stop_event.set()
         finally:
             self.disconnect_all()
@@ -0,0 +1,95 @@
+'''Headless main server: `spasm-main-server CONFIG`.'''
+from typing import Optional
+
+from queue import Queue
+from threading import Thread, Event
+import argparse
+import json
+import sys
+
+from spasm.common.atomic import safe_thread_target
+from spasm.common.log import LogLevel
+from spasm.common.metrics import MetricsServer, export_queue_depths
+from spasm.common.tracing import TRACER
+from spasm.common.profiling import PROFILER, toggle_on_signal
+from spasm.common.codec import PayloadCodec
+from spasm.common.diffie_hellman import KeyExchangeProtocol, DEFAULT_GROUP
+from spasm.common.headless import DRAIN_TIMEOUT, load_config, config_path, data_servers_from_config, \
+    load_crypto_config, make_logger, drain_on_signals, wait_for_drain_request
+
+from spasm.main_server.backend import MainServer, MAX_CONCURRENT_QUERIES, EPOCH_DURATION, EPOCH_MAX_QUERIES
+from spasm.main_server.loopback import LoopbackServer
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='spasm-main-server', description='Runs the main server without a GUI.')
+    parser.add_argument('config', help='cluster config file')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT)
+    parser.add_argument('--log-level', choices=[level.name for level in LogLevel], type=str.upper)
+    parser.add_argument('--log-file', help='rotating log file, in addition to stdout')
+    options = parser.parse_args(args)
+
+    config = load_config(options.config)
+    load_crypto_config(config)
+    data_servers = data_servers_from_config(config)
+    settings = config['main_server']
+    base_data = settings['base_data']
+    if isinstance(base_data, str):
+        with open(config_path(config, base_data)) as file:
+            base_data = json.load(file)
+
+    logger = make_logger(config, options.log_level, options.log_file)
+    if 'trace_file' in settings:
+        TRACER.enable(config_path(config, settings['trace_file']), 'main')
+    PROFILER.configure(config_path(config, settings.get('profile_dir', '.')), 'main')
+    toggle_on_signal(logger)
+    stop_event = Event()
+    log_stop_event = Event()
+    drain_requested = drain_on_signals()
+    user_query_queue = Queue()
+    query_result_queue = Queue()
+
+    main_server = MainServer(logger, tuple(settings['backend_address']), data_servers, base_data, user_query_queue, query_result_queue,
+                             PayloadCodec[settings.get('payload_codec', PayloadCodec.BINARY.name)],
+                             settings.get('max_concurrent_queries', MAX_CONCURRENT_QUERIES),
+                             settings.get('key_exchange_group', DEFAULT_GROUP.name),
+                             KeyExchangeProtocol[settings.get('key_exchange_protocol', KeyExchangeProtocol.RING.name)],
+                             settings.get('epoch_duration', EPOCH_DURATION),
+                             settings.get('epoch_max_queries', EPOCH_MAX_QUERIES))
+    export_queue_depths(main_server.queue_depths())
+    loopback_server = LoopbackServer(logger, tuple(settings['loopback_address']), data_servers, user_query_queue, query_result_queue,
+                                     main_server.query_stats.snapshot, main_server.profile)
+
+    log_thread = Thread(target=logger.run, args=(log_stop_event,))
+    main_server_thread = Thread(target=safe_thread_target(logger, stop_event, main_server.run), args=(stop_event,))
+    loopback_server_thread = Thread(target=safe_thread_target(logger, stop_event, loopback_server.run), args=(stop_event,))
+    metrics_thread = None
+    if 'metrics_address' in settings:
+        metrics_server = MetricsServer(tuple(settings['metrics_address']), logger)
+        metrics_thread = Thread(target=safe_thread_target(logger, stop_event, metrics_server.run), args=(stop_event,))
+    log_thread.start()
+    main_server_thread.start()
+    loopback_server_thread.start()
+    if metrics_thread is not None:
+        metrics_thread.start()
+
+    wait_for_drain_request(drain_requested, stop_event)
+    if not stop_event.is_set():
+        logger.info('[QUERY] Draining...')
+        main_server.drain()
+        main_server_thread.join(options.drain_timeout)
+        # lets the loopback server hand out the last results
+        loopback_server.drain(options.drain_timeout)
+    stop_event.set()
+    main_server_thread.join()
+    loopback_server_thread.join()
+    if metrics_thread is not None:
+        metrics_thread.join()
+    TRACER.disable()
+    log_stop_event.set()
+    log_thread.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
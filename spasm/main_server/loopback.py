@@ -1,7 +1,6 @@
 from __future__ import annotations
 from typing import Optional, Union, Callable, Any, overload
 
-import traceback
 
 from dataclasses import dataclass
 from enum import Enum
@@ -15,89 +14,103 @@ import time
 from Crypto.Hash import SHA384
 
 from spasm.common.error import DataUnavailableError, ProtocolViolation
-from spasm.common.protocol import ByteBuffer, Message, MessageType
-from spasm.common.atomic import Promise
+from spasm.common.protocol import Message, MessageType
+from spasm.common.reactor import Reactor, Channel
+from spasm.common.atomic import safe_thread_target
 from spasm.common.diffie_hellman import DiffieHellmanState
 from spasm.common.network_components import DataServer
 from spasm.common.security import AsymmetricKey
-from spasm.common.defaults import REFRESH_DELAY
+from spasm.common.defaults import STOP_CHECK_INTERVAL, REFRESH_DELAY
+from spasm.common.log import Logger
+from spasm.common.tracing import TRACER, new_trace_id
+from spasm.common.profiling import PROFILER, ProfilingError
 
 
 class LoopbackServer:
-    def __init__(self, logger : Queue, address : tuple[str,int], data_servers : list[DataServer], user_requests : Queue, user_results : Queue):
+    def __init__(self, logger : Logger, address : tuple[str,int], data_servers : list[DataServer], user_requests : Queue, user_results : Queue, server_info : Optional[Callable[[], dict]] = None, profile : Optional[Callable[[dict], Any]] = None):
         self.address = address
+        self.server_info = server_info
+        self.profile = PROFILER.control if profile is None else profile
         self.logger = logger
         self.data_servers = data_servers
         
         self.user_requests = user_requests
         self.user_results = user_results
 
-    def reply_ok(self, request : Message, data = None):
-        self.main_connection.send(request.generate_reply(True,data).to_bytes())
+        # connection, trace id and arrival time of each query waiting for its result
+        self.pending_replies : dict[int, tuple[Channel, str, float]] = {}
 
-    def handle_request(self, request : Message):
-        self.logger.put(f'[NETWORK-LOOPBACK] received message from web: type `{\
-            request.type}`, id `{request.id}`, sid `{request.session_id}`.')
+    def reply_ok(self, connection : Channel, request : Message, data = None):
+        connection.send(request.generate_reply(True,data))
+
+    def handle_request(self, connection : Channel, request : Message):
+        self.logger.debug('[NETWORK-LOOPBACK] received message from web: type `%s`, id `%d`, sid `%d`.',
+            request.type, request.id, request.session_id)
         match request.type:
             case MessageType.PING:
-                self.reply_ok(request)
+                self.reply_ok(connection, request)
+            case MessageType.INFO:
+                self.reply_ok(connection, request, self.server_info() if self.server_info is not None else None)
+            case MessageType.PROFILE:
+                # may wait on the data servers, so not on the reactor thread
+                Thread(target=self.handle_profile, args=(connection, request)).start()
             case MessageType.USER_DATA_REQUEST:
-                self.user_requests.put((request, request.data))
+                # keyed by identity: the same Message object comes back with its result
+                trace_id = new_trace_id()
+                self.pending_replies[id(request)] = (connection, trace_id, time.time())
+                self.user_requests.put((request, request.data, trace_id))
             case _:
                 raise NotImplementedError
 
-    def handle_main_connection(self):
-        self.logger.put(f'[NETWORK-LOOPBACK] Start of connection with web server at {self.web_address}.')
-        reader = ByteBuffer()
-        self.main_connection.setblocking(False)
+    def handle_profile(self, connection : Channel, request : Message):
+        try:
+            if not isinstance(request.data, dict):
+                raise ProfilingError('Profiling requests take a dict.')
+            reply = self.profile(dict(request.data))
+        except (ProfilingError, DataUnavailableError, TypeError, ValueError) as e:
+            self.logger.warning('[PROFILE] %s', e)
+            connection.send(request.generate_reply(False, str(e)))
+            return
+        self.logger.info('[PROFILE] %s', reply)
+        self.reply_ok(connection, request, reply)
+
+    def accept_connection(self, conn : socket.socket, web_address):
+        self.logger.info('[NETWORK-LOOPBACK] Start of connection with web server at %s.', web_address)
+        self.reactor.add_channel(conn, web_address, self.handle_request, self.close_connection)
+
+    def close_connection(self, connection : Channel):
+        self.logger.info('[NETWORK-LOOPBACK] End of connection with web %s.', connection.address)
+
+    def return_results(self):
         while not self.stop_event.is_set():
-            time.sleep(REFRESH_DELAY)
-            try:
-                reader.append(self.main_connection.recv(2048))
-            except BlockingIOError:
-                pass
-            except DataUnavailableError:
-                break
-            except IOError as e:
-                self.logger.put(f'[ERROR-LOOPBACK] {e}')
-                break
-            else:
-                reader.save()
-                try:
-                    message = Message.from_bytes(buff=reader)
-                    self.handle_request(message)
-                except DataUnavailableError:
-                    reader.restore()
-            
             try:
-                message,reply = self.user_results.get_nowait()
-                self.logger.put(f'[LOOPBACK] Returning result: `{message.id}`, data: `{reply}`.')
-                self.reply_ok(message, reply)
+                message, success, reply = self.user_results.get(timeout=STOP_CHECK_INTERVAL)
             except Empty:
-                pass
-        
-        self.logger.put(f'[NETWORK-LOOPBACK] End of connection with web {self.web_address}.')
-        
+                continue
+            connection, trace_id, start = self.pending_replies.pop(id(message))
+            self.logger.debug('[LOOPBACK] Returning result: `%d`, data: `%s`.', message.id, reply)
+            try:
+                connection.send(message.generate_reply(success, reply))
+            except DataUnavailableError as e:
+                self.logger.error('[ERROR-LOOPBACK] %s', e)
+            TRACER.record(trace_id, 'loopback', start, time.time(), message=message.id)
+
+    def drain(self, timeout : float):
+        '''Waits up to `timeout` seconds for the results already computed to be sent back.'''
+        deadline = time.monotonic() + timeout
+        while not self.user_results.empty() and time.monotonic() < deadline:
+            time.sleep(REFRESH_DELAY)
+
     def run(self, stop_event: Event):
         self.stop_event = stop_event
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-                server.bind(self.address)
-                server.listen(1)
-                server.setblocking(False)
-                self.logger.put(f'[NETWORK-LOOPBACK] Started Loopback Server. Listening on {self.address}.')
-
-                while not stop_event.is_set():
-                    try:
-                        self.main_connection, self.web_address = server.accept()
-                        with self.main_connection:
-                            self.handle_main_connection()
-                    except BlockingIOError:
-                        time.sleep(REFRESH_DELAY)
-                        pass
+            self.reactor = Reactor(self.logger)
+            self.reactor.listen(self.address, self.accept_connection)
+            self.logger.info('[NETWORK-LOOPBACK] Started Loopback Server. Listening on %s.', self.address)
+            Thread(target=safe_thread_target(self.logger,self.stop_event,self.return_results)).start()
+            self.reactor.run(stop_event)
         except Exception as e:
-            self.logger.put(traceback.format_exc())
-            self.logger.put(f'[ERROR-LOOPBACK] {e}')
+            self.logger.exception('[ERROR-LOOPBACK] %s', e)
             self.stop_event.set()
         finally:
-            self.logger.put('[NETWORK-LOOPBACK] Closed Loopback Server.')
+            self.logger.info('[NETWORK-LOOPBACK] Closed Loopback Server.')
@@ -37,9 +37,13 @@ class WebLoopback:
             conditions = conditions_from_user_text(condition_text)
             with self.conn_lock:
                 self.sock.send(Message(MessageType.USER_DATA_REQUEST,conditional_to_struct(conditions)).to_bytes())
-                return Message.from_bytes(buff=self.sock,stop_event=self.stop_event).data
+                response = Message.from_bytes(buff=self.sock,stop_event=self.stop_event)
         except Exception as e:
             print('Backend error!')
             print(e)
             self.stop_event.set()
-            raise e
\ No newline at end of file
+            raise e
+        # the query failed, not the connection, so later queries may still work
+        if response.type is MessageType.RESPONSE_FAILED:
+            raise Exception(response.data)
+        return response.data
\ No newline at end of file
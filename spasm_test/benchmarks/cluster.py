@@ -0,0 +1,229 @@
+'''
+End-to-end throughput and latency of a cluster on localhost. \n
+Starts N headless data servers and a main server (`spasm.data_server.cli`, `spasm.main_server.cli`) on synthetic
+databases of the chosen size, then sends `USER_DATA_REQUEST`s to the loopback port from concurrent clients.
+Reports throughput, the latency the clients see, and the p50/p95/p99 latency of every stage, taken from the spans the
+servers trace (`main/query`, `main/key_exchange`, `main/fetch`, `data/DATA_REQUEST`, ...). Only queries sent after the
+warmup count. Results are written as JSON with `--output`, and `--compare` prints the change from an earlier run. \n
+Run from the repository root: `python -m spasm_test.benchmarks.cluster [--data-servers 3] [--records 10000] [--group p256] ...`
+'''
+from typing import Any, Optional
+
+from threading import Thread
+import subprocess
+import tempfile
+import argparse
+import datetime
+import platform
+import random
+import socket
+import signal
+import string
+import math
+import json
+import time
+import sys
+import os
+
+from spasm.common.protocol import Message, MessageType
+from spasm.common.codec import PayloadCodec
+from spasm.common.diffie_hellman import KeyExchangeProtocol, DEFAULT_GROUP, GROUPS
+from spasm.common.tracing import read_spans
+from spasm.main_server.backend import MAX_CONCURRENT_QUERIES, EPOCH_MAX_QUERIES
+
+# seconds a server may take to start listening
+START_TIMEOUT = 30
+STOP_TIMEOUT = 10
+QUANTILES = (.5, .95, .99)
+
+
+def synthetic_cluster(directory: str, options: argparse.Namespace) -> str:
+    '''Writes the databases, base data and config of a cluster to `directory`. Returns the config path.'''
+    rng = random.Random(options.seed)
+    ids = [''.join(rng.choices(string.digits, k=9)) for _ in range(options.records)]
+    base_data = {id: {'age': rng.randint(18, 90), 'sex': rng.choice('MF')} for id in ids}
+    with open(os.path.join(directory, 'base_data.json'), 'w') as file:
+        json.dump(base_data, file)
+    data_servers = []
+    for index in range(options.data_servers):
+        database = {id: {'sysBP': rng.randint(90, 180), 'diaBP': rng.randint(50, 110), 'planType': rng.randint(1, 3)} for id in ids}
+        with open(os.path.join(directory, f'data_server{index}.json'), 'w') as file:
+            json.dump(database, file)
+        data_servers.append({'id': f'bench{index:03d}', 'address': ['localhost', options.port + index],
+                             'information': {'name': f'Benchmark server {index}'}, 'database': f'data_server{index}.json',
+                             'trace_file': f'data_server{index}.spans'})
+    config = {
+        'data_servers': data_servers,
+        'main_server': {
+            'backend_address': ['localhost', options.port + options.data_servers],
+            'loopback_address': ['localhost', options.port + options.data_servers + 1],
+            'base_data': 'base_data.json',
+            'trace_file': 'main.spans',
+            'payload_codec': options.codec,
+            'max_concurrent_queries': options.concurrency,
+            'key_exchange_group': options.group,
+            'key_exchange_protocol': options.protocol,
+            'epoch_max_queries': options.epoch_max_queries,
+        },
+    }
+    path = os.path.join(directory, 'cluster.json')
+    with open(path, 'w') as file:
+        json.dump(config, file)
+    return path
+
+
+def start_server(args: list[str], log_path: str, ready_line: str) -> subprocess.Popen:
+    '''Starts a server module and waits for `ready_line` in its log. Connecting to probe it would take the main connection.'''
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, '-m', *args, '--log-level', 'INFO'], stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        with open(log_path) as log:
+            if ready_line in log.read():
+                return process
+        if process.poll() is not None:
+            break
+        time.sleep(.05)
+    process.kill()
+    with open(log_path) as log:
+        raise RuntimeError(f'{args[0]} did not start:\n{log.read()}')
+
+
+def stop_servers(processes: list[subprocess.Popen]):
+    '''Drains the main server first, the data servers stop once it disconnects.'''
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_client(address: tuple[str, int], count: int, latencies: list[float], failures: list[str]):
+    with socket.create_connection(address) as connection:
+        for _ in range(count):
+            start = time.perf_counter()
+            connection.sendall(Message(MessageType.USER_DATA_REQUEST, {}).to_bytes())
+            response = Message.from_bytes(buff=connection)
+            latencies.append(time.perf_counter() - start)
+            if response.type is not MessageType.RESPONSE_OK or not response.data:
+                failures.append(str(response.data))
+
+
+def drive(address: tuple[str, int], clients: int, queries: int) -> tuple[float, list[float], list[str]]:
+    '''Sends `queries` queries from `clients` connections at once. Returns (seconds, latencies, failures).'''
+    latencies, failures = [], []
+    threads = [Thread(target=run_client, args=(address, queries // clients + (index < queries % clients), latencies, failures))
+               for index in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, failures
+
+
+def summarize(seconds: list[float]) -> dict[str, float]:
+    '''Count, mean and nearest-rank quantiles, in milliseconds.'''
+    values = sorted(seconds)
+    summary = {'count': len(values), 'mean': sum(values) / len(values) * 1e3}
+    for q in QUANTILES:
+        summary[f'p{round(q * 100)}'] = values[max(math.ceil(q * len(values)) - 1, 0)] * 1e3
+    return summary
+
+
+def stage_latencies(paths: list[str], since: float) -> dict[str, list[float]]:
+    '''Span durations by `process kind/span name`, for spans that started after `since`.'''
+    stages: dict[str, list[float]] = {}
+    for spans in read_spans([path for path in paths if os.path.exists(path)]).values():
+        for span in spans:
+            if span['start'] >= since:
+                stage = f'{(span['process'] or '').split(':')[0]}/{span['name']}'
+                stages.setdefault(stage, []).append(span['end'] - span['start'])
+    return stages
+
+
+def run(options: argparse.Namespace) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix='spasm-bench-') as directory:
+        config_path = synthetic_cluster(directory, options)
+        with open(config_path) as file:
+            config = json.load(file)
+        processes = []
+        try:
+            for index in range(options.data_servers):
+                processes.append(start_server(['spasm.data_server.cli', config_path, '--index', str(index)],
+                                              os.path.join(directory, f'data_server{index}.log'), '[SERVER] Started Server.'))
+            processes.insert(0, start_server(['spasm.main_server.cli', config_path],
+                                             os.path.join(directory, 'main.log'), '[QUERY] Running up to'))
+            address = tuple(config['main_server']['loopback_address'])
+            if options.warmup:
+                drive(address, options.clients, options.warmup)
+            since = time.time()
+            seconds, latencies, failures = drive(address, options.clients, options.queries)
+        finally:
+            stop_servers(processes)
+        paths = [os.path.join(directory, 'main.spans')] + [os.path.join(directory, entry['trace_file']) for entry in config['data_servers']]
+        stages = stage_latencies(paths, since)
+
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'config': {key: value for key, value in vars(options).items() if key not in ('output', 'compare')},
+        'queries': len(latencies),
+        'failures': len(failures),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds,
+        'latency': {'client': summarize(latencies)} | {stage: summarize(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def print_results(results: dict[str, Any], previous: Optional[dict[str, Any]] = None):
+    def change(value: float, old: Optional[float]) -> str:
+        return f'{(value / old - 1) * 100:>+7.1f}%' if old else ''
+
+    old_throughput = previous['throughput'] if previous else None
+    print(f'{results["queries"]} queries, {results["failures"]} failed, {results["seconds"]:.2f} s: '
+          f'{results["throughput"]:.1f} queries/s {change(results["throughput"], old_throughput)}')
+    print(f'{"stage":<32}{"count":>8}{"mean":>11}' + ''.join(f'{f"p{round(q * 100)}":>11}' for q in QUANTILES) + ('    p99 change' if previous else ''))
+    for stage, summary in results['latency'].items():
+        old = previous['latency'].get(stage, {}).get('p99') if previous else None
+        print(f'{stage:<32}{summary["count"]:>8}{summary["mean"]:>8.2f} ms'
+              + ''.join(f'{summary[f"p{round(q * 100)}"]:>8.2f} ms' for q in QUANTILES) + f'   {change(summary["p99"], old)}')
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='spasm_test.benchmarks.cluster', description='Benchmarks a cluster on localhost.')
+    parser.add_argument('--data-servers', type=int, default=3)
+    parser.add_argument('--records', type=int, default=10000, help='ids in the base data, each data server holds a record for every one')
+    parser.add_argument('--group', choices=list(GROUPS), default=DEFAULT_GROUP.name)
+    parser.add_argument('--protocol', choices=[protocol.name for protocol in KeyExchangeProtocol], default=KeyExchangeProtocol.RING.name)
+    parser.add_argument('--codec', choices=[codec.name for codec in PayloadCodec], default=PayloadCodec.BINARY.name)
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENT_QUERIES, help='queries the main server runs at once')
+    parser.add_argument('--epoch-max-queries', type=int, default=EPOCH_MAX_QUERIES, help='queries per key exchange')
+    parser.add_argument('--clients', type=int, default=4, help='connections sending queries at once')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20, help='queries sent before measuring, not counted')
+    parser.add_argument('--port', type=int, default=15500, help='first of the data servers, backend and loopback ports')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    options = parser.parse_args(args)
+    if options.data_servers < 1 or options.records < 4 or options.clients < 1 or options.queries < options.clients:
+        parser.error('Needs at least 1 data server, 4 records (the minimal study group) and a query per client.')
+
+    previous = None
+    if options.compare is not None:
+        with open(options.compare) as file:
+            previous = json.load(file)
+    results = run(options)
+    print_results(results, previous)
+    if options.output is not None:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return 1 if results['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+'''
+Payload codec throughput and wire size, JSON against BINARY. \n
+Run from the repository root: `python -m spasm_test.benchmarks.codec [record count ...]`
+'''
+import sys
+import random
+import timeit
+
+from Crypto.Hash import SHA384
+
+from spasm.common.codec import PayloadCodec, encode_payload, decode_payload
+from spasm.common.diffie_hellman import MODULUS
+
+
+def data_reply(record_count: int, raw_digests: bool):
+    '''A `DATA_REQUEST` reply shaped like `DataComponent._read` output.'''
+    result = []
+    for idx in range(record_count):
+        hasher = SHA384.new(str(idx).encode())
+        record = {'sysBP': random.randint(90, 150), 'diaBP': random.randint(50, 100), 'planType': random.randint(1, 3),
+                  'riskFactor': round(random.random()*5, 2), 'hadSurgery': random.random() < .5}
+        result.append([hasher.digest() if raw_digests else hasher.hexdigest(), record])
+    return result
+
+
+def measure(name: str, value, codec: PayloadCodec):
+    payload = encode_payload(value, codec)
+    assert decode_payload(payload, codec) is not None
+    number, encode_time = timeit.Timer(lambda: encode_payload(value, codec)).autorange()
+    encode_time /= number
+    number, decode_time = timeit.Timer(lambda: decode_payload(payload, codec)).autorange()
+    decode_time /= number
+    mib = len(payload) / (1 << 20)
+    print(f'{name:<28}{codec.name:<8}{len(payload):>12,} B'
+          f'{encode_time*1e6:>12.1f} us{mib/encode_time:>10.1f} MiB/s'
+          f'{decode_time*1e6:>12.1f} us{mib/decode_time:>10.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    record_counts = [int(arg) for arg in sys.argv[1:]] or [10, 1000, 100000]
+    random.seed(0)
+    print(f'{"payload":<28}{"codec":<8}{"wire size":>14}{"encode":>15}{"":>16}{"decode":>15}')
+    for record_count in record_counts:
+        measure(f'data reply x{record_count}', data_reply(record_count, False), PayloadCodec.JSON)
+        measure(f'data reply x{record_count}', data_reply(record_count, True), PayloadCodec.BINARY)
+    key = random.randrange(MODULUS)
+    for codec in PayloadCodec:
+        measure('intermediate key', key, codec)
@@ -0,0 +1,42 @@
+'''
+Fixed-base comb against builtin `pow` for powers of `GENERATOR`, in each MODP group. \n
+Run from the repository root: `python -m spasm_test.benchmarks.fixed_base [rows ...]`
+'''
+import sys
+import os
+import time
+import timeit
+import tempfile
+
+from spasm.common.diffie_hellman import FixedBaseTable, ModPGroup, GROUPS, COMB_ROWS
+
+
+def measure(group: ModPGroup, rows: int):
+    start = time.perf_counter()
+    table = FixedBaseTable(group.generator(), group.modulus, group.exponent_bits, rows)
+    build_time = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'table')
+        table.save(path)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        assert FixedBaseTable.load(path, group.generator(), group.modulus, group.exponent_bits, rows) is not None
+        load_time = time.perf_counter() - start
+
+    exponents = [group.random_exponent() for _ in range(8)]
+    assert all(table.power(exponent) == pow(group.generator(), exponent, group.modulus) for exponent in exponents)
+    number, comb_time = timeit.Timer(lambda: [table.power(exponent) for exponent in exponents]).autorange()
+    comb_time /= number * len(exponents)
+    number, pow_time = timeit.Timer(lambda: [pow(group.generator(), exponent, group.modulus) for exponent in exponents]).autorange()
+    pow_time /= number * len(exponents)
+    print(f'{group.name:<16}{rows:>5}{size:>12,} B{build_time*1e3:>10.1f} ms{load_time*1e3:>10.1f} ms'
+          f'{pow_time*1e3:>10.2f} ms{comb_time*1e3:>10.2f} ms{pow_time/comb_time:>8.2f}x')
+
+
+if __name__ == '__main__':
+    rows_options = [int(arg) for arg in sys.argv[1:]] or [COMB_ROWS]
+    print(f'{"group":<16}{"rows":>5}{"table":>14}{"build":>13}{"load":>13}{"pow":>13}{"comb":>13}{"speedup":>9}')
+    for group in GROUPS.values():
+        if isinstance(group, ModPGroup):
+            for rows in rows_options:
+                measure(group, rows)
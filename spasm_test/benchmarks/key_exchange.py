@@ -0,0 +1,56 @@
+'''
+Cost of each key exchange protocol in each group, for N = 2..10 parties. \n
+A step is one exponentiation of a received key: each of the N - 1 ring steps, or the two exponentiations of the
+round one keys in Burmester-Desmedt. The session cost is everything one party computes. Parties run in parallel,
+so the latency of an exchange is about the session cost plus `rounds` sequential network round trips. \n
+Run from the repository root: `python -m spasm_test.benchmarks.key_exchange [group ...]`
+'''
+import sys
+import time
+
+from spasm.common.diffie_hellman import DiffieHellmanState, BurmesterDesmedtState, KeyExchangeProtocol, GROUPS
+
+PARTIES = range(2, 11)
+
+
+def run_ring(n: int, group) -> tuple[float, float, int]:
+    '''Runs the ring exchange with `n` parties in-process. Returns (seconds per step, seconds per party, network rounds).'''
+    start = time.perf_counter()
+    parties = [DiffieHellmanState(n, group) for _ in range(n)]
+    setup_time = time.perf_counter() - start
+    step_time = 0.
+    for _ in range(n-1):
+        keys = [party.public_key() for party in parties]
+        start = time.perf_counter()
+        for i, party in enumerate(parties):
+            party.transform_intermediate_key(keys[i-1])
+        step_time += time.perf_counter() - start
+    assert len({party.result() for party in parties}) == 1
+    return step_time / (n*(n-1)), (setup_time + step_time) / n, n - 1
+
+
+def run_burmester_desmedt(n: int, group) -> tuple[float, float, int]:
+    start = time.perf_counter()
+    parties = [BurmesterDesmedtState(n, i, group) for i in range(n)]
+    public_keys = [party.public_key() for party in parties]
+    second_round_start = time.perf_counter()
+    broadcasts = [party.second_round(public_keys) for party in parties]
+    second_round_time = time.perf_counter() - second_round_start
+    for party in parties:
+        party.finish(broadcasts)
+    elapsed = time.perf_counter() - start
+    assert len({party.result() for party in parties}) == 1
+    return second_round_time / (2*n), elapsed / n, 2
+
+
+PROTOCOLS = {KeyExchangeProtocol.RING: run_ring, KeyExchangeProtocol.BURMESTER_DESMEDT: run_burmester_desmedt}
+
+
+if __name__ == '__main__':
+    groups = [GROUPS[name] for name in sys.argv[1:]] or list(GROUPS.values())
+    print(f'{"group":<16}{"protocol":<20}{"N":>4}{"per step":>14}{"per session":>14}{"rounds":>8}')
+    for group in groups:
+        for protocol, run in PROTOCOLS.items():
+            for n in PARTIES:
+                step, session, rounds = run(n, group)
+                print(f'{group.name:<16}{protocol.name:<20}{n:>4}{step*1e3:>11.2f} ms{session*1e3:>11.2f} ms{rounds:>8}')
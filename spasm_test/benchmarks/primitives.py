@@ -0,0 +1,199 @@
+'''
+Micro-benchmarks of the hot primitives, checked against a baseline. \n
+Covers `Message.to_bytes`/`from_bytes` by payload size, `MessageDecoder` (`ByteBuffer` append/recv) fed in fragments,
+`filter_ids` by base data size, `DataComponent._read` hashing and the ring `DiffieHellmanState` step of each group.
+Every case reports the best of `--repeat` timings. With `--baseline`, a case more than `--threshold` slower than its
+baseline fails the run with status 1, so it can guard a build. \n
+Baselines only compare on the machine that recorded them, so none is committed. On each build host, first record one
+with `--save`, then check later runs with `--baseline`. Both default to `$SPASM_BENCHMARK_BASELINE`, or to
+`primitives_baseline.json` next to this file, which git ignores. \n
+Run from the repository root: `python -m spasm_test.benchmarks.primitives [--only NAME] [--save [FILE]] [--baseline [FILE]]`
+'''
+from typing import Any, Callable, Iterator, Optional
+
+import argparse
+import datetime
+import platform
+import random
+import copy
+import timeit
+import json
+import sys
+import os
+
+from spasm.common.protocol import Message, MessageType, MessageDecoder
+from spasm.common.codec import PayloadCodec
+from spasm.common.queries import Condition, BoundType, filter_ids
+from spasm.common.diffie_hellman import DiffieHellmanState, GROUPS
+from spasm.common.log import Logger
+from spasm.data_server.data import DataComponent, Database
+from spasm_test.benchmarks.codec import data_reply
+
+BASELINE = os.environ.get('SPASM_BENCHMARK_BASELINE', os.path.join(os.path.dirname(__file__), 'primitives_baseline.json'))
+# fraction a case may get slower than its baseline before the check fails
+THRESHOLD = .3
+REPEAT = 5
+MESSAGE_RECORDS = (1, 100, 10000)
+# TCP segment, and worse
+FRAGMENT_SIZES = (1460, 64)
+# filter_ids runs on 10^3 records and every power of ten up to this
+MAX_FILTER_RECORDS = 10**6
+READ_SIZES = (100, 10000)
+
+# (name, items per run, setup returning the function to time)
+Case = tuple[str, int, Callable[[], Callable[[], Any]]]
+
+
+def message_cases() -> Iterator[Case]:
+    for record_count in MESSAGE_RECORDS:
+        def setup_encode(record_count=record_count):
+            message = Message(MessageType.RESPONSE_PART, data_reply(record_count, True), codec=PayloadCodec.BINARY)
+            return message.to_bytes
+
+        def setup_decode(record_count=record_count):
+            frame = Message(MessageType.RESPONSE_PART, data_reply(record_count, True), codec=PayloadCodec.BINARY).to_bytes()
+            return lambda: Message.from_bytes(frame)
+        yield f'message.to_bytes[{record_count}]', record_count, setup_encode
+        yield f'message.from_bytes[{record_count}]', record_count, setup_decode
+
+
+def decoder_cases() -> Iterator[Case]:
+    '''A stream of 100 frames of 100 records, fed to the decoder in fixed size fragments as a socket would.'''
+    for fragment_size in FRAGMENT_SIZES:
+        def setup(fragment_size=fragment_size):
+            stream = Message(MessageType.RESPONSE_PART, data_reply(100, True), codec=PayloadCodec.BINARY).to_bytes() * 100
+            fragments = [stream[start:start + fragment_size] for start in range(0, len(stream), fragment_size)]
+
+            def decode():
+                decoder = MessageDecoder()
+                count = 0
+                for fragment in fragments:
+                    decoder.feed(fragment)
+                    count += sum(1 for _ in decoder)
+                assert count == 100
+            return decode
+        yield f'decoder.feed[{fragment_size} B]', 100, setup
+
+
+def base_data(size: int) -> dict[str, dict]:
+    rng = random.Random(0)
+    return {f'{index:09d}': {'age': rng.randint(18, 90), 'sex': rng.choice('MF')} for index in range(size)}
+
+
+def filter_cases(sizes: tuple[int, ...]) -> Iterator[Case]:
+    conditions = {'age': Condition(BoundType.AT_LEAST, 50), 'sex': Condition(BoundType.NOT, 'M')}
+    for size in sizes:
+        def setup(size=size):
+            data = base_data(size)
+            return lambda: filter_ids(data, conditions)
+        yield f'filter_ids[{size}]', size, setup
+
+
+class MemoryDatabase(Database):
+    '''`JsonFileDatabase` without the file.'''
+
+    def get(self, id):
+        return copy.deepcopy(self._data.get(id))
+
+
+def read_cases() -> Iterator[Case]:
+    for size in READ_SIZES:
+        def setup(size=size):
+            data = base_data(size)
+            database = DataComponent(MemoryDatabase(data), Logger())
+            salt, ids = os.urandom(16), list(data)
+            return lambda: database._read(ids, salt, True)
+        yield f'data.read[{size}]', size, setup
+
+
+def key_exchange_cases() -> Iterator[Case]:
+    for name, group in GROUPS.items():
+        def setup(group=group):
+            # never reaches the last step, so it can transform keys indefinitely
+            state = DiffieHellmanState(1 << 30, group)
+            key = DiffieHellmanState(2, group).public_key()
+            return lambda: state.transform_intermediate_key(key)
+        yield f'dh.step[{name}]', 1, setup
+
+
+def all_cases(filter_sizes: tuple[int, ...]) -> Iterator[Case]:
+    yield from message_cases()
+    yield from decoder_cases()
+    yield from filter_cases(filter_sizes)
+    yield from read_cases()
+    yield from key_exchange_cases()
+
+
+def measure(function: Callable[[], Any], repeat: int) -> float:
+    '''Best seconds per call of `repeat` runs, each long enough to time reliably.'''
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.Timer(function).repeat(repeat, number)) / number
+
+
+def host() -> dict[str, Any]:
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='spasm_test.benchmarks.primitives', description='Micro-benchmarks of the hot primitives.')
+    parser.add_argument('--only', action='append', help='run only cases whose name contains this, may be repeated')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--max-records', type=int, default=MAX_FILTER_RECORDS, help='largest base data for filter_ids, up to 10000000')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE, help=f'fail on cases slower than this baseline (default {BASELINE})')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='allowed slowdown, as a fraction of the baseline')
+    parser.add_argument('--save', nargs='?', const=BASELINE, help='write the timings as a baseline')
+    options = parser.parse_args(args)
+
+    baseline = {}
+    if options.baseline is not None:
+        if not os.path.exists(options.baseline):
+            print(f'No baseline at {options.baseline}. Record one on this host first, with --save.')
+            return 2
+        with open(options.baseline) as file:
+            saved = json.load(file)
+        baseline = saved['cases']
+        if saved['host'] != host():
+            print(f'Baseline recorded on {saved["host"]}, not on this host {host()}. Expect differences.')
+    filter_sizes = tuple(10**exponent for exponent in range(3, 8) if 10**exponent <= options.max_records)
+
+    results, regressions = {}, []
+    print(f'{"case":<32}{"per call":>12}{"per item":>12}' + (f'{"baseline":>12}{"change":>9}' if baseline else ''))
+    for name, items, setup in all_cases(filter_sizes):
+        if options.only and not any(part in name for part in options.only):
+            continue
+        seconds = measure(setup(), options.repeat)
+        results[name] = seconds
+        line = f'{name:<32}{format_time(seconds):>12}{format_time(seconds / items):>12}'
+        if (old := baseline.get(name)) is not None:
+            change = seconds / old - 1
+            line += f'{format_time(old):>12}{change * 100:>+8.1f}%'
+            if change > options.threshold:
+                regressions.append(name)
+                line += '  SLOWER'
+        print(line, flush=True)
+
+    if options.save is not None:
+        # cases left out by `--only` keep their saved timings
+        cases = {}
+        if os.path.exists(options.save):
+            with open(options.save) as file:
+                cases = json.load(file)['cases']
+        with open(options.save, 'w') as file:
+            json.dump({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'host': host(),
+                       'cases': cases | results}, file, indent=2)
+            file.write('\n')
+    if regressions:
+        print(f'{len(regressions)} case(s) more than {options.threshold:.0%} slower than the baseline: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
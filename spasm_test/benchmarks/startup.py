@@ -0,0 +1,48 @@
+'''
+Startup budget of the server processes. \n
+Imports each server module in a fresh interpreter under `-X importtime` and fails if it takes longer than its
+budget or pulls in a UI-only dependency. Exits with status 1 on any failure, so it can guard a build. \n
+Run from the repository root: `python -m spasm_test.benchmarks.startup [runs]`
+'''
+import sys
+import subprocess
+import time
+
+# module -> seconds its import may take
+BUDGETS = {
+    'spasm.data_server.network': .3,
+    'spasm.main_server.backend': .3,
+    'spasm.main_server.loopback': .3,
+}
+FORBIDDEN_MODULES = ['tkinter', 'wtforms', 'flask']
+
+
+def measure(module: str) -> tuple[float, float, list[str]]:
+    '''Returns (import seconds, process wall seconds, forbidden modules loaded) for one cold import of `module`.'''
+    code = f'import sys, {module}; print(" ".join(name for name in {FORBIDDEN_MODULES!r} if name in sys.modules))'
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+    wall_time = time.perf_counter() - start
+    # `import time: self [us] | cumulative | name`, a top level import has no indentation before its name
+    import_time = 0
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].startswith(' spasm') and not fields[2].startswith('  '):
+            import_time += int(fields[1]) / 1e6
+    return import_time, wall_time, process.stdout.split()
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    failed = False
+    print(f'{"module":<32}{"import":>10}{"wall":>10}{"budget":>10}')
+    for module, budget in BUDGETS.items():
+        results = [measure(module) for _ in range(runs)]
+        import_time = min(result[0] for result in results)
+        wall_time = min(result[1] for result in results)
+        forbidden = results[0][2]
+        over = import_time > budget
+        failed |= over or bool(forbidden)
+        print(f'{module:<32}{import_time*1e3:>7.0f} ms{wall_time*1e3:>7.0f} ms{budget*1e3:>7.0f} ms'
+              f'{"  OVER BUDGET" if over else ""}{"  imports " + ", ".join(forbidden) if forbidden else ""}')
+    sys.exit(1 if failed else 0)
@@ -5,37 +5,11 @@ print(sys.argv)
 
 from spasm.common.security import AsymmetricKey   
  
-from spasm.data_server import App, Database
+from spasm.data_server import App
+from spasm.data_server.data import JsonFileDatabase
 
 from spasm_test import DATA_SERVERS
 
-import copy
-import json
-
-class JsonFileDatabase(Database):
-    # def write_disk(self):
-    #     with open(self.file_location, 'w') as f:
-    #         json.dump(self.data, f)
-
-    def read_disk(self):
-        with open(self.file_location, 'r') as f:
-            self.data : dict = json.load(f)
-
-    def __init__(self, location : str):
-        self.file_location = location
-        self.read_disk()
-
-    def get(self, id):
-        return copy.deepcopy(self.data.get(id))
-
-    # def set(self, id, data):
-    #     self.data[id] = copy.deepcopy(data)
-    #     self.write_disk()
-
-    # def clear(self):
-    #     self.data = {}
-    #     self.write_disk()
-
 
 if __name__ == '__main__':
     if len(sys.argv) != 2: